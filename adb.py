@@ -0,0 +1,247 @@
+'''
+Async database access for aserver.py.
+
+Statements are built with the same SQLAlchemy models and indexer helpers the
+Flask server uses, compiled for the target dialect, and run on aiosqlite or
+asyncpg. A slow query then waits on the event loop instead of holding a
+thread per request.
+'''
+import asyncio
+import re
+import time
+from collections import namedtuple
+
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.orm import Query
+from sqlalchemy.sql.expression import Select
+
+from database import SQLITE_PRAGMAS
+from settings import DB_STATEMENT_CACHE_SIZE
+
+
+class Statements(object):
+    '''Stands in for a Session where helpers only build queries (indexer.lookup).'''
+
+    def query(self, *entities):
+        return Query(entities)
+
+
+class _SqlitePool(object):
+    '''aiosqlite connections, opened on demand up to size.'''
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.opened = 0
+        self.idle = asyncio.Queue()
+
+    async def acquire(self):
+        if self.idle.empty() and self.opened < self.size:
+            import aiosqlite
+            self.opened += 1
+            conn = await aiosqlite.connect(self.path)
+            for pragma in SQLITE_PRAGMAS:
+                await conn.execute(pragma)
+            return conn
+        return await self.idle.get()
+
+    async def release(self, conn):
+        self.idle.put_nowait(conn)
+
+    async def close(self):
+        while not self.idle.empty():
+            await self.idle.get_nowait().close()
+        self.opened = 0
+
+
+class Connection(object):
+    '''One pooled connection; rows come back as named tuples.'''
+
+    def __init__(self, db, raw, transaction=None):
+        self.db = db
+        self.raw = raw
+        self.transaction = transaction
+        self.finished = False
+
+    async def _run(self, stmt):
+        sql, params = self.db.compile(stmt)
+        if self.db.backend == 'sqlite':
+            cursor = await self.raw.execute(sql, params)
+            rows = await cursor.fetchall() if cursor.description else []
+            names = [d[0] for d in cursor.description or ()]
+            count = cursor.rowcount
+            await cursor.close()
+        elif isinstance(stmt, (Query, Select)):
+            records = await self.raw.fetch(sql, *params)
+            rows = [tuple(r.values()) for r in records]
+            names = list(records[0].keys()) if records else []
+            count = len(rows)
+        else:
+            status = await self.raw.execute(sql, *params)
+            rows, names = [], []
+            count = int(status.split()[-1]) if status.split()[-1].isdigit() else 0
+        return rows, names, count
+
+    async def fetch_all(self, stmt):
+        rows, names, count = await self._run(stmt)
+        if not rows:
+            return []
+        processors = self.db.processors(stmt)
+        row_type = namedtuple('Row', names, rename=True)
+        out = []
+        for row in rows:
+            if processors:
+                row = [p(v) if p else v for p, v in zip(processors, row)]
+            out.append(row_type(*row))
+        return out
+
+    async def fetch_one(self, stmt):
+        if hasattr(stmt, 'limit'):
+            stmt = stmt.limit(1)
+        rows = await self.fetch_all(stmt)
+        return rows[0] if rows else None
+
+    async def execute(self, stmt):
+        '''Run an insert/update/delete and return the number of rows it touched.'''
+        return (await self._run(stmt))[2]
+
+    async def commit(self):
+        if not self.finished:
+            self.finished = True
+            if self.db.backend == 'sqlite':
+                await self.raw.commit()
+            elif self.transaction is not None:
+                await self.transaction.commit()
+
+    async def rollback(self):
+        if not self.finished:
+            self.finished = True
+            if self.db.backend == 'sqlite':
+                await self.raw.rollback()
+            elif self.transaction is not None:
+                await self.transaction.rollback()
+
+
+class _Acquire(object):
+    def __init__(self, db, transaction):
+        self.db = db
+        self.transaction = transaction
+        self.conn = None
+
+    async def __aenter__(self):
+        pool = await self.db.connect()
+        start = time.time()
+        raw = await pool.acquire()
+        self.db.checked_out(time.time() - start)
+        tr = None
+        if self.transaction and self.db.backend == 'postgresql':
+            tr = raw.transaction()
+            await tr.start()
+        self.conn = Connection(self.db, raw, tr)
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is not None or not self.transaction:
+                await self.conn.rollback()
+            else:
+                await self.conn.commit()
+        finally:
+            self.db.checked_in()
+            await self.db.pool.release(self.conn.raw)
+        return False
+
+
+class AsyncDB(object):
+    def __init__(self, uri, pool_size=10):
+        self.pool_size = pool_size
+        self.pool = None
+        self.in_use = 0
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        if uri.startswith('sqlite'):
+            self.backend = 'sqlite'
+            self.dialect = sqlite.dialect(paramstyle='qmark')
+            self.path = uri.partition(':///')[2] or ':memory:'
+        elif uri.startswith('postgres'):
+            self.backend = 'postgresql'
+            self.dialect = postgresql.dialect(paramstyle='format')
+            self.dsn = re.sub(r'^postgres(ql)?(\+\w+)?://', 'postgresql://', uri)
+        else:
+            raise ValueError('No async driver for %s' % uri.split(':', 1)[0])
+
+    async def connect(self):
+        if self.pool is None:
+            if self.backend == 'sqlite':
+                self.pool = _SqlitePool(self.path, self.pool_size)
+            else:
+                import asyncpg
+                self.pool = await asyncpg.create_pool(self.dsn, max_size=self.pool_size,
+                                                      statement_cache_size=DB_STATEMENT_CACHE_SIZE)
+        return self.pool
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    def checked_out(self, waited):
+        self.in_use += 1
+        self.checkouts += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def checked_in(self):
+        self.in_use -= 1
+
+    def stats(self):
+        '''Pool counters for /status, as database.pool_stats() gives them.'''
+        if self.pool is None:
+            size = 0
+        elif self.backend == 'sqlite':
+            size = self.pool.opened
+        else:
+            size = self.pool.get_size()
+        return {'size': size,
+                'checked_out': self.in_use,
+                'checkouts': self.checkouts,
+                'wait_avg_ms': round(1000 * self.wait_total / self.checkouts, 3) if self.checkouts else 0,
+                'wait_max_ms': round(1000 * self.wait_max, 3),
+               }
+
+    def connection(self):
+        '''async with db.connection() as conn: read-only work, nothing is committed.'''
+        return _Acquire(self, False)
+
+    def transaction(self):
+        '''async with db.transaction() as conn: committed on exit unless it raises.'''
+        return _Acquire(self, True)
+
+    def compile(self, stmt):
+        '''SQL text and positional parameters for stmt (a Core statement or Query).'''
+        if hasattr(stmt, 'statement'):
+            stmt = stmt.statement
+        compiled = stmt.compile(dialect=self.dialect)
+        values = compiled.construct_params()
+        params = []
+        for name in compiled.positiontup:
+            process = compiled.binds[name].type.dialect_impl(self.dialect).bind_processor(self.dialect)
+            params.append(process(values[name]) if process else values[name])
+        sql = compiled.string
+        if self.backend == 'postgresql':
+            # asyncpg wants $1, $2, ... where psycopg2 takes %s
+            numbers = iter(range(1, len(params) + 1))
+            sql = re.sub(r'%[%s]', lambda m: '%' if m.group() == '%%' else '$%d' % next(numbers), sql)
+        return sql, params
+
+    def processors(self, stmt):
+        '''Result processors (e.g. sqlite text -> datetime) for a select's columns.'''
+        if hasattr(stmt, 'statement'):
+            stmt = stmt.statement
+        columns = getattr(stmt, 'inner_columns', None)
+        if columns is None:
+            return []
+        out = [c.type.dialect_impl(self.dialect).result_processor(self.dialect, None)
+               for c in columns]
+        return out if any(out) else []
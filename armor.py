@@ -0,0 +1,237 @@
+'''
+Single-pass parser for Bitcoin signed-message ASCII armor.
+
+Rein documents nest signed messages inside each other; inner envelopes mark
+their armor lines with a leading "- " ("- ----BEGIN SIGNATURE-----"). parse()
+walks the text once, line by line, and returns a Document holding a tree of
+Envelopes with their header fields, body lines, signature address and
+signature, plus the exact text each envelope's signature was made over.
+strip() cuts the signed message out of armored text, nested or not.
+'''
+import re
+
+BEGIN = '-----BEGIN BITCOIN SIGNED MESSAGE-----'
+SIGNATURE = '-----BEGIN SIGNATURE-----'
+END = '-----END BITCOIN SIGNED MESSAGE-----'
+
+# armor line -> canonical marker; nested envelopes use the "- ----" form
+_MARKERS = {}
+for _m in (BEGIN, SIGNATURE, END):
+    _MARKERS[_m] = _m
+    _MARKERS['- ' + _m[1:]] = _m
+
+_SIG_LINE = re.compile(r'[A-z\d=+/]+\Z')
+
+
+# "Name: value" the way validate.parse_sig()'s regex reads it: split at the
+# last ':' followed by whitespace that leaves a non-empty value
+_FIELD = re.compile(r'(.+):\s(.+)\Z')
+
+
+def split_field(line):
+    '''(name, value) of a "Name: value" line, or None.'''
+    m = _FIELD.match(line)
+    return m.groups() if m else None
+
+
+class Envelope(object):
+    def __init__(self, document, parent, begin):
+        self.document = document
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.begin = begin          # line numbers of the armor lines
+        self.lead = ''              # text before a top-level BEGIN marker on its line
+        self.sig = None
+        self.end = None
+        self.children = []
+        self.lines = []             # body lines outside child envelopes
+        self.fields = []            # (name, value) pairs from self.lines
+        self.signature_address = None
+        self.signature = None
+
+    @property
+    def doc_type(self):
+        '''First "Rein ..." line of this envelope's own body, if any.'''
+        for line in self.lines:
+            if line.startswith('Rein '):
+                return line
+        return None
+
+    @property
+    def signed(self):
+        return self.signature is not None
+
+    @property
+    def message(self):
+        '''The text this envelope's signature covers, or None if it isn't signed.
+
+        The body without trailing blank lines, and with every "\\n\\n"
+        removed. For the root envelope use Document.message, which also keeps
+        the text around the armor.'''
+        if not self.signed:
+            return None
+        lines = self.document.lines
+        text = '\n'.join(lines[self.begin + 1:self.sig]).rstrip('\n')
+        return text.replace('\n\n', '')
+
+    @property
+    def text(self):
+        '''This envelope as a standalone armored document (own markers unescaped).'''
+        lines = self.document.lines
+        end = self.end if self.end is not None else len(lines) - 1
+        out = lines[self.begin:end + 1]
+        for n in (self.begin, self.sig, self.end):
+            if n is not None:
+                out[n - self.begin] = _MARKERS.get(lines[n], BEGIN)
+        return '\n'.join(out)
+
+    def walk(self):
+        '''This envelope and its descendants, parents first.'''
+        yield self
+        for child in self.children:
+            for env in child.walk():
+                yield env
+
+    def __repr__(self):
+        return '<Envelope depth=%d %r>' % (self.depth, self.doc_type)
+
+
+class Document(object):
+    def __init__(self, text):
+        self.text = text
+        self.lines = text.split('\n')
+        self.root = None        # first top-level envelope
+        self.toplevel = 0       # number of top-level envelopes
+        self.fields = []        # (name, value) pairs at any depth, in document order
+        self.body = []          # body lines at any depth, in document order
+        # the first signature block in the text, which is what
+        # validate.parse_sig() returns whatever the envelope structure
+        self.signature_address = None
+        self.signature = None
+        self._message = None
+
+    @property
+    def message(self):
+        '''Signed text of the root envelope, as strip() cuts it.'''
+        if self._message is None:
+            self._message = strip(self.text)
+        return self._message
+
+    def info(self):
+        '''Field dict in the shape validate.parse_sig() returns, or False.'''
+        if self.signature is None:
+            return False
+        ret = {}
+        for name, value in self.fields:
+            ret[name] = value
+        ret['signature_address'] = self.signature_address
+        ret['signature'] = self.signature
+        return ret
+
+
+# what may stand between a SIGNATURE and an END marker: address and
+# signature characters, and newlines
+_SIG_RUN = re.compile(r'[\n\dA-z+=/]+')
+
+
+def strip(text, dash_space=False):
+    '''The signed message of armored text, with the armor cut away.
+
+    Every BEGIN marker is dropped, and every signature block with the
+    newlines around it: a SIGNATURE marker starting a line, address and
+    signature characters, then an END marker. Then one leading newline and
+    every "\\n\\n" go. Nested envelopes keep their "- ----" markers unless
+    dash_space unescapes them first.
+
+    This cuts exactly what validate.strip_armor()'s chain of regexes did,
+    whatever the nesting, in one scan for signature blocks.'''
+    if dash_space:
+        text = text.replace('- ----', '-----')
+    text = text.replace(BEGIN, '')
+    out = []
+    pos = 0             # text[pos:] is still to be copied out
+    search = 0
+    while True:
+        at = text.find('\n' + SIGNATURE, search)
+        if at < 0:
+            break
+        search = at + 1
+        run = _SIG_RUN.match(text, at + 1 + len(SIGNATURE))
+        if run is None or not text.startswith(END, run.end()):
+            continue
+        start = at
+        while start > pos and text[start - 1] == '\n':
+            start -= 1
+        end = run.end() + len(END)
+        while end < len(text) and text[end] == '\n':
+            end += 1
+        out.append(text[pos:start])
+        # newlines taken here can't lead into the next block
+        pos = search = end
+    out.append(text[pos:])
+    text = ''.join(out)
+    if text.startswith('\n'):
+        text = text[1:]
+    return text.replace('\n\n', '')
+
+
+def parse(text):
+    '''Tokenize armored text into a Document in one pass over its lines.'''
+    doc = Document(text)
+    lines = doc.lines
+    stack = []
+    sig_lines = None        # address/signature lines read after a SIGNATURE marker
+    last = len(lines) - 1
+    skip = False
+    for n, line in enumerate(lines):
+        # header fields: "Name: value", or "Name:" with the value on the next line
+        if skip:
+            skip = False
+            field = None
+        elif line.endswith(':') and len(line) > 1 and n + 1 < last and lines[n + 1]:
+            field = (line[:-1], lines[n + 1])
+            skip = True
+        elif n < last:
+            field = split_field(line)
+        else:
+            field = None
+        if field:
+            doc.fields.append(field)
+
+        # a SIGNATURE marker ending its line, two signature lines, then END
+        if doc.signature is None and line.endswith(SIGNATURE) and n + 3 <= last \
+                and _SIG_LINE.match(lines[n + 1]) and _SIG_LINE.match(lines[n + 2]) \
+                and lines[n + 3].startswith(END):
+            doc.signature_address, doc.signature = lines[n + 1], lines[n + 2]
+
+        marker = _MARKERS.get(line)
+        if marker is None and not stack and doc.root is None and line.endswith(BEGIN):
+            marker = BEGIN
+        if sig_lines is not None and marker is None:
+            sig_lines.append(line)
+        elif marker == BEGIN:
+            env = Envelope(doc, stack[-1] if stack else None, n)
+            if stack:
+                stack[-1].children.append(env)
+            else:
+                doc.toplevel += 1
+            if not stack and doc.root is None:
+                doc.root = env
+                env.lead = line[:-len(BEGIN)]
+            stack.append(env)
+        elif marker == SIGNATURE and stack:
+            stack[-1].sig = n
+            sig_lines = []
+        elif marker == END and stack:
+            env = stack.pop()
+            env.end = n
+            if sig_lines is not None and len(sig_lines) == 2 \
+                    and all(_SIG_LINE.match(l) for l in sig_lines):
+                env.signature_address, env.signature = sig_lines
+            sig_lines = None
+        elif stack:
+            stack[-1].lines.append(line)
+            doc.body.append(line)
+        if field and stack:
+            stack[-1].fields.append(field)
+    return doc
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+'''
+Causeway Server, asyncio mode - the storage routes of cserver.py on ASGI
+
+Serves /get, /put, /delete, /query, /nonce, /bitcoin, /status and /price
+from one event loop. Database work goes through aiosqlite or asyncpg (adb.py),
+running the same steps as the Flask server (writes.py), Bitcoin Core through
+rpc.AsyncRPC and signature checks through the verifier process pool, so slow
+calls wait on the loop instead of pinning a thread per request. Account
+routes (/buy, /request, /address) stay on the Flask server.
+
+Usage:
+    python3 aserver.py
+    uvicorn aserver:app --port 2016
+'''
+import asyncio
+import json
+import logging
+import os
+import time
+from urllib.parse import parse_qs
+
+
+from settings import DATABASE_URI, PRICE, DATA_DIR, SERVER_PORT, TESTNET
+from settings import CORE_ENABLED, SERVER, RPCPORT, RPCUSER, RPCPASS, RPCTIMEOUT
+from settings import BLOCK_POLL_INTERVAL, BLOCK_CACHE_SIZE, VERIFY_CACHE_SIZE, VERIFY_WORKERS
+from settings import VERIFY_ENGINE, NONCE_TTL, NONCE_WINDOW, ASYNC_POOL_SIZE
+from settings import KV_CACHE_BYTES, KV_CACHE_TTL, GET_MAX_AGE, QUERY_MAX_AGE, JSON_ENCODER
+from settings import QUERY_PAGE_SIZE, QUERY_MAX_PAGE_SIZE
+from adb import AsyncDB, Statements
+from rpc import AsyncRPC
+from blockcache import BlockCache
+from bitcoinecdsa import verify_cache, set_engine
+from verifier import Verifier
+from nonces import NonceStore
+from kvcache import KvCache
+from models import Owner, Kv, Blob, Sale, kv_size
+from indexer import collection_version, answer
+from writes import arun, stored_sizes, charge, check_nonce, consume_nonce, issue_nonce
+from writes import owned, store_kv, delete_kv
+import blobs
+import compress
+import etags
+import fastjson
+import bitcoin
+
+if (TESTNET): bitcoin.SelectParams('testnet')
+
+logger = logging.getLogger('cw-aserver')
+
+db = AsyncDB(DATABASE_URI, pool_size=ASYNC_POOL_SIZE)
+q = Statements()
+rpc = AsyncRPC(RPCUSER, RPCPASS, SERVER, RPCPORT, timeout=RPCTIMEOUT)
+
+set_engine(VERIFY_ENGINE)
+fastjson.set_encoder(JSON_ENCODER)
+verify_cache.size = VERIFY_CACHE_SIZE
+verifier = Verifier(VERIFY_WORKERS, TESTNET)
+nonces = NonceStore(ttl=NONCE_TTL, window=NONCE_WINDOW)
+# local tier only: the redis client would block the event loop
+kv_cache = KvCache(KV_CACHE_BYTES, ttl=KV_CACHE_TTL)
+# filled from AsyncRPC by poll_blocks(); its own thread is never started
+block_cache = BlockCache(None, depth=12, interval=BLOCK_POLL_INTERVAL, size=BLOCK_CACHE_SIZE)
+
+start_time = time.time()
+stored = 0
+core_enabled = False
+
+ROUTES = {}
+
+
+def route(path, methods=('GET',)):
+    def register(handler):
+        ROUTES[path] = (methods, handler)
+        return handler
+    return register
+
+
+class Args(object):
+    '''Query string arguments, read like Flask's request.args.'''
+
+    def __init__(self, query_string):
+        self.values = parse_qs(query_string.decode('latin-1'))
+
+    def get(self, name, default=None, type=None):
+        if name not in self.values:
+            return default
+        value = self.values[name][0]
+        if type is not None:
+            try:
+                return type(value)
+            except ValueError:
+                return default
+        return value
+
+    def getlist(self, name):
+        return self.values.get(name, [])
+
+
+class Request(object):
+    def __init__(self, scope, data):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'')
+        self.args = Args(self.query_string)
+        self.headers = dict((k.decode('latin-1').lower(), v.decode('latin-1'))
+                            for k, v in scope.get('headers', ()))
+        self.data = data
+
+
+def reply(obj, code=200, **kwargs):
+    body = fastjson.dumps(obj, **kwargs)
+    return (body, code, {'Content-type': 'application/json'})
+
+
+@route('/status')
+async def status(request):
+    '''Return general info about server instance. '''
+    uptime = str(int(time.time() - start_time))
+    st = os.statvfs(DATA_DIR)
+    free = st.f_bavail * st.f_frsize
+    return reply({'uptime': uptime,
+                  'stored': str(stored),
+                  'free': str(free),
+                  'price': str(PRICE),
+                  'verify_cache': verify_cache.stats(),
+                  'kv_cache': kv_cache.stats(),
+                  'db_pool': db.stats()
+                 }, indent=2)
+
+
+PRICE_REPLY = reply({'price': 0})
+
+
+@route('/price')
+async def price(request):
+    '''Return price for 1MB storage with bundled 50MB transfer.'''
+    return PRICE_REPLY
+
+
+@route('/get')
+async def get(request):
+    '''Get a key-value pair.'''
+    key = request.args.get('key')
+    record = kv_cache.get(key)
+    if record is not None and blobs.stale(record):
+        # its segment was compacted away
+        kv_cache.invalidate(key)
+        record = None
+    if record is None:
+        token = kv_cache.token()
+        async with db.connection() as conn:
+            kv = await conn.fetch_one(q.query(Kv.digest, *blobs.READ_COLUMNS)
+                                       .join(Blob, Blob.digest == Kv.digest)
+                                       .filter(Kv.key == key))
+        if kv is None:
+            return reply({'error': 'Key not found.'}, 404)
+        record = blobs.record(kv, kv.digest)
+        kv_cache.fill(key, record, token)
+    digest = record[1]
+    gzip = blobs.gzipped(record) and compress.accepts(request.headers.get('accept-encoding'), 'gzip')
+    headers = {'ETag': etags.quote(digest + '-gzip' if gzip else digest),
+               'Cache-Control': etags.cache_control(GET_MAX_AGE),
+               'Vary': 'Accept-Encoding'}
+    if etags.matches(request.headers.get('if-none-match'), headers['ETag']):
+        return ('', 304, headers)
+    headers['Content-type'] = 'application/json'
+    if gzip:
+        headers['Content-Encoding'] = 'gzip'
+    return (blobs.get_body(record, key, gzip), 200, headers)
+
+
+@route('/put', methods=('POST',))
+async def put(request):
+    '''Store a key-value pair.'''
+    try:
+        in_obj = json.loads(request.data.decode('utf-8'))
+        k = in_obj['key']
+        v = in_obj['value']
+        o = in_obj['owner']
+        n = in_obj['nonce']
+        s = in_obj['signature']
+        d = in_obj['signature_address']
+    except:
+        return ("JSON Decode failed", 400, {'Content-Type': 'text/plain'})
+    testnet = in_obj.get('testnet', False)
+
+    async with db.transaction() as conn:
+        owner = await conn.fetch_one(q.query(Owner.address, Owner.nonce, Owner.nonce_expires).filter(Owner.address == o))
+        if owner is None:
+            return reply({'error': 'User not found'}, 403)
+        if not await arun(conn, check_nonce(nonces, owner, n)):
+            return reply({'error': 'Bad nonce'}, 401)
+        if not await verifier.verify_async(d, k + v + d + n, s):
+            return reply({'error': 'Incorrect signature'}, 401)
+
+        # charge the size difference of an overwrite, or the bucket with the most free space
+        current = (await arun(conn, stored_sizes(o, [k]))).get(k)
+        sale_id = await arun(conn, charge(o, kv_size(k, v), current))
+        if sale_id is None:
+            await conn.rollback()
+            return reply({'error': 'Insufficient storage space.'}, 403)
+        # use the nonce up; a concurrent request may have beaten us to it
+        if not await arun(conn, consume_nonce(nonces, owner, n)):
+            await conn.rollback()
+            return reply({'error': 'Bad nonce'}, 401)
+        await arun(conn, store_kv(db.dialect.name, k, v, o, sale_id, testnet))
+    kv_cache.invalidate(k)
+    return reply({'result': 'success'}, 201)
+
+
+@route('/delete', methods=('POST',))
+async def delete(request):
+    '''Delete a key-value pair.'''
+    try:
+        in_obj = json.loads(request.data.decode('utf-8'))
+        k = in_obj['key']
+        d = in_obj['address']
+        n = in_obj['nonce']
+        s = in_obj['signature']
+    except:
+        return ("JSON Decode failed", 400, {'Content-Type': 'text/plain'})
+
+    async with db.transaction() as conn:
+        owner = await conn.fetch_one(q.query(Owner.address, Owner.nonce, Owner.nonce_expires).filter(Owner.delegate == d))
+        if owner is None or not await arun(conn, check_nonce(nonces, owner, n)) \
+                or not await verifier.verify_async(d, k + d + n, s):
+            return reply({'error': 'Incorrect signature.'}, 401)
+
+        # check if key already exists and is owned by the same owner
+        kv = await arun(conn, owned(k, owner.address))
+        if kv is None:
+            return reply({'error': 'Key not found or not owned by caller.'}, 404)
+        if not await arun(conn, consume_nonce(nonces, owner, n)):
+            await conn.rollback()
+            return reply({'error': 'Bad nonce'}, 401)
+
+        # free up storage quota and remove kv
+        await arun(conn, delete_kv(db.dialect.name, kv))
+    kv_cache.invalidate(k)
+    return reply({'result': 'success'})
+
+
+@route('/nonce')
+async def nonce(request):
+    '''Return 32-byte nonce for generating non-reusable signatures..'''
+    address = request.args.get('address')
+    clear = request.args.get('clear')
+    count = request.args.get('count', 1, type=int)
+
+    async with db.transaction() as conn:
+        out = await arun(conn, issue_nonce(nonces, address, count, clear))
+    if out is None:
+        return ("", 500, {'Content-Type': 'text/plain'})
+    return reply(out)
+
+
+@route('/query')
+async def query(request):
+    owner = request.args.get('owner')
+    string = request.args.get('query')
+    testnet = request.args.get('testnet') in ('True', '1')
+
+    # the answer goes under the query's name, which JSON needs as a string
+    if string is None:
+        return reply({'error': 'No query given.'}, 400)
+
+    async with db.connection() as conn:
+        #check if owner has an active sale record or request
+        sales = await conn.fetch_one(q.query(Sale.id).filter(Sale.owner == owner))
+        if sales is None:
+            return reply({"result": "error",
+                          "message": "Account required to make queries"})
+
+        # nothing the query can return has changed since the client's copy
+        block_info = block_cache.at_depth if core_enabled else None
+        version = await conn.fetch_one(collection_version(q, None if string == 'dispute' else testnet,
+                                                          string))
+        etag = etags.query_etag(request.query_string, version[0], block_info)
+        headers = {'ETag': etag, 'Cache-Control': etags.cache_control(QUERY_MAX_AGE)}
+        if etags.matches(request.headers.get('if-none-match'), etag):
+            return ('', 304, headers)
+
+        # keyset paging: rows inserted after the cursor, oldest first
+        limit = max(1, min(request.args.get('limit', QUERY_PAGE_SIZE, type=int), QUERY_MAX_PAGE_SIZE))
+        cursor = request.args.get('cursor', 0, type=int)
+        res, next_cursor = await arun(conn, answer(q, string, testnet, request.args, cursor, limit))
+
+    body, code, _ = reply({"result": "success",
+                           string: res,
+                           "next_cursor": next_cursor,
+                           "block_info": block_info})
+    return (body, code, dict(headers, **{'Content-type': 'application/json'}))
+
+
+async def rpc_result(command, params=None):
+    res = await rpc.get(command, params)
+    if 'output' in res and res['output'].get('result') is not None:
+        return res['output']['result']
+    return None
+
+
+async def block_by_hash(block_hash):
+    out = block_cache.cached(block_hash)
+    if out is None:
+        header = await rpc_result('getblockheader', [str(block_hash)])
+        if header is not None:
+            out = block_cache.store(block_hash, header)
+    return out
+
+
+async def block_by_height(height):
+    block_hash = block_cache.cached_height(height)
+    if block_hash is None:
+        block_hash = await rpc_result('getblockhash', [int(height)])
+        if block_hash is None:
+            return None
+    return await block_by_hash(block_hash)
+
+
+async def refresh_blocks():
+    tip = await rpc_result('getblockcount')
+    if tip is not None and block_cache.advance(tip):
+        block_cache.at_depth = await block_by_height(tip - block_cache.depth)
+
+
+async def poll_blocks():
+    '''The asyncio counterpart of BlockCache.run().'''
+    while True:
+        try:
+            await refresh_blocks()
+        except Exception:
+            logger.exception('block refresh failed')
+        await asyncio.sleep(block_cache.interval)
+
+
+@route('/bitcoin', methods=('GET', 'POST'))
+async def query_bitcoin(request):
+    if not core_enabled:
+        return reply({"result": "error",
+                      "message": "Bitcoin Core not enabled for this server"})
+
+    owner = request.args.get('owner')
+    string = request.args.get('query')
+    async with db.connection() as conn:
+        sales = await conn.fetch_one(q.query(Sale.id).filter(Sale.owner == owner))
+    out = None
+    try:
+        if sales is None:
+            return reply({"result": "error",
+                          "message": "Account required to make queries"})
+        elif string == 'getbydepth':
+            if block_cache.tip is None:
+                await refresh_blocks()
+            if block_cache.tip is not None:
+                out = await block_by_height(block_cache.tip - int(request.args.get('depth')))
+        elif string == 'getbyheight':
+            out = await block_by_height(int(request.args.get('height')))
+        elif string == 'getbyhash':
+            out = await block_by_hash(request.args.get('hash'))
+        elif string == 'sendrawtransaction':
+            res = await rpc.get('sendrawtransaction', [str(request.args.get('tx'))])
+            if 'output' in res and 'result' in res['output']:
+                return reply({'txid': res['output']['result']})
+    except (TypeError, ValueError):
+        out = None
+
+    if out:
+        return reply(out)
+    return reply({"result": "error",
+                  "message": "Invalid depth or RPC error"})
+
+
+async def startup():
+    global core_enabled
+    try:
+        await rpc.get('getblockcount')
+        core_enabled = CORE_ENABLED
+    except Exception:
+        core_enabled = False
+    print("Core enabled: " + str(core_enabled))
+    if core_enabled:
+        asyncio.ensure_future(poll_blocks())
+
+
+async def shutdown():
+    await db.close()
+    await rpc.close()
+    verifier.shutdown()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    '''ASGI 3 entry point.'''
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    data = b''
+    while True:
+        message = await receive()
+        data += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+
+    methods, handler = ROUTES.get(scope['path'], ((), None))
+    if handler is None:
+        body, code, headers = reply({'error': 'Not found.'}, 404)
+    elif scope['method'] not in methods:
+        body, code, headers = reply({'error': 'Method not allowed.'}, 405)
+    else:
+        try:
+            body, code, headers = await handler(Request(scope, data))
+        except Exception:
+            logger.exception('%s %s failed', scope['method'], scope['path'])
+            body, code, headers = reply({'error': 'Internal server error.'}, 500)
+
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    if code != 304:
+        headers = dict(headers, **{'Content-length': len(body)})
+    await send({'type': 'http.response.start',
+                'status': code,
+                'headers': [(k.lower().encode('latin-1'), str(v).encode('latin-1'))
+                            for k, v in headers.items()]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('SERVER_PORT', SERVER_PORT)))
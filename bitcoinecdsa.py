@@ -12,6 +12,12 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import hashlib
+import threading
+from collections import OrderedDict
+
+import bitcoin
+import bitcoinsig
 from bitcoin.wallet import CBitcoinSecret
 from bitcoin.signmessage import BitcoinMessage, VerifyMessage, SignMessage
 
@@ -20,6 +26,71 @@ def sign(key, message):
     message = BitcoinMessage(message)
     return SignMessage(key, message).decode('ascii')
 
+class VerifyCache(object):
+    '''Bounded LRU of verification results keyed by a digest of (address, message, signature).'''
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(address, message, signature):
+        h = hashlib.sha256()
+        for part in (address, message, signature):
+            part = part.encode('utf-8') if isinstance(part, str) else part
+            h.update(str(len(part)).encode('ascii') + b':' + part)
+        return h.digest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                self.hits += 1
+                return self.results[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, valid):
+        with self.lock:
+            self.results[key] = valid
+            self.results.move_to_end(key)
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.results)}
+
+# shared by every caller in the process; cserver sizes it from settings
+verify_cache = VerifyCache()
+
+# 'bitcoinlib' recovers keys with python-bitcoinlib; 'native' with bitcoinsig,
+# which hands recovery to libsecp256k1 when coincurve is installed (faster
+# than bitcoinlib) and otherwise does it in pure Python (slower); 'auto' is
+# 'native' with coincurve, else 'bitcoinlib'
+ENGINES = ('auto', 'bitcoinlib', 'native')
+engine = 'bitcoinlib'
+
+def set_engine(name):
+    global engine
+    if name not in ENGINES:
+        raise ValueError("Unknown verify engine %r" % name)
+    if name == 'auto':
+        name = 'native' if bitcoinsig.coincurve is not None else 'bitcoinlib'
+    engine = name
+
+def verify_uncached(address, message, signature):
+    if engine == 'native':
+        version = bitcoin.params.BASE58_PREFIXES['PUBKEY_ADDR']
+        return bitcoinsig.verify_message(address, signature, message, version)
+    return bool(VerifyMessage(address, BitcoinMessage(message), signature))
+
 def verify(address, message, signature):
-    message = BitcoinMessage(message)
-    return VerifyMessage(address, message, signature)
+    key = VerifyCache.key(address, message, signature)
+    valid = verify_cache.get(key)
+    if valid is None:
+        valid = verify_uncached(address, message, signature)
+        verify_cache.put(key, valid)
+    return valid
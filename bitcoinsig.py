@@ -1,131 +1,215 @@
-# the code below is 'borrowed' almost verbatim from electrum,
-# https://gitorious.org/electrum/electrum
+# The message format and address handling below started out as code
+# 'borrowed' from electrum, https://gitorious.org/electrum/electrum
 # and is under the GPLv3.
+#
+# Python 3 rewrite of the signed-message backend. Point arithmetic is done in
+# Jacobian coordinates on plain integers, generator multiples come from a
+# precomputed table, and public-key recovery evaluates u1*G + u2*R with
+# Shamir's trick.
+#
+# This is the 'native' engine behind bitcoinecdsa.verify. When coincurve is
+# installed, recovery itself is done by libsecp256k1 through it, which is
+# several times faster than python-bitcoinlib's OpenSSL path; the pure-Python
+# point arithmetic is then only the fallback, and is slower than bitcoinlib.
+# See 'python3 bitcoinsig.py bench'.
 
-import ecdsa
 import base64
 import hashlib
-from ecdsa.util import string_to_number
+import hmac
+import struct
+import sys
+import time
+
+try:
+    import coincurve
+except ImportError:
+    coincurve = None
 
 # secp256k1, http://www.oid-info.com/get/1.3.132.0.10
-_p = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2FL
-_r = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141L
-_b = 0x0000000000000000000000000000000000000000000000000000000000000007L
-_a = 0x0000000000000000000000000000000000000000000000000000000000000000L
-_Gx = 0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798L
-_Gy = 0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8L
-curve_secp256k1 = ecdsa.ellipticcurve.CurveFp( _p, _a, _b )
-generator_secp256k1 = ecdsa.ellipticcurve.Point( curve_secp256k1, _Gx, _Gy, _r )
-oid_secp256k1 = (1,3,132,0,10)
-SECP256k1 = ecdsa.curves.Curve("SECP256k1", curve_secp256k1, generator_secp256k1, oid_secp256k1 ) 
+_p = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+_r = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+_b = 0x0000000000000000000000000000000000000000000000000000000000000007
+_a = 0x0000000000000000000000000000000000000000000000000000000000000000
+_Gx = 0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798
+_Gy = 0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8
 
 addrtype = 0
 
-# from http://eli.thegreenplace.net/2009/03/07/computing-modular-square-roots-in-python/
-
-def modular_sqrt(a, p):
-    """ Find a quadratic residue (mod p) of 'a'. p
-    must be an odd prime.
-    
-    Solve the congruence of the form:
-    x^2 = a (mod p)
-    And returns x. Note that p - x is also a root.
-    
-    0 is returned is no square root exists for
-    these a and p.
-    
-    The Tonelli-Shanks algorithm is used (except
-    for some simple cases in which the solution
-    is known from an identity). This algorithm
-    runs in polynomial time (unless the
-    generalized Riemann hypothesis is false).
-    """
-    # Simple cases
-    #
-    if legendre_symbol(a, p) != 1:
-        return 0
-    elif a == 0:
-        return 0
-    elif p == 2:
-        return p
-    elif p % 4 == 3:
-        return pow(a, (p + 1) / 4, p)
-    
-    # Partition p-1 to s * 2^e for an odd s (i.e.
-    # reduce all the powers of 2 from p-1)
-    #
-    s = p - 1
-    e = 0
-    while s % 2 == 0:
-        s /= 2
-        e += 1
-        
-    # Find some 'n' with a legendre symbol n|p = -1.
-    # Shouldn't take long.
-    #
-    n = 2
-    while legendre_symbol(n, p) != -1:
-        n += 1
-        
-    # Here be dragons!
-    # Read the paper "Square roots from 1; 24, 51,
-    # 10 to Dan Shanks" by Ezra Brown for more
-    # information
-    #
-    
-    # x is a guess of the square root that gets better
-    # with each iteration.
-    # b is the "fudge factor" - by how much we're off
-    # with the guess. The invariant x^2 = ab (mod p)
-    # is maintained throughout the loop.
-    # g is used for successive powers of n to update
-    # both a and b
-    # r is the exponent - decreases with each update
-    #
-    x = pow(a, (s + 1) / 2, p)
-    b = pow(a, s, p)
-    g = pow(n, s, p)
-    r = e
-    
-    while True:
-        t = b
-        m = 0
-        for m in xrange(r):
-            if t == 1:
-                break
-            t = pow(t, 2, p)
-            
-        if m == 0:
-            return x
-        
-        gs = pow(g, 2 ** (r - m - 1), p)
-        g = (gs * gs) % p
-        x = (x * gs) % p
-        b = (b * g) % p
-        r = m
-        
-def legendre_symbol(a, p):
-    """ Compute the Legendre symbol a|p using
-    Euler's criterion. p is a prime, a is
-    relatively prime to p (if p divides
-    a, then a|p = 0)
-    
-    Returns 1 if a has a square root modulo
-    p, -1 otherwise.
-    """
-    ls = pow(a, (p - 1) / 2, p)
-    return -1 if ls == p - 1 else ls
+# Jacobian point (X, Y, Z) stands for the affine point (X/Z^2, Y/Z^3);
+# Z == 0 is the point at infinity.
+INFINITY = (0, 1, 0)
+
+
+def _double(P):
+    X, Y, Z = P
+    if Z == 0 or Y == 0:
+        return INFINITY
+    # dbl-2009-l, a = 0
+    A = X * X % _p
+    B = Y * Y % _p
+    C = B * B % _p
+    D = 2 * ((X + B) * (X + B) - A - C) % _p
+    E = 3 * A % _p
+    X3 = (E * E - 2 * D) % _p
+    Y3 = (E * (D - X3) - 8 * C) % _p
+    Z3 = 2 * Y * Z % _p
+    return (X3, Y3, Z3)
+
+
+def _add(P, Q):
+    X1, Y1, Z1 = P
+    X2, Y2, Z2 = Q
+    if Z1 == 0:
+        return Q
+    if Z2 == 0:
+        return P
+    # add-2007-bl
+    Z1Z1 = Z1 * Z1 % _p
+    Z2Z2 = Z2 * Z2 % _p
+    U1 = X1 * Z2Z2 % _p
+    U2 = X2 * Z1Z1 % _p
+    S1 = Y1 * Z2 * Z2Z2 % _p
+    S2 = Y2 * Z1 * Z1Z1 % _p
+    if U1 == U2:
+        if S1 == S2:
+            return _double(P)
+        return INFINITY
+    H = U2 - U1
+    I = 4 * H * H % _p
+    J = H * I % _p
+    rr = 2 * (S2 - S1) % _p
+    V = U1 * I % _p
+    X3 = (rr * rr - J - 2 * V) % _p
+    Y3 = (rr * (V - X3) - 2 * S1 * J) % _p
+    Z3 = ((Z1 + Z2) * (Z1 + Z2) - Z1Z1 - Z2Z2) * H % _p
+    return (X3, Y3, Z3)
+
+
+def _add_affine(P, x2, y2):
+    '''P + (x2, y2) where the second point is affine (Z = 1).'''
+    X1, Y1, Z1 = P
+    if Z1 == 0:
+        return (x2, y2, 1)
+    # madd-2007-bl
+    Z1Z1 = Z1 * Z1 % _p
+    U2 = x2 * Z1Z1 % _p
+    S2 = y2 * Z1 * Z1Z1 % _p
+    if U2 == X1:
+        if S2 == Y1:
+            return _double(P)
+        return INFINITY
+    H = (U2 - X1) % _p
+    HH = H * H % _p
+    I = 4 * HH % _p
+    J = H * I % _p
+    rr = 2 * (S2 - Y1) % _p
+    V = X1 * I % _p
+    X3 = (rr * rr - J - 2 * V) % _p
+    Y3 = (rr * (V - X3) - 2 * Y1 * J) % _p
+    Z3 = ((Z1 + H) * (Z1 + H) - Z1Z1 - HH) % _p
+    return (X3, Y3, Z3)
+
+
+def _to_affine(P):
+    X, Y, Z = P
+    if Z == 0:
+        return None
+    zinv = pow(Z, _p - 2, _p)
+    zinv2 = zinv * zinv % _p
+    return (X * zinv2 % _p, Y * zinv2 * zinv % _p)
+
+
+def _batch_affine(points):
+    '''Convert Jacobian points to affine with a single field inversion.'''
+    acc = 1
+    prefix = []
+    for X, Y, Z in points:
+        prefix.append(acc)
+        acc = acc * Z % _p
+    inv = pow(acc, _p - 2, _p)
+    out = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        zinv = inv * prefix[i] % _p
+        inv = inv * Z % _p
+        zinv2 = zinv * zinv % _p
+        out[i] = (X * zinv2 % _p, Y * zinv2 * zinv % _p)
+    return out
+
+
+# Generator table: _G_TABLE[i][j] is j * 256**i * G in affine coordinates, so
+# k*G is one mixed addition per byte of k and no doublings.
+_G_TABLE = None
+
+
+def _g_table():
+    global _G_TABLE
+    if _G_TABLE is None:
+        rows = []
+        base = (_Gx, _Gy, 1)
+        for i in range(32):
+            row = [base]
+            for j in range(2, 256):
+                row.append(_add(row[-1], base))
+            rows.append([None] + _batch_affine(row))
+            for _ in range(8):
+                base = _double(base)
+        _G_TABLE = rows
+    return _G_TABLE
+
+
+def _mul_g(k):
+    table = _g_table()
+    k %= _r
+    P = INFINITY
+    for i in range(32):
+        j = k & 0xff
+        if j:
+            P = _add_affine(P, *table[i][j])
+        k >>= 8
+    return P
+
+
+def _shamir(u1, u2, R):
+    '''u1*G + u2*R, sharing one doubling chain between both scalars.
+
+    Uses 2-bit joint windows: a table of a*G + b*R for a, b in 0..3 (the
+    G multiples come from the generator table), then two doublings and at
+    most one addition per window.'''
+    g = _g_table()[0]
+    R2 = _double(R)
+    Rs = [INFINITY, R, R2, _add(R2, R)]
+    table = [[None] * 4 for _ in range(4)]
+    for a in range(4):
+        for b in range(4):
+            if a == 0:
+                table[a][b] = Rs[b]
+            else:
+                table[a][b] = _add_affine(Rs[b], *g[a])
+    P = INFINITY
+    for shift in range(254, -1, -2):
+        P = _double(_double(P))
+        a = (u1 >> shift) & 3
+        b = (u2 >> shift) & 3
+        if a or b:
+            P = _add(P, table[a][b])
+    return P
+
+
+def _sqrt(a):
+    '''Square root mod p; p = 3 (mod 4) so it is a single exponentiation.'''
+    y = pow(a, (_p + 1) // 4, _p)
+    return y if y * y % _p == a % _p else None
+
 
 __b58chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 __b58base = len(__b58chars)
 
+
 def b58encode(v):
-    """ encode v, which is a string of bytes, to base58.		
+    """ encode v, which is a string of bytes, to base58.
     """
-
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * ord(c)
+    long_value = int.from_bytes(v, 'big')
 
     result = ''
     while long_value >= __b58base:
@@ -136,168 +220,309 @@ def b58encode(v):
 
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
-    nPad = 0
-    for c in v:
-        if c == '\0': nPad += 1
-        else: break
+    nPad = len(v) - len(v.lstrip(b'\0'))
 
     return (__b58chars[0]*nPad) + result
 
-def decbin(d, l=0, rev=False):
-	if l==0:
-		a="%x"%d
-		if len(a)%2: a='0'+a
-	else:
-		a=("%0"+str(2*l)+"x")%d
-	a=a.decode('hex')
-	if rev:
-		a=a[::-1]
-	return a
 
 def decvi(d):
-	if d<0xfd:
-		return decbin(d)
-	elif d<0xffff:
-		return '\xfd'+decbin(d,2,True)
-	elif d<0xffffffff:
-		return '\xfe'+decbin(d,4,True)
-	return '\xff'+decbin(d,8,True)
+    if d < 0xfd:
+        return struct.pack('<B', d)
+    elif d <= 0xffff:
+        return b'\xfd' + struct.pack('<H', d)
+    elif d <= 0xffffffff:
+        return b'\xfe' + struct.pack('<I', d)
+    return b'\xff' + struct.pack('<Q', d)
+
 
 def msg_magic(msg):
-    return "\x18Bitcoin Signed Message:\n"+decvi(len(msg))+msg
+    if isinstance(msg, str):
+        msg = msg.encode('utf-8')
+    return b"\x18Bitcoin Signed Message:\n" + decvi(len(msg)) + msg
+
 
 def Hash(data):
     return hashlib.sha256(hashlib.sha256(data).digest()).digest()
 
+
+def _ripemd160(data):
+    try:
+        return hashlib.new('ripemd160', data).digest()
+    except ValueError:
+        # OpenSSL 3 builds may not ship ripemd160
+        return _ripemd160_py(data)
+
+
 def hash_160(public_key):
-    md = hashlib.new('ripemd160')
-    md.update(hashlib.sha256(public_key).digest())
-    return md.digest()
+    return _ripemd160(hashlib.sha256(public_key).digest())
 
-def hash_160_to_bc_address(h160):
-    vh160 = chr(addrtype) + h160
+
+def hash_160_to_bc_address(h160, version=None):
+    vh160 = bytes([addrtype if version is None else version]) + h160
     h = Hash(vh160)
     addr = vh160 + h[0:4]
     return b58encode(addr)
 
-def public_key_to_bc_address(public_key):
+
+def public_key_to_bc_address(public_key, version=None):
     h160 = hash_160(public_key)
-    return hash_160_to_bc_address(h160)
+    return hash_160_to_bc_address(h160, version)
 
-def encode_point(pubkey, compressed=False):
-    order = generator_secp256k1.order()
-    p = pubkey.pubkey.point
-    x_str = ecdsa.util.number_to_string(p.x(), order)
-    y_str = ecdsa.util.number_to_string(p.y(), order)
+
+def encode_point(point, compressed=False):
+    '''Serialize an affine (x, y) public key point.'''
+    x, y = point
     if compressed:
-        return chr(2 + (p.y() & 1)) + x_str
+        return bytes([2 + (y & 1)]) + x.to_bytes(32, 'big')
     else:
-        return chr(4) + x_str + y_str
+        return b'\x04' + x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+
+
+def private_key_to_point(secret):
+    if isinstance(secret, bytes):
+        secret = int.from_bytes(secret, 'big')
+    return _to_affine(_mul_g(secret))
+
+
+def _rfc6979_k(secret, h):
+    '''Deterministic nonce generator (RFC 6979, HMAC-SHA256).'''
+    x = secret.to_bytes(32, 'big')
+    h = (int.from_bytes(h, 'big') % _r).to_bytes(32, 'big')
+    V = b'\x01' * 32
+    K = b'\x00' * 32
+    K = hmac.new(K, V + b'\x00' + x + h, hashlib.sha256).digest()
+    V = hmac.new(K, V, hashlib.sha256).digest()
+    K = hmac.new(K, V + b'\x01' + x + h, hashlib.sha256).digest()
+    V = hmac.new(K, V, hashlib.sha256).digest()
+    while True:
+        V = hmac.new(K, V, hashlib.sha256).digest()
+        k = int.from_bytes(V, 'big')
+        if 1 <= k < _r:
+            yield k
+        K = hmac.new(K, V + b'\x00', hashlib.sha256).digest()
+        V = hmac.new(K, V, hashlib.sha256).digest()
+
 
 def sign_message(private_key, message, compressed=False):
-    public_key = private_key.get_verifying_key()
-    signature = private_key.sign_digest( Hash( msg_magic( message ) ), sigencode = ecdsa.util.sigencode_string )
-    address = public_key_to_bc_address(encode_point(public_key, compressed))
-    assert public_key.verify_digest( signature, Hash( msg_magic( message ) ), sigdecode = ecdsa.util.sigdecode_string)
-    for i in range(4):
-        nV = 27 + i
-        if compressed:
-            nV += 4
-        sig = base64.b64encode( chr(nV) + signature )
-        try:
-            if verify_message( address, sig, message):
-                return sig
-        except:
+    '''Sign message with a 32-byte (or integer) secret, returning base64.'''
+    if isinstance(private_key, bytes):
+        private_key = int.from_bytes(private_key, 'big')
+    h = Hash(msg_magic(message))
+    e = int.from_bytes(h, 'big')
+    for k in _rfc6979_k(private_key, h):
+        x, y = _to_affine(_mul_g(k))
+        r = x % _r
+        if r == 0:
             continue
-    else:
-        raise BaseException("error: cannot sign message")
+        s = pow(k, _r - 2, _r) * (e + r * private_key) % _r
+        if s == 0:
+            continue
+        recid = (y & 1) | (2 if x >= _r else 0)
+        # low-s form, which flips the parity of R
+        if s > _r // 2:
+            s = _r - s
+            recid ^= 1
+        nV = 27 + recid + (4 if compressed else 0)
+        return base64.b64encode(bytes([nV]) + r.to_bytes(32, 'big') + s.to_bytes(32, 'big')).decode('ascii')
+
 
-def verify_message(address, signature, message):
+def recover_public_key(signature, message):
+    '''Return (point, compressed) for a base64 signature, or None.'''
     """ See http://www.secg.org/download/aid-780/sec1-v2.pdf for the math """
-    from ecdsa import numbertheory, ellipticcurve, util
-    curve = curve_secp256k1
-    G = generator_secp256k1
-    order = G.order()
-    # extract r,s from signature
     sig = base64.b64decode(signature)
-    if len(sig) != 65: raise BaseException("Wrong encoding")
-    r,s = util.sigdecode_string(sig[1:], order)
-    nV = ord(sig[0])
+    if len(sig) != 65:
+        raise ValueError("Wrong encoding")
+    nV = sig[0]
     if nV < 27 or nV >= 35:
-        return False
+        return None
     if nV >= 31:
         compressed = True
         nV -= 4
     else:
         compressed = False
     recid = nV - 27
+    r = int.from_bytes(sig[1:33], 'big')
+    s = int.from_bytes(sig[33:], 'big')
+    if not (0 < r < _r and 0 < s < _r):
+        return None
+    if coincurve is not None:
+        try:
+            key = coincurve.PublicKey.from_signature_and_message(
+                sig[1:] + bytes([recid]), Hash(msg_magic(message)), hasher=None)
+        except ValueError:
+            return None
+        return key.point(), compressed
     # 1.1
-    x = r + (recid/2) * order
+    x = r + (recid // 2) * _r
+    if x >= _p:
+        return None
     # 1.3
-    alpha = ( x * x * x  + curve.a() * x + curve.b() ) % curve.p()
-    beta = modular_sqrt(alpha, curve.p())
-    y = beta if (beta - recid) % 2 == 0 else curve.p() - beta
-    # 1.4 the constructor checks that nR is at infinity
-    R = ellipticcurve.Point(curve, x, y, order)
+    y = _sqrt(x * x * x + _b)
+    if y is None:
+        return None
+    if (y - recid) % 2:
+        y = _p - y
     # 1.5 compute e from message:
-    h = Hash( msg_magic( message ) )
-    e = string_to_number(h)
-    minus_e = -e % order
-    # 1.6 compute Q = r^-1 (sR - eG)
-    inv_r = numbertheory.inverse_mod(r,order)
-    Q = inv_r * ( s * R + minus_e * G )
-    public_key = ecdsa.VerifyingKey.from_public_point( Q, curve = SECP256k1 )
-    # check that Q is the public key
-    public_key.verify_digest( sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
-    # check that we get the original signing address
-    addr = public_key_to_bc_address(encode_point(public_key, compressed))
-    if address == addr:
-        return True
-    else:
-        #print addr
+    e = int.from_bytes(Hash(msg_magic(message)), 'big')
+    # 1.6 compute Q = r^-1 (sR - eG) = (-e/r) G + (s/r) R
+    inv_r = pow(r, _r - 2, _r)
+    Q = _to_affine(_shamir(-e * inv_r % _r, s * inv_r % _r, (x, y, 1)))
+    if Q is None:
+        return None
+    return Q, compressed
+
+
+def verify_message(address, signature, message, version=None):
+    try:
+        recovered = recover_public_key(signature, message)
+    except (ValueError, TypeError):
+        return False
+    if recovered is None:
         return False
-        
+    point, compressed = recovered
+    # check that we get the original signing address
+    return address == public_key_to_bc_address(encode_point(point, compressed), version)
+
+
+# Pure-Python RIPEMD-160, only used when hashlib lacks it.
+_RL = [
+    0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15,
+    7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14, 11, 8,
+    3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12,
+    1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15, 14, 5, 6, 2,
+    4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13]
+_RR = [
+    5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12,
+    6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9, 1, 2,
+    15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13,
+    8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9, 7, 10, 14,
+    12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11]
+_SL = [
+    11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8,
+    7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7, 13, 12,
+    11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5,
+    11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5, 6, 8, 6, 5, 12,
+    9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6]
+_SR = [
+    8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6,
+    9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15, 13, 11,
+    9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5,
+    15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8,
+    8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11]
+_KL = [0x00000000, 0x5A827999, 0x6ED9EBA1, 0x8F1BBCDC, 0xA953FD4E]
+_KR = [0x50A28BE6, 0x5C4DD124, 0x6D703EF3, 0x7A6D76E9, 0x00000000]
+
+
+def _rf(j, x, y, z):
+    if j == 0:
+        return x ^ y ^ z
+    if j == 1:
+        return (x & y) | (~x & z)
+    if j == 2:
+        return (x | ~y) ^ z
+    if j == 3:
+        return (x & z) | (y & ~z)
+    return x ^ (y | ~z)
+
+
+def _rol(x, n):
+    return ((x << n) | (x >> (32 - n))) & 0xffffffff
+
+
+def _ripemd160_py(data):
+    h = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476, 0xC3D2E1F0]
+    msg = data + b'\x80' + b'\x00' * ((55 - len(data)) % 64) + struct.pack('<Q', 8 * len(data))
+    for off in range(0, len(msg), 64):
+        X = struct.unpack('<16I', msg[off:off + 64])
+        al, bl, cl, dl, el = h
+        ar, br, cr, dr, er = h
+        for i in range(80):
+            j = i // 16
+            t = _rol((al + _rf(j, bl, cl, dl) + X[_RL[i]] + _KL[j]) & 0xffffffff, _SL[i]) + el
+            al, el, dl, cl, bl = el, dl, _rol(cl, 10), bl, t & 0xffffffff
+            t = _rol((ar + _rf(4 - j, br, cr, dr) + X[_RR[i]] + _KR[j]) & 0xffffffff, _SR[i]) + er
+            ar, er, dr, cr, br = er, dr, _rol(cr, 10), br, t & 0xffffffff
+        t = (h[1] + cl + dr) & 0xffffffff
+        h[1] = (h[2] + dl + er) & 0xffffffff
+        h[2] = (h[3] + el + ar) & 0xffffffff
+        h[3] = (h[4] + al + br) & 0xffffffff
+        h[4] = (h[0] + bl + cr) & 0xffffffff
+        h[0] = t
+    return struct.pack('<5I', *h)
+
+
+def benchmark(rounds=200):
+    '''Time verify_message, with and without coincurve, against
+    python-bitcoinlib's VerifyMessage.'''
+    global coincurve
+    address = '1Hpj6xv9AzaaXjPPisQrdAD2tu84cnPv3f'
+    signature = 'INEJxQnSu6mwGnLs0E8eirl5g+0cAC9D5M7hALHD9sK0XQ66CH9mas06gNoIX7K1NKTLaj3MzVe8z3pt6apGJ34='
+    _g_table()
+    installed = coincurve
+    for name, backend in (('libsecp256k1', installed), ('pure Python', None)):
+        if name == 'libsecp256k1' and installed is None:
+            print("native (%s):  coincurve not installed" % name)
+            continue
+        coincurve = backend
+        start = time.time()
+        for _ in range(rounds):
+            assert verify_message(address, signature, 'testtest')
+        native = (time.time() - start) / rounds
+        print("native (%s):  %.3f ms/verify" % (name, native * 1000))
+    coincurve = installed
+    try:
+        from bitcoin.signmessage import BitcoinMessage, VerifyMessage
+    except ImportError:
+        print("bitcoinlib:  not installed")
+        return
+    start = time.time()
+    for _ in range(rounds):
+        assert VerifyMessage(address, BitcoinMessage('testtest'), signature)
+    lib = (time.time() - start) / rounds
+    print("bitcoinlib:  %.3f ms/verify" % (lib * 1000))
+
+
 if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        benchmark()
+        sys.exit(0)
+
     # some simple testing code
-    print verify_message('16vqGo3KRKE9kTsTZxKoJKLzwZGTodK3ce',
+    print(verify_message('16vqGo3KRKE9kTsTZxKoJKLzwZGTodK3ce',
             'HPDs1TesA48a9up4QORIuub67VHBM37X66skAYz0Esg23gdfMuCTYDFORc6XGpKZ2/flJ2h/DUF569FJxGoVZ50=',
-            'test message') # good
-    print verify_message('16vqGo3KRKE9kTsTZxKoJKLzwZGTodK3ce',
+            'test message')) # good
+    print(verify_message('16vqGo3KRKE9kTsTZxKoJKLzwZGTodK3ce',
             'HPDs1TesA48a9up4QORIuub67VHBM37X66skAYz0Esg23gdfMuCTYDFORc6XGpKZ2/flJ2h/DUF569FJxGoVZ50=',
-            'test message 2') # bad
-
-    private_key = ecdsa.SigningKey.from_string( '5JkuZ6GLsMWBKcDWa5QiD15Uj467phPR', curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    bitcoinaddress = public_key_to_bc_address( encode_point(public_key) )
-    print bitcoinaddress
-    sig = sign_message(private_key, 'test message')
-    print sig
-    print verify_message(bitcoinaddress, sig, 'test message')
-    print verify_message('1GdKjTSg2eMyeVvPV5Nivo6kR8yP2GT7wF',
+            'test message 2')) # bad
+
+    secret = b'5JkuZ6GLsMWBKcDWa5QiD15Uj467phPR'
+    bitcoinaddress = public_key_to_bc_address(encode_point(private_key_to_point(secret)))
+    print(bitcoinaddress)
+    sig = sign_message(secret, 'test message')
+    print(sig)
+    print(verify_message(bitcoinaddress, sig, 'test message'))
+    print(verify_message('1GdKjTSg2eMyeVvPV5Nivo6kR8yP2GT7wF',
             'GyMn9AdYeZIPWLVCiAblOOG18Qqy4fFaqjg5rjH6QT5tNiUXLS6T2o7iuWkV1gc4DbEWvyi8yJ8FvSkmEs3voWE=',
-            'freenode:#bitcoin-otc:b42f7e7ea336db4109df6badc05c6b3ea8bfaa13575b51631c5178a7')
+            'freenode:#bitcoin-otc:b42f7e7ea336db4109df6badc05c6b3ea8bfaa13575b51631c5178a7'))
 
-    print verify_message('1Hpj6xv9AzaaXjPPisQrdAD2tu84cnPv3f',
+    print(verify_message('1Hpj6xv9AzaaXjPPisQrdAD2tu84cnPv3f',
             'INEJxQnSu6mwGnLs0E8eirl5g+0cAC9D5M7hALHD9sK0XQ66CH9mas06gNoIX7K1NKTLaj3MzVe8z3pt6apGJ34=',
-            'testtest')
-    print verify_message('18uitB5ARAhyxmkN2Sa9TbEuoGN1he83BX',
+            'testtest'))
+    print(verify_message('18uitB5ARAhyxmkN2Sa9TbEuoGN1he83BX',
             'IMAtT1SjRyP6bz6vm5tKDTTTNYS6D8w2RQQyKD3VGPq2i2txGd2ar18L8/nvF1+kAMo5tNc4x0xAOGP0HRjKLjc=',
-            'testtest')
+            'testtest'))
 
     # sign compressed key
     compressed = True
-    secret = 'dea7715ddcf5aba27530d6a1393813fbdd09af3aeb5f4f1616f563833d07babb'.decode('hex')
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    bitcoinaddress = public_key_to_bc_address( encode_point(public_key, compressed) )
-    print bitcoinaddress
+    secret = bytes.fromhex('dea7715ddcf5aba27530d6a1393813fbdd09af3aeb5f4f1616f563833d07babb')
+    bitcoinaddress = public_key_to_bc_address(encode_point(private_key_to_point(secret), compressed))
+    print(bitcoinaddress)
 
-    sig = sign_message(private_key, 'test message', compressed)
-    print sig
+    sig = sign_message(secret, 'test message', compressed)
+    print(sig)
 
-    print verify_message(bitcoinaddress, sig, 'test message')
+    print(verify_message(bitcoinaddress, sig, 'test message'))
 
-    print verify_message('1LsPb3D1o1Z7CzEt1kv5QVxErfqzXxaZXv',
+    print(verify_message('1LsPb3D1o1Z7CzEt1kv5QVxErfqzXxaZXv',
             'H3I37ur48/fn52ZvWQT+Mj2wXL36gyjfaN5qcgfiVRTJb1eP1li/IacCQspYnUntiRv8r6GDfJYsdiQ5VzlG3As=',
-            'testtest')
-
+            'testtest'))
@@ -0,0 +1,224 @@
+'''
+Content-addressed value storage.
+
+Each distinct value is stored once in the blob table, under its sha256
+(models.content_digest). Kv rows point at it through kv.digest, and the blob
+counts them in refs, so the same signed document uploaded under many keys
+takes its bytes once. A blob is deleted when its last key goes.
+
+Quota is still charged per key (kv.size), whatever is shared underneath.
+
+New blobs may be stored compressed (compress.py), and large ones in segment
+files under DATA_DIR instead of the database (segments.py). value_of(),
+fragment_of() and record() read every kind from a row selected with
+READ_COLUMNS.
+
+The statement builders are run by writes.acquire() and writes.release(),
+on a Session and on an async connection alike.
+'''
+import json
+import os
+
+from sqlalchemy import and_, case
+from sqlalchemy.dialects import postgresql
+
+from settings import DATA_DIR, SEGMENT_MIN_SIZE, SEGMENT_SIZE, SEGMENT_COMPACT_RATIO
+from settings import SEGMENT_COMPACT_GRACE
+from models import db, Kv, Blob
+from segments import SegmentStore
+import compress
+import fastjson
+
+# what value_of(), fragment_of() and record() need from a blob row
+READ_COLUMNS = (Blob.value, Blob.value_json, Blob.codec, Blob.data,
+                Blob.segment, Blob.seg_offset, Blob.seg_length)
+
+store = SegmentStore(os.path.join(DATA_DIR, 'segments'), SEGMENT_SIZE)
+
+
+def segmented(value):
+    '''True if a new blob for value goes to a segment file.'''
+    return SEGMENT_MIN_SIZE is not None and len(value.encode('utf-8')) >= SEGMENT_MIN_SIZE
+
+
+def add_ref(digest):
+    '''Take one more reference on an existing blob.'''
+    table = Blob.__table__
+    return table.update().where(table.c.digest == digest).values(refs=table.c.refs + 1)
+
+
+def insert(dialect, digest, value):
+    '''Store a new blob with one reference, or nothing if digest exists.
+
+    A segmented() value is appended to a segment file here, before the
+    statement runs; if it turns out not to be needed the bytes are garbage
+    for compact().'''
+    table = Blob.__table__
+    codec, data = compress.encode(value)
+    row = {'digest': digest, 'size': len(value.encode('utf-8')), 'refs': 1, 'codec': codec}
+    if segmented(value):
+        # plain values are kept as their /get fragment, ready to splice
+        payload = data if codec is not None else fastjson.fragment(value).encode('utf-8')
+        row['segment'], row['seg_offset'] = store.append(payload)
+        row['seg_length'] = len(payload)
+    elif codec is None:
+        row.update(value=value, value_json=fastjson.fragment(value))
+    else:
+        row['data'] = data
+    if dialect == 'postgresql':
+        return postgresql.insert(table).values(**row).on_conflict_do_nothing()
+    return table.insert().prefix_with('OR IGNORE').values(**row)
+
+
+def drop_ref(digest):
+    table = Blob.__table__
+    return table.update().where(table.c.digest == digest).values(refs=table.c.refs - 1)
+
+
+def sweep(digest):
+    '''Delete the blob if nothing points at it any more.'''
+    table = Blob.__table__
+    return table.delete().where(and_(table.c.digest == digest, table.c.refs <= 0))
+
+
+def stored(row):
+    '''The bytes a compressed or segmented blob row keeps.'''
+    if row.segment is None:
+        return row.data
+    return store.read(row.segment, row.seg_offset, row.seg_length)
+
+
+def value_of(row):
+    '''The value of a blob row.'''
+    if row.segment is None and row.codec is None:
+        return row.value
+    if row.codec is None:
+        return json.loads(str(stored(row), 'utf-8'))
+    return compress.decode(row.codec, stored(row))
+
+
+def fragment_of(row):
+    '''The value_json fragment of a blob row.'''
+    if row.segment is None and row.codec is None:
+        return row.value_json
+    if row.codec is None:
+        return str(stored(row), 'utf-8')
+    return compress.fragment(row.codec, stored(row))
+
+
+def record(row, digest):
+    '''The /get cache record for a blob row, read back with get_body():
+    (value_json, digest, gzip data, segment pointer).
+
+    A segmented blob is cached as its pointer, 'segment:offset:length:codec',
+    and read from the segment map on every hit. Otherwise the gzip data, as a
+    latin-1 string, is '' unless the blob is gzip compressed.'''
+    if row.segment is not None:
+        return ('', digest, '', '%d:%d:%d:%s' % (row.segment, row.seg_offset, row.seg_length,
+                                                 row.codec or ''))
+    gz = bytes(row.data).decode('latin-1') if row.codec == 'gzip' else ''
+    return (fragment_of(row), digest, gz, '')
+
+
+def stale(record):
+    '''True if a cached record points into a segment compact() has retired.
+
+    The blob has moved, so the record must be read again; another process
+    may have done the compaction, and KV_CACHE_TTL can be 0.'''
+    pointer = record[3]
+    return bool(pointer) and store.retired(int(pointer.split(':', 1)[0]))
+
+
+def gzipped(record):
+    '''True if a record's value can be sent gzip encoded as stored.'''
+    return bool(record[2]) or record[3].endswith(':gzip')
+
+
+def get_body(record, key, gzip=False):
+    '''The /get body for key from a record(); gzip encoded if gzip is set,
+    which needs gzipped(record).
+
+    Segmented values are sliced from the segment map straight into the body.'''
+    value_json, digest, gz, pointer = record
+    if pointer:
+        segment, offset, length, codec = pointer.split(':')
+        raw = store.read(int(segment), int(offset), int(length))
+        if gzip:
+            return compress.gzip_body(raw, key)
+        return fastjson.kv_body(key, compress.fragment(codec, raw) if codec else raw)
+    if gzip:
+        return compress.gzip_body(gz.encode('latin-1'), key)
+    return fastjson.kv_body(key, value_json)
+
+
+def report(session):
+    '''How much storage sharing and compressing blobs saves.
+
+    Returns {'keys', 'blobs', 'compressed', 'segmented', 'logical_bytes',
+    'stored_bytes', 'saved_bytes', 'ratio'}: logical bytes count each key's
+    value in full, stored bytes each blob once as stored (compressed or not,
+    in the database or a segment), and ratio is logical over stored.'''
+    keys, logical = session.query(db.func.count(Kv.key),
+                                  db.func.coalesce(db.func.sum(Blob.size), 0)) \
+                           .join(Blob, Blob.digest == Kv.digest).one()
+    stored_size = case([(Blob.segment != None, Blob.seg_length),
+                        (Blob.codec != None, db.func.length(Blob.data))], else_=Blob.size)
+    blobs, compressed, segmented, stored = session.query(db.func.count(Blob.digest),
+                                                         db.func.count(Blob.codec),
+                                                         db.func.count(Blob.segment),
+                                                         db.func.coalesce(db.func.sum(stored_size), 0)).one()
+    return {'keys': keys,
+            'blobs': blobs,
+            'compressed': compressed,
+            'segmented': segmented,
+            'logical_bytes': int(logical),
+            'stored_bytes': int(stored),
+            'saved_bytes': int(logical) - int(stored),
+            'ratio': round(float(logical) / stored, 4) if stored else 1.0,
+           }
+
+
+def compact(session, ratio=SEGMENT_COMPACT_RATIO, grace=SEGMENT_COMPACT_GRACE):
+    '''Reclaim the space deleted blobs left in segment files.
+
+    Deletes the segments retired at least grace seconds ago, then copies the
+    live blobs out of each segment whose live bytes are under ratio of its
+    size, repoints them and retires the segment. The active segment and any
+    appended to in the last grace seconds are skipped: a writer may not have
+    committed the row that points into them yet.
+    Returns {'segments', 'compacted', 'moved', 'purged_bytes'}.'''
+    dead = store.dead(grace)
+    # a row committed after its segment was retired; move it next run
+    referenced = set(segment for segment, in session.query(Blob.segment)
+                                                   .filter(Blob.segment.in_(dead)).distinct()) \
+                     if dead else set()
+    for segment in referenced:
+        store.revive(segment)
+    purged = store.purge([segment for segment in dead if segment not in referenced])
+    active = store.active()
+    live = dict(session.query(Blob.segment, db.func.sum(Blob.seg_length))
+                       .filter(Blob.segment != None).group_by(Blob.segment))
+    compacted = moved = 0
+    for segment in store.segments():
+        if segment == active or not store.idle(segment, grace) \
+                or (live.get(segment) or 0) >= store.size(segment) * ratio:
+            continue
+        rows = session.query(Blob.digest, Blob.seg_offset, Blob.seg_length) \
+                      .filter(Blob.segment == segment).all()
+        for digest, offset, length in rows:
+            new_segment, new_offset = store.append(bytes(store.read(segment, offset, length)),
+                                                   sync=False)
+            # skipped if the blob was deleted meanwhile
+            moved += session.query(Blob).filter(Blob.digest == digest, Blob.segment == segment,
+                                                Blob.seg_offset == offset) \
+                            .update({Blob.segment: new_segment, Blob.seg_offset: new_offset},
+                                    synchronize_session=False)
+        store.sync()
+        session.commit()
+        store.retire(segment)
+        compacted += 1
+    return {'segments': len(store.segments()),
+            'compacted': compacted,
+            'moved': moved,
+            'purged_bytes': purged,
+           }
@@ -0,0 +1,123 @@
+'''
+Block header cache for Bitcoin Core lookups.
+
+A background thread polls the chain tip and keeps the header at a fixed
+depth ready, so /query can attach block_info without any RPC. Headers fetched
+for /bitcoin are kept in an LRU keyed by hash, with a height -> hash map in
+front of it.
+'''
+import threading
+from collections import OrderedDict
+
+# heights closer than this to the tip can still be reorganized away
+REORG_DEPTH = 6
+
+
+class BlockCache(object):
+    def __init__(self, rpc, depth=12, interval=30, size=2048):
+        self.rpc = rpc
+        self.depth = depth
+        self.interval = interval
+        self.size = size
+        self.tip = None
+        self.at_depth = None        # header at self.depth below the tip
+        self.headers = OrderedDict()
+        self.heights = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self):
+        '''Start polling the tip in a daemon thread.'''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='blockcache')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                pass
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def notify(self):
+        '''Refresh now, e.g. from a -blocknotify hook.'''
+        self.wake.set()
+
+    def refresh(self):
+        '''Fetch the tip height and update the depth header if it moved.'''
+        tip = self._call('getblockcount')
+        if tip is None or not self.advance(tip):
+            return
+        self.at_depth = self.by_height(tip - self.depth)
+
+    def advance(self, tip):
+        '''Record a new tip height; False if it hasn't moved.
+
+        Heights near the tip are forgotten since a reorg may replace them.'''
+        if tip == self.tip:
+            return False
+        with self.lock:
+            for height in [h for h in self.heights if h > tip - REORG_DEPTH]:
+                del self.heights[height]
+        self.tip = tip
+        return True
+
+    def by_depth(self, depth):
+        if self.tip is None:
+            self.refresh()
+        if self.tip is None:
+            return None
+        return self.by_height(self.tip - int(depth))
+
+    def by_height(self, height):
+        height = int(height)
+        block_hash = self.cached_height(height)
+        if block_hash is None:
+            block_hash = self._call('getblockhash', [height])
+            if block_hash is None:
+                return None
+        return self.by_hash(block_hash)
+
+    def by_hash(self, block_hash):
+        out = self.cached(block_hash)
+        if out is not None:
+            return out
+        header = self._call('getblockheader', [str(block_hash)])
+        if header is None:
+            return None
+        return self.store(block_hash, header)
+
+    def cached_height(self, height):
+        '''Hash of the block at height if known, without any RPC.'''
+        with self.lock:
+            return self.heights.get(int(height))
+
+    def cached(self, block_hash):
+        '''Header for block_hash if cached, without any RPC.'''
+        with self.lock:
+            out = self.headers.get(block_hash)
+            if out is not None:
+                self.headers.move_to_end(block_hash)
+            return out
+
+    def store(self, block_hash, header):
+        '''Cache a getblockheader result and return its short form.'''
+        out = {'hash': header['hash'], 'time': header['time'], 'height': header['height']}
+        with self.lock:
+            self.headers[block_hash] = out
+            self.heights[out['height']] = block_hash
+            while len(self.headers) > self.size:
+                old_hash, old = self.headers.popitem(last=False)
+                if self.heights.get(old['height']) == old_hash:
+                    del self.heights[old['height']]
+        return out
+
+    def _call(self, command, params=None):
+        res = self.rpc.get(command, params)
+        if 'output' in res and res['output'].get('result') is not None:
+            return res['output']['result']
+        return None
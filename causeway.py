@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+'''
+Causeway command line
+
+Usage:
+    python3 causeway.py serve [--workers N] [--bind HOST:PORT] [--max-requests N] [--asgi]
+    python3 causeway.py migrate
+    python3 causeway.py reconcile [--dry-run]
+    python3 causeway.py dedup
+    python3 causeway.py train-dict OUT [--size BYTES] [--samples N]
+    python3 causeway.py compact
+
+serve runs a pre-forking master. It loads settings and the application
+(cserver, or aserver with --asgi) once, binds the listening socket and then
+forks the workers, which share all of that copy-on-write. A worker exits after
+--max-requests requests and the master starts a fresh one.
+
+Once every worker is up the master signals readiness: READY=1 to systemd's
+NOTIFY_SOCKET if set, and its pid to READY_FILE if configured.
+
+Signals to the master:
+    HUP         graceful reload: workers finish their current request, the
+                master re-executes itself (re-reading code and settings) and
+                keeps the listening socket, so no connection is refused
+    TERM, INT   graceful stop
+
+migrate brings an existing database up to the current schema (migrations.py).
+
+reconcile recomputes each sale's bytes_used from the rows stored under it and
+prints the drift it found. It is safe to run against a live server; monitor.py
+also runs it every RECONCILE_INTERVAL seconds.
+
+dedup reports how many keys share stored values (blobs.py) and the ratio of
+logical to stored bytes.
+
+train-dict trains a zstd dictionary on up to --samples stored values and
+writes it to OUT, for COMPRESSION_DICT (compress.py).
+
+compact reclaims the space deleted values left in segment files
+(segments.py); monitor.py also runs it every SEGMENT_COMPACT_INTERVAL seconds.
+'''
+import argparse
+import importlib
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from settings import SERVER_PORT, WORKERS, MAX_REQUESTS, READY_FILE
+
+# the listening socket's fd, handed to the re-executed master on reload
+LISTEN_FD = 'CAUSEWAY_LISTEN_FD'
+# seconds workers get to finish in-flight requests on stop
+GRACEFUL_TIMEOUT = 30
+
+
+def listen(bind):
+    '''Inherited socket after a reload, else a fresh one bound to HOST:PORT.'''
+    fd = os.environ.pop(LISTEN_FD, None)
+    if fd is not None:
+        sock = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+        os.close(int(fd))
+        return sock
+    host, _, port = bind.rpartition(':')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host or '0.0.0.0', int(port)))
+    sock.listen(128)
+    return sock
+
+
+def notify(state, ready_file=None):
+    '''Report state ("READY=1", "RELOADING=1", ...) to systemd and the ready file.'''
+    if ready_file and state == 'READY=1':
+        with open(ready_file, 'w') as f:
+            f.write(str(os.getpid()))
+    address = os.environ.get('NOTIFY_SOCKET')
+    if address:
+        if address.startswith('@'):
+            address = '\0' + address[1:]
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(('%s\nMAINPID=%d' % (state, os.getpid())).encode('ascii'), address)
+        finally:
+            sock.close()
+
+
+class _Server(WSGIServer):
+    '''wsgiref server on an already listening socket, counting requests.'''
+
+    def __init__(self, sock):
+        WSGIServer.__init__(self, sock.getsockname(), WSGIRequestHandler,
+                            bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name = socket.getfqdn(sock.getsockname()[0])
+        self.server_port = sock.getsockname()[1]
+        self.setup_environ()
+        self.served = 0
+
+    def process_request(self, request, client_address):
+        self.served += 1
+        WSGIServer.process_request(self, request, client_address)
+
+
+def run_wsgi(sock, module, max_requests):
+    stop = []
+    signal.signal(signal.SIGTERM, lambda *args: stop.append(True))
+    signal.signal(signal.SIGINT, lambda *args: stop.append(True))
+    # every worker wakes on a new connection; the losers must not block in accept()
+    sock.setblocking(False)
+    server = _Server(sock)
+    server.set_app(module.app)
+    server.timeout = 1
+    while not stop and not (max_requests and server.served >= max_requests):
+        server.handle_request()
+
+
+def run_asgi(sock, module, max_requests):
+    import uvicorn
+    config = uvicorn.Config(module.app, limit_max_requests=max_requests or None, lifespan='on')
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Master(object):
+    def __init__(self, args):
+        self.args = args
+        self.workers = {}           # pid -> start time
+        self.stopping = False
+        self.reloading = False
+        self.ready = False
+
+    def run(self):
+        self.sock = listen(self.args.bind)
+        # everything imported here is shared copy-on-write by the workers
+        self.module = importlib.import_module('aserver' if self.args.asgi else 'cserver')
+        if hasattr(self.module, 'check_core'):
+            self.module.check_core()
+        self.ready_r, self.ready_w = os.pipe()
+        started = 0
+
+        signal.signal(signal.SIGHUP, lambda *args: setattr(self, 'reloading', True))
+        signal.signal(signal.SIGTERM, lambda *args: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda *args: setattr(self, 'stopping', True))
+
+        print("Serving on %s:%d with %d workers" % (self.sock.getsockname()[:2] + (self.args.workers,)))
+        while True:
+            self.reap()
+            if self.stopping:
+                return self.stop()
+            if self.reloading:
+                return self.reload()
+            while len(self.workers) < self.args.workers:
+                self.spawn()
+            readable = select.select([self.ready_r], [], [], 1.0)[0]
+            if readable:
+                started += len(os.read(self.ready_r, 1024))
+                if not self.ready and started >= self.args.workers:
+                    self.ready = True
+                    notify('READY=1', self.args.ready_file)
+                    print("Ready")
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return
+        # worker
+        status = 0
+        try:
+            for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, signal.SIG_DFL)
+            os.close(self.ready_r)
+            if hasattr(self.module, 'after_fork'):
+                self.module.after_fork()
+            max_requests = self.args.max_requests
+            if max_requests:
+                # spread recycling out so workers don't all restart at once
+                max_requests += random.randint(0, max_requests // 10)
+            os.write(self.ready_w, b'.')
+            (run_asgi if self.args.asgi else run_wsgi)(self.sock, self.module, max_requests)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self.workers.pop(pid, None)
+            # a worker dying right after start is likely to again; don't spin
+            if started is not None and status and time.time() - started < 1:
+                time.sleep(1)
+
+    def signal_workers(self, sig):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                self.workers.pop(pid)
+
+    def stop(self):
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.time() + GRACEFUL_TIMEOUT
+        while self.workers and time.time() < deadline:
+            time.sleep(0.1)
+            self.reap()
+        self.signal_workers(signal.SIGKILL)
+        if self.args.ready_file and os.path.exists(self.args.ready_file):
+            os.remove(self.args.ready_file)
+
+    def reload(self):
+        '''Let the current workers drain and exec a new master on the same socket.
+
+        The pid stays the same, so the new master reaps the old workers.'''
+        notify('RELOADING=1')
+        self.signal_workers(signal.SIGTERM)
+        fd = self.sock.fileno()
+        os.set_inheritable(fd, True)
+        env = dict(os.environ)
+        env[LISTEN_FD] = str(fd)
+        os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+
+def serve(args):
+    if args.workers <= 0:
+        args.workers = os.cpu_count() or 1
+    Master(args).run()
+
+
+def migrate(args):
+    import migrations
+    migrations.migrate()
+
+
+def reconcile(args):
+    import json
+    from models import db, Sale
+    report = Sale.reconcile(db.session, fix=not args.dry_run)
+    print(json.dumps(report, indent=2))
+    return 1 if report['drifted'] and args.dry_run else 0
+
+
+def dedup(args):
+    import json
+    import blobs
+    from models import db
+    print(json.dumps(blobs.report(db.session), indent=2))
+
+
+def train_dict(args):
+    import blobs
+    import compress
+    from models import db
+    rows = db.session.query(*blobs.READ_COLUMNS).order_by(db.func.random()).limit(args.samples)
+    samples = [blobs.value_of(row) for row in rows]
+    try:
+        trained = compress.train(samples, args.size)
+    except ValueError as e:
+        print(e)
+        return 1
+    with open(args.out, 'wb') as f:
+        f.write(trained)
+    print("Trained a %d byte dictionary on %d values" % (args.size, len(samples)))
+
+
+def compact(args):
+    import json
+    import blobs
+    from models import db
+    print(json.dumps(blobs.compact(db.session), indent=2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='causeway')
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('serve', help='run the server with pre-forked workers')
+    p.add_argument('--bind', default='0.0.0.0:%s' % os.environ.get('SERVER_PORT', SERVER_PORT),
+                   help='HOST:PORT to listen on')
+    p.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', WORKERS)),
+                   help='worker processes, 0 for one per CPU core (default $WEB_CONCURRENCY)')
+    p.add_argument('--max-requests', type=int, default=MAX_REQUESTS,
+                   help='recycle a worker after this many requests, 0 never')
+    p.add_argument('--ready-file', default=READY_FILE,
+                   help='write the master pid here once all workers are up')
+    p.add_argument('--asgi', action='store_true',
+                   help='serve aserver.py (asyncio) instead of cserver.py')
+    p.set_defaults(func=serve)
+    p = commands.add_parser('migrate', help='upgrade the database schema')
+    p.set_defaults(func=migrate)
+    p = commands.add_parser('reconcile', help='recompute bucket usage and report drift')
+    p.add_argument('--dry-run', action='store_true',
+                   help='only report drift, exit 1 if there is any')
+    p.set_defaults(func=reconcile)
+    p = commands.add_parser('dedup', help='report storage saved by shared values')
+    p.set_defaults(func=dedup)
+    p = commands.add_parser('train-dict', help='train a zstd dictionary on stored values')
+    p.add_argument('out', help='file to write the dictionary to')
+    p.add_argument('--size', type=int, default=16384, help='dictionary size in bytes')
+    p.add_argument('--samples', type=int, default=5000, help='most values to train on')
+    p.set_defaults(func=train_dict)
+    p = commands.add_parser('compact', help='reclaim space in value segment files')
+    p.set_defaults(func=compact)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
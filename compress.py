@@ -0,0 +1,137 @@
+'''
+Compression for stored values.
+
+With COMPRESSION set, a new blob of at least COMPRESSION_MIN_SIZE bytes is
+stored compressed in blob.data and blob.codec names the codec. Blobs with no
+codec keep value and value_json as before, so existing rows still read.
+
+'gzip' deflates the blob's /get body up to the key, '{"value": <value>', and
+keeps the stream open. A client whose Accept-Encoding allows gzip gets the
+stored bytes as they are: gzip_body() only adds the header, a compressed
+', "key": <key>}' and the trailer, so the value is never decompressed. The
+body it decodes to lists value before key.
+
+'zstd' needs the zstandard package and can use a dictionary trained on the
+stored documents (COMPRESSION_DICT, see causeway.py train-dict), which suits
+Rein's armored text. Clients don't have the dictionary, so zstd values are
+decompressed before they are sent.
+'''
+import json
+import struct
+import zlib
+
+from settings import COMPRESSION, COMPRESSION_MIN_SIZE, COMPRESSION_DICT
+import fastjson
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ('gzip', 'zstd')
+
+# what gzip blobs hold before the value's JSON fragment
+VALUE_PREFIX = b'{"value": '
+# ID1 ID2 CM=deflate FLG=0 MTIME=0 XFL=0 OS=unknown
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+LEVEL = 6
+
+codec = None
+min_size = 512
+dictionary = None
+
+
+def configure(name, size=512, dict_path=None):
+    '''Compress new values of at least size bytes with codec name, None for none.'''
+    global codec, min_size, dictionary
+    if name not in CODECS + (None,):
+        raise ValueError("Unknown COMPRESSION codec %r" % name)
+    if (name == 'zstd' or dict_path) and zstandard is None:
+        raise ValueError("COMPRESSION 'zstd' needs the zstandard package")
+    dictionary = None
+    if dict_path:
+        with open(dict_path, 'rb') as f:
+            dictionary = zstandard.ZstdCompressionDict(f.read())
+    codec = name
+    min_size = size
+
+
+def encode(value):
+    '''(codec, data) to store value as, or (None, None) to store it plain.
+
+    A value that doesn't come out smaller is stored plain.'''
+    raw = value.encode('utf-8')
+    if codec is None or len(raw) < min_size:
+        return None, None
+    if codec == 'gzip':
+        plain = VALUE_PREFIX + fastjson.fragment(value).encode('utf-8')
+        c = zlib.compressobj(LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        # a sync flush ends on a byte boundary without a final block, so
+        # gzip_body() can append to the stream
+        stream = c.compress(plain) + c.flush(zlib.Z_SYNC_FLUSH)
+        data = struct.pack('<II', zlib.crc32(plain) & 0xffffffff, len(plain)) + stream
+    else:
+        data = zstandard.ZstdCompressor(dict_data=dictionary).compress(raw)
+    if len(data) >= len(raw):
+        return None, None
+    return codec, data
+
+
+def decode(name, data):
+    '''The value a compressed blob holds.'''
+    if name == 'gzip':
+        return json.loads(fragment(name, data))
+    if name == 'zstd':
+        if zstandard is None:
+            raise ValueError("Reading zstd values needs the zstandard package")
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(bytes(data)).decode('utf-8')
+    raise ValueError("Unknown codec %r" % name)
+
+
+def fragment(name, data):
+    '''The value_json fragment of a compressed blob.'''
+    if name == 'gzip':
+        plain = zlib.decompressobj(-zlib.MAX_WBITS).decompress(bytes(data[8:]))
+        return plain[len(VALUE_PREFIX):].decode('utf-8')
+    return fastjson.fragment(decode(name, data))
+
+
+def gzip_body(data, key):
+    '''Complete gzip encoded /get body for key from a gzip blob's data.'''
+    crc, size = struct.unpack_from('<II', data)
+    tail = b', "key": ' + fastjson.dumps(key) + b'}'
+    c = zlib.compressobj(LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    end = c.compress(tail) + c.flush()
+    return b''.join((GZIP_HEADER, bytes(data[8:]), end,
+                     struct.pack('<II', zlib.crc32(tail, crc) & 0xffffffff,
+                                 (size + len(tail)) & 0xffffffff)))
+
+
+def accepts(accept_encoding, name):
+    '''True if an Accept-Encoding header value allows content coding name.'''
+    weights = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0
+        weights[coding.strip().lower()] = q
+    return weights.get(name, weights.get('*', 0)) > 0
+
+
+def train(samples, size=16384):
+    '''zstd dictionary bytes trained on sample values.'''
+    if zstandard is None:
+        raise ValueError("Training a dictionary needs the zstandard package")
+    try:
+        return zstandard.train_dictionary(size, [s.encode('utf-8') for s in samples]).as_bytes()
+    except zstandard.ZstdError as e:
+        # typically too few or too small samples for the size asked for
+        raise ValueError("Can't train a %d byte dictionary on %d values: %s" % (size, len(samples), e))
+
+
+configure(COMPRESSION, COMPRESSION_MIN_SIZE, COMPRESSION_DICT)
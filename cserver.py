@@ -5,18 +5,19 @@ Causeway Server - key/value storage server geared toward small files with ECSDA
 Usage:
     python3 causeway-server.py
 '''
-from flask import Flask
 from flask import request
 from flask import abort, url_for
-from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy import and_
+from flask import Response, stream_with_context
 
-from settings import DATABASE_URI, PRICE, DATA_DIR, SERVER_PORT, DEBUG, TESTNET
+from settings import PRICE, DATA_DIR, SERVER_PORT, DEBUG, TESTNET, MGET_MAX_KEYS
+from settings import BLOCK_POLL_INTERVAL, BLOCK_CACHE_SIZE, VERIFY_CACHE_SIZE, VERIFY_WORKERS
+from settings import VERIFY_ENGINE, NONCE_TTL, NONCE_WINDOW
+from settings import KV_CACHE_BYTES, KV_CACHE_TTL, KV_CACHE_SHARED, KV_CACHE_SHARED_TTL
+from settings import GET_MAX_AGE, QUERY_MAX_AGE, JSON_ENCODER, QUERY_PAGE_SIZE, QUERY_MAX_PAGE_SIZE
 import os
 import json
-import random
 import time
-import string
+from datetime import datetime
 import requests
 from decimal import Decimal
 
@@ -24,64 +25,92 @@ from decimal import Decimal
 #from two1.lib.bitserv.flask import Payment
 
 from rpc import RPC
-from bitcoinecdsa import sign, verify
+from blockcache import BlockCache
+from bitcoinecdsa import sign, verify_cache, set_engine
+from verifier import Verifier
+from nonces import NonceStore
+from kvcache import KvCache
 from monitor import Daemon
 from models import *
+from database import app, db, pool_stats
+from indexer import collection_version, answer
+from writes import run, stored_sizes, charge, charge_many, check_nonce, consume_nonce, issue_nonce
+from writes import owned, store_kv, delete_kv
+import blobs
+import compress
+import etags
+import fastjson
 import bitcoin
 
 if (TESTNET): bitcoin.SelectParams('testnet')
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
 #wallet = Wallet()
 #payment = Payment(app, wallet)
 
+set_engine(VERIFY_ENGINE)
+fastjson.set_encoder(JSON_ENCODER)
+verify_cache.size = VERIFY_CACHE_SIZE
+verifier = Verifier(VERIFY_WORKERS, TESTNET)
+nonces = NonceStore(ttl=NONCE_TTL, window=NONCE_WINDOW)
+kv_cache = KvCache(KV_CACHE_BYTES, ttl=KV_CACHE_TTL, shared=KV_CACHE_SHARED,
+                   shared_ttl=KV_CACHE_SHARED_TTL)
+# what writes.py builds dialect-specific statements for
+dialect = db.engine.dialect.name
+block_cache = BlockCache(RPC.shared(RPCUSER, RPCPASS, SERVER, RPCPORT, timeout=RPCTIMEOUT), depth=12,
+                         interval=BLOCK_POLL_INTERVAL, size=BLOCK_CACHE_SIZE)
+
 # start time
 start_time = time.time()
 stored = 0
+core_enabled = False
+
+# service, pricing and endpoint information for /help
+HELP = [{"name": "causeway/1.freebeer",       # service 'causeway', version '1'
+         "pricing-type": "per-mb",   # pricing is listed per 1000000 bytes
+         "pricing" : [#{"rpc": "buy",
+                      # "per-req": 0,
+                      # "per-unit": PRICE,
+                      # "description": "1 MB hosting, 50 MB bandwidth, 1 year expiration"
+                      #},
+                      {"rpc": "request",
+                       "per-req": 0,
+                       "per-unit": 0,
+                       "description": "1 MB hosting, 50 MB bandwidth, 1 year expiration - free version for testing"
+                      },
+                      {"rpc": "get",
+                       "per-req": 0,
+                       "per-mb": 0
+                      },
+                      {"rpc": "put",
+                       "per-req": 0,
+                       "per-mb": 0
+                      },
+
+                      # default
+                      {"rpc": True,        # True indicates default
+                       "per-req": 0,
+                       "per-mb": 0
+                      }],
+          "description": "This Causeway server provides microhosting services."
+        }
+       ]
+
+def static_response(obj, **kwargs):
+    '''Handler return value for a body that never changes, encoded once.'''
+    body = fastjson.dumps(obj, **kwargs)
+    return (body, 200, {'Content-length': len(body),
+                        'Content-type': 'application/json',
+                       }
+           )
+
+HELP_RESPONSE = static_response(HELP, indent=2)
+PRICE_RESPONSE = static_response({'price': 0})
 
 @app.route('/')
 @app.route('/help')
 def home():
     '''Return service, pricing and endpoint information'''
-    home_obj = [{"name": "causeway/1.freebeer",       # service 'causeway', version '1'
-                 "pricing-type": "per-mb",   # pricing is listed per 1000000 bytes
-                 "pricing" : [#{"rpc": "buy",
-                              # "per-req": 0,
-                              # "per-unit": PRICE,
-                              # "description": "1 MB hosting, 50 MB bandwidth, 1 year expiration"
-                              #},
-                              {"rpc": "request",
-                               "per-req": 0,
-                               "per-unit": 0,
-                               "description": "1 MB hosting, 50 MB bandwidth, 1 year expiration - free version for testing"
-                              },
-                              {"rpc": "get",
-                               "per-req": 0,
-                               "per-mb": 0
-                              },
-                              {"rpc": "put",
-                               "per-req": 0,
-                               "per-mb": 0
-                              },
-
-                              # default
-                              {"rpc": True,        # True indicates default
-                               "per-req": 0,
-                               "per-mb": 0
-                              }],
-                  "description": "This Causeway server provides microhosting services."
-                }
-               ]
-
-    body = json.dumps(home_obj, indent=2)
-
-    return (body, 200, {'Content-length': len(body),
-                        'Content-type': 'application/json',
-                       }
-                       )
+    return HELP_RESPONSE
 
 @app.route('/status')
 def status():
@@ -89,10 +118,13 @@ def status():
     uptime = str(int(time.time() - start_time))
     st = os.statvfs(DATA_DIR)
     free = st.f_bavail * st.f_frsize
-    body = json.dumps({'uptime': uptime,
+    body = fastjson.dumps({'uptime': uptime,
                        'stored': str(stored),
                        'free': str(free),
-                       'price': str(PRICE)
+                       'price': str(PRICE),
+                       'verify_cache': verify_cache.stats(),
+                       'kv_cache': kv_cache.stats(),
+                       'db_pool': pool_stats()
                       }, indent=2
                      )
     return (body, 200, {'Content-length': len(body),
@@ -103,11 +135,11 @@ def status():
 @app.route('/price')
 def price():
     '''Return price for 1MB storage with bundled 50MB transfer.'''
-    body = json.dumps({'price': 0})
-    return (body, 200, {'Content-length': len(body),
-                        'Content-type': 'application/json',
-                       }
-           )
+    return PRICE_RESPONSE
+
+def utcnow():
+    '''Now to the second, as the sale.created default would record it.'''
+    return datetime.utcnow().replace(microsecond=0)
 
 @app.route('/buy')
 def buy_hosting():
@@ -118,10 +150,10 @@ def buy_hosting():
     contact = request.args.get('contact')
 
 
-    # check if user exists
-    o = db.session.query(Owner).get(owner)
+    # the owner and their buckets in one read
+    o, owned = Owner.with_sales(db.session, owner)
     if o is None:
-        # create them
+        # create them, kept even if getting a payment address fails below
         o = Owner(owner, delegate)
         db.session.add(o)
         db.session.commit()
@@ -131,7 +163,7 @@ def buy_hosting():
     if 'result' in res and res['result'] == 'success':
         address = res['output']['result']
     else:
-        body = json.dumps({'result': 'error',
+        body = fastjson.dumps({'result': 'error',
                            'message': 'Error getting address. Contact server admin.'}, indent=2)
         return (body, 500, {'Content-length': len(body),
                             'Content-type': 'application/json',
@@ -144,26 +176,31 @@ def buy_hosting():
     # else we can just update thjis sale record's creation time, price, and receiving address
     # the policy here is you must pay with a single payment, if you send a payment and request 
     # a bucket, you will get a new address
-    sales = Sale.get_recent(owner)
+    sales = Sale.recent(owned)
     if len(sales) == 0:
         s = Sale(owner, contact, 1, 30, PRICE, address)
+        s.created = utcnow()
         db.session.add(s)
-        db.session.commit()
+        owned.append(s)
     else:
         for s in sales:
             if s.price == 0 or Decimal(s.received) > 0.0:
                 continue
 
-            s.created = db.func.current_timestamp()
+            s.created = utcnow()
             s.price = PRICE
             s.payment_address = address
-            db.session.commit()
             break
 
-    body = json.dumps({'result': 'success',
+    # flush first so a new sale has its id for the listing
+    db.session.flush()
+    buckets = Sale.buckets(owned)
+    db.session.commit()
+
+    body = fastjson.dumps({'result': 'success',
                        'address': address,
                        'price': str(PRICE),
-                       'buckets': s.get_buckets()}, indent=2)
+                       'buckets': buckets}, indent=2)
     return (body, 200, {'Content-length': len(body),
                         'Content-type': 'application/json',
                        }
@@ -177,30 +214,36 @@ def request_hosting():
     delegate = request.args.get('delegate')
     contact = request.args.get('contact')
 
-    # check if user exists
-    o = db.session.query(Owner).filter(Owner.address == owner).first()
-    print(o)
+    # the owner and their buckets in one read
+    o, owned = Owner.with_sales(db.session, owner)
     if o is None:
-        # create them
+        # create them, kept even if a concurrent grant rolls ours back below
         o = Owner(owner, delegate)
-        print(o)
         db.session.add(o)
         db.session.commit()
 
-    count = db.session.query(Sale).filter(and_(Sale.price == 0, 
-                                               Sale.owner == owner)).count()
+    count = len([s for s in owned if s.price == 0])
+    granted = None
     if count < 4:
         s = Sale(owner, contact, 1, 30, 0)
+        s.created = utcnow()
         db.session.add(s)
-        db.session.commit()
-        body = json.dumps({'result': 'success', 
-                           'buckets': s.get_buckets()}, indent=2)
+        db.session.flush()
+        # a concurrent request may have granted one since we read
+        if Sale.free_count(db.session, owner) <= 4:
+            granted = Sale.buckets(owned + [s])
+            db.session.commit()
+        else:
+            db.session.rollback()
+            o, owned = Owner.with_sales(db.session, owner)
+
+    if granted is not None:
+        body = fastjson.dumps({'result': 'success', 
+                           'buckets': granted}, indent=2)
     else:
-        s = db.session.query(Sale).filter(and_(Sale.price == 0,
-                                               Sale.owner == owner)).first()
-        body = json.dumps({'result': 'error',
+        body = fastjson.dumps({'result': 'error',
                            'message': 'Maximum free buckets granted',
-                           'buckets': s.get_buckets()}, indent=2)
+                           'buckets': Sale.buckets(owned)}, indent=2)
 
     return (body, 200, {'Content-length': len(body),
                         'Content-type': 'application/json',
@@ -216,178 +259,48 @@ def query():
         testnet = True
     else:
         testnet = False
-        
+
+    # the answer goes under the query's name, which JSON needs as a string
+    if string is None:
+        body = fastjson.dumps({'error': 'No query given.'})
+        return (body, 400, {'Content-length': len(body),
+                            'Content-type': 'application/json',
+                           }
+               )
+
     #check if owner has an active sale record or request
     sales = db.session.query(Sale).filter(Sale.owner == owner).count()
-    res = []
     if sales == 0:
-        body = json.dumps({"result": "error",
+        body = fastjson.dumps({"result": "error",
                           "message": "Account required to make queries"})
         return (body, 200, {'Content-length': len(body),
                         'Content-type': 'application/json',
                        }
                )
-    elif string == 'mediators':
-        mediator_query = Kv.query.filter(and_(Kv.testnet == testnet,
-                                              Kv.value.ilike('%\nWilling to mediate: True%'))).paginate(1, 100, False)
-        mediators = mediator_query.items
-        for m in mediators:
-            res.append(m.value)
-    elif string == 'jobs':
-        q = Kv.query.filter(and_(Kv.testnet == testnet,
-                                 Kv.value.like('%\nRein Job%'))).paginate(1, 100, False)
-        items = q.items
-        for i in items:
-            res.append(i.value)
-    elif string == 'bids':
-        q = Kv.query.filter(and_(Kv.testnet == testnet,
-                                 Kv.value.like('%\nRein Bid%'))).paginate(1, 100, False)
-        items = q.items
-        for i in items:
-            res.append(i.value)
-    elif string == 'deliveries':
-        job_creator = request.args.get('job_creator')
-        q = Kv.query.filter(and_(Kv.testnet == testnet,
-                                 Kv.value.ilike('%Rein Delivery%Job creator public key: '+job_creator+'%'))).paginate(1, 100, False)
-        items = q.items
-        for i in items:
-            res.append(i.value)
-    elif string == 'in-process':
-        worker = request.args.get('worker')
-        q = Kv.query.filter(and_(Kv.testnet == testnet,
-                                 Kv.value.ilike('%Worker public key: '+worker+'%'))).paginate(1, 100, False)
-        items = q.items
-        for i in items:
-            res.append(i.value)
-    elif string == 'review':
-        mediator = request.args.get('mediator')
-        q = Kv.query.filter(and_(Kv.testnet == testnet,
-                                 Kv.value.ilike('%Mediator public key: '+mediator+'%'))).paginate(1, 100, False)
-        items = q.items
-        for i in items:
-            res.append(i.value)
-    elif string == 'by_job_id':
-        job_ids = request.args.get('job_ids')
-        for job_id in job_ids.split(','):   
-            q = Kv.query.filter(and_(Kv.testnet == testnet,
-                                     Kv.value.ilike('%Job ID: '+job_id+'\n%'))).paginate(1, 100, False)
-            items = q.items
-            for i in items:
-                if i is not None:
-                    res.append(i.value)
-    elif string == 'dispute':
-        job_ids = request.args.get('job_ids')
-        for job_id in job_ids.split(','):   
-            last_len = len(res) 
-            print(last_len)
-            q = Kv.query.filter(Kv.value.ilike('%Rein Delivery%'+job_id+'\n%')).paginate(1, 100, False)
-            items = q.items
-            for i in items:
-                if i is not None:
-                    res.append(i.value)
-            if len(res) == last_len: #we didn't find a delivery for this job id, look for an offer
-                q = Kv.query.filter(Kv.value.ilike('%Rein Offer%'+job_id+'\n%')).paginate(1, 100, False)
-                items = q.items
-                for i in items:
-                    if i is not None:
-                        res.append(i.value)
-            print(len(res))
-    elif string == 'get_user_ratings':
-        dest = None
-        source = None
-        try:
-            dest = request.args.get('dest')
-
-        except: pass
-
-        try:
-            source = request.args.get('source')
-
-        except: pass
 
-        if not dest and not source:
-            res.append('error')
-
-        else:
-            q = Kv.query.filter(and_(Kv.testnet == testnet,
-                                     Kv.value.like('%\nRein Rating%')))
-            if dest:
-                q = q.filter(Kv.value.like('%\nUser msin: {}%'.format(dest)))
-
-            if source:
-                q = q.filter(Kv.value.like('%\nRater msin: {}%'.format(source)))
-
-            q = q.paginate(1, 100, False)
-            items = q.items
-            for i in items:
-                res.append({'key': i.key, 'value': i.value})
-
-    elif string == 'get_user_name':
-        msin = request.args.get('msin')
-
-        if not msin:
-            res.append('error')
-
-        else:
-            q = Kv.query.filter(and_(Kv.testnet == testnet,
-                                     Kv.value.like('%\nRein User Enrollment%'))).filter(Kv.value.like('%\nSecure Identity Number: {}%'.format(msin))).paginate(1, 100, False)
-            items = q.items
-            for i in items:
-                res.append({'key': i.key, 'value': i.value})
-
-    elif string == 'get_user':
-      search_input = request.args.get('search_input')
-
-      if not search_input:
-        res.append('error')
-
-      else:
-        all_enrollments = Kv.query.filter(and_(
-          Kv.testnet == testnet,
-          Kv.value.like('%\nRein User Enrollment%')
-        ))
-
-        # Check for SIN matches
-        q = all_enrollments.filter(
-          Kv.value.like('%\nSecure Identity Number: {}%'.format(search_input))
-        ).paginate(1, 20, False)
-
-        # If unsuccessful, check for master address matches
-        if not q.items:
-          q = all_enrollments.filter(
-            Kv.value.like('%\nMaster signing address: {}%'.format(search_input))
-          ).paginate(1, 20, False)
-
-        # If unsuccessful, check for delegate address matches
-        if not q.items:
-          q = all_enrollments.filter(
-            Kv.value.like('%\nDelegate signing address: {}%'.format(search_input))
-          ).paginate(1, 20, False)
-
-        # If unsuccessful, check for username, case-insensitive, accepts partial matches
-        if not q.items:
-          q = all_enrollments.filter(
-            Kv.value.ilike('%\nUser: %{}%'.format(search_input))
-          ).paginate(1, 20, False)
-
-        # If unsuccessful, check for contact, case-insensitive, accepts partial matches
-        if not q.items:
-          q = all_enrollments.filter(
-            Kv.value.ilike('%\nContact: %{}%'.format(search_input))
-          ).paginate(1, 20, False)
-
-        for enrollment in q.items:
-          res.append(enrollment.value)
-                
     block_info = None
     if core_enabled:
-        block_info = get_by_depth(12)
-    body = json.dumps({"result": "success",
-                       string: res,
-                       "block_info": block_info})
-    return (body, 200, {'Content-length': len(body),
-                        'Content-type': 'application/json',
-                       }
+        block_info = block_cache.at_depth
+
+    # nothing the query can return has changed since the client's copy
+    version = collection_version(db.session, None if string == 'dispute' else testnet, string).scalar()
+    etag = etags.query_etag(request.query_string, version, block_info)
+    cache_headers = {'ETag': etag, 'Cache-Control': etags.cache_control(QUERY_MAX_AGE)}
+    if etags.matches(request.headers.get('If-None-Match'), etag):
+        return ('', 304, cache_headers)
+
+    # keyset paging: rows inserted after the cursor, oldest first
+    limit = max(1, min(request.args.get('limit', QUERY_PAGE_SIZE, type=int), QUERY_MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor', 0, type=int)
+    res, next_cursor = run(db.session, answer(db.session, string, testnet, request.args, cursor, limit))
+
+    body = fastjson.dumps({"result": "success",
+                           string: res,
+                           "next_cursor": next_cursor,
+                           "block_info": block_info})
+    return (body, 200, dict(cache_headers, **{'Content-length': len(body),
+                                              'Content-type': 'application/json',
+                                             })
            )
 
 @app.route('/put', methods=['POST'])
@@ -414,47 +327,33 @@ def put():
 
     owner = Owner.query.filter_by(address=o).first()
     if owner is None:
-        body = json.dumps({'error': 'User not found'})
+        body = fastjson.dumps({'error': 'User not found'})
         code = 403
-    elif owner.nonce != n:
-        body = json.dumps({'error': 'Bad nonce'})
+    elif not run(db.session, check_nonce(nonces, owner, n)):
+        body = fastjson.dumps({'error': 'Bad nonce'})
         code = 401
-    elif not verify(d, k + v + d + n, s) :
-        body = json.dumps({'error': 'Incorrect signature'})
+    elif not verifier.verify(d, k + v + d + n, s) :
+        body = fastjson.dumps({'error': 'Incorrect signature'})
         code = 401
     else:
-        size = len(k) + len(v)
-
         # need to also check that we have an enrollment that makes this a delegate of this owner
 
-        # check if owner has enough free storage
-        # get free space from each of owner's buckets
-        result = db.engine.execute('select * from sale where julianday("now") - \
-                    julianday(sale.created) < sale.term order by sale.created desc')
-        # choose newest bucket that has enough space
-        sale_id = None
-        for row in result:
-            if (row[7] + size) < (1024 * 1024):
-                sale_id = row[0]
-    
+        # charge the size difference of an overwrite, or the bucket with the most free space
+        current = run(db.session, stored_sizes(o, [k])).get(k)
+        sale_id = run(db.session, charge(o, kv_size(k, v), current))
         if sale_id is None:     # we couldn't find enough free space
-            body = json.dumps({'error': 'Insufficient storage space.'})
+            body = fastjson.dumps({'error': 'Insufficient storage space.'})
             code = 403 
+        # use the nonce up; a concurrent request may have beaten us to it
+        elif not run(db.session, consume_nonce(nonces, owner, n)):
+            db.session.rollback()
+            body = fastjson.dumps({'error': 'Bad nonce'})
+            code = 401
         else:
-            # check if key already exists and is owned by the same owner
-            kv = db.session.query(Kv).filter(and_(Kv.key == k, Kv.owner == o)).first()
-            if kv is None:
-                kv = Kv(k, v, o, sale_id, testnet)
-                db.session.add(kv)
-                db.session.commit()
-            else:
-                kv.value = v
-                db.session.commit()
-    
-            s = db.session.query(Sale).get(sale_id)
-            s.bytes_used = s.bytes_used + size
+            run(db.session, store_kv(dialect, k, v, o, sale_id, testnet))
             db.session.commit()
-            body = json.dumps({'result': 'success'})
+            kv_cache.invalidate(k)
+            body = fastjson.dumps({'result': 'success'})
             code = 201
     
     return (body, code, {'Content-length': len(body),
@@ -462,6 +361,72 @@ def put():
                         }
            )
 
+@app.route('/mput', methods=['POST'])
+def mput():
+    '''Store a batch of key-value pairs under one nonce in one transaction.'''
+    try:
+        body = request.data.decode('utf-8')
+        in_obj = json.loads(body)
+        items = [(i['key'], i['value'], i['signature'], i['signature_address'])
+                 for i in in_obj['items']]
+        o = in_obj['owner']
+        n = in_obj['nonce']
+    except:
+        return ("JSON Decode failed", 400, {'Content-Type':'text/plain'})
+
+    # an empty batch would use the nonce up and store nothing
+    if not items:
+        body = fastjson.dumps({'error': 'No items to store.'})
+        return (body, 400, {'Content-length': len(body),
+                            'Content-type': 'application/json',
+                           }
+               )
+
+    if 'testnet' in in_obj:
+        testnet = in_obj['testnet']
+    else:
+        testnet = False
+
+    owner = Owner.query.filter_by(address=o).first()
+    if owner is None:
+        body = fastjson.dumps({'error': 'User not found'})
+        code = 403
+    elif not run(db.session, check_nonce(nonces, owner, n)):
+        body = fastjson.dumps({'error': 'Bad nonce'})
+        code = 401
+    else:
+        valid = verifier.verify_many([(d, k + v + d + n, s) for k, v, s, d in items])
+        bad = [item[0] for item, ok in zip(items, valid) if not ok]
+        full = False
+        if not bad:
+            current = run(db.session, stored_sizes(o, [item[0] for item in items]))
+            placed = run(db.session, charge_many(o, [(k, kv_size(k, v)) for k, v, s, d in items],
+                                                 current))
+            full = placed is None
+        if bad:
+            body = fastjson.dumps({'error': 'Incorrect signature', 'keys': bad})
+            code = 401
+        elif full:
+            db.session.rollback()
+            body = fastjson.dumps({'error': 'Insufficient storage space.'})
+            code = 403
+        elif not run(db.session, consume_nonce(nonces, owner, n)):
+            db.session.rollback()
+            body = fastjson.dumps({'error': 'Bad nonce'})
+            code = 401
+        else:
+            for k, v, s, d in items:
+                run(db.session, store_kv(dialect, k, v, o, placed[k][0], testnet))
+            db.session.commit()
+            kv_cache.invalidate(*[item[0] for item in items])
+            body = fastjson.dumps({'result': 'success', 'stored': len(items)})
+            code = 201
+
+    return (body, code, {'Content-length': len(body),
+                         'Content-type': 'application/json',
+                        }
+           )
+
 @app.route('/delete', methods=['POST'])
 def delete():
     '''Delete a key-value pair.'''
@@ -479,24 +444,27 @@ def delete():
 
     # check signature
     owner = Owner.query.filter_by(delegate=d).first()
-    if owner.nonce not in n or verify(o, k + o + n, s):
-        body = json.dumps({'error': 'Incorrect signature.'})
+    if owner is None or not run(db.session, check_nonce(nonces, owner, n)) \
+            or not verifier.verify(d, k + d + n, s):
+        body = fastjson.dumps({'error': 'Incorrect signature.'})
         code = 401
     else:
         # check if key already exists and is owned by the same owner
-        kv = db.session.query(Kv).filter_by(key=k).filter_by(owner=o).first()
+        kv = run(db.session, owned(k, owner.address))
         if kv is None:
-            body = json.dumps({'error': 'Key not found or not owned by caller.'})
+            body = fastjson.dumps({'error': 'Key not found or not owned by caller.'})
             code = 404
+        # use the nonce up; a concurrent request may have beaten us to it
+        elif not run(db.session, consume_nonce(nonces, owner, n)):
+            db.session.rollback()
+            body = fastjson.dumps({'error': 'Bad nonce'})
+            code = 401
         else:
             # free up storage quota and remove kv
-            size = len(kv.value)
-            sale_id = kv.sale
-            s = db.session.query(Sale).get(sale_id)
-            s.bytes_used = s.bytes_used - size
-            db.session.delete(kv)
+            run(db.session, delete_kv(dialect, kv))
             db.session.commit()
-            body = json.dumps({'result': 'success'})
+            kv_cache.invalidate(k)
+            body = fastjson.dumps({'result': 'success'})
             code = 200
     
     return (body, code, {'Content-length': len(body),
@@ -510,45 +478,102 @@ def get():
     
     key = request.args.get('key')
 
-    kv = Kv.query.filter_by(key=key).first()
-
-    if kv is None:
-        body = json.dumps({'error': 'Key not found.'})
+    record = kv_cache.get(key)
+    if record is not None and blobs.stale(record):
+        # its segment was compacted away
+        kv_cache.invalidate(key)
+        record = None
+    if record is None:
+        token = kv_cache.token()
+        kv = db.session.query(Kv.digest, *blobs.READ_COLUMNS).join(Blob, Blob.digest == Kv.digest) \
+                       .filter(Kv.key == key).first()
+        if kv is not None:
+            record = blobs.record(kv, kv.digest)
+            kv_cache.fill(key, record, token)
+
+    headers = {}
+    if record is None:
+        body = fastjson.dumps({'error': 'Key not found.'})
         code = 404
     else:
-        body = json.dumps({'key': key, 'value': kv.value})
+        digest = record[1]
+        # gzip compressed values go out as stored to clients that take gzip
+        gzip = blobs.gzipped(record) and compress.accepts(request.headers.get('Accept-Encoding'), 'gzip')
+        headers = {'ETag': etags.quote(digest + '-gzip' if gzip else digest),
+                   'Cache-Control': etags.cache_control(GET_MAX_AGE),
+                   'Vary': 'Accept-Encoding'}
+        if etags.matches(request.headers.get('If-None-Match'), headers['ETag']):
+            return ('', 304, headers)
+        body = blobs.get_body(record, key, gzip)
+        if gzip:
+            headers['Content-Encoding'] = 'gzip'
         code = 200
 
     # calculate size and check against quota on kv's sale record
-    return (body, code, {'Content-length': len(body),
-                        'Content-type': 'application/json',
-                        }
+    return (body, code, dict(headers, **{'Content-length': len(body),
+                                         'Content-type': 'application/json',
+                                        })
            )
 
+@app.route('/mget', methods=['GET', 'POST'])
+def mget():
+    '''Get many key-value pairs, streamed back as newline-delimited JSON.'''
+    if request.method == 'POST':
+        try:
+            keys = json.loads(request.data.decode('utf-8'))
+            if isinstance(keys, dict):
+                keys = keys['keys']
+        except:
+            return ("JSON Decode failed", 400, {'Content-Type':'text/plain'})
+    else:
+        keys = request.args.getlist('key')
+
+    if not isinstance(keys, list) or not all(isinstance(k, str) for k in keys):
+        error = 'keys must be a list of strings.'
+    elif len(keys) > MGET_MAX_KEYS:
+        error = 'Too many keys, limit is %d.' % MGET_MAX_KEYS
+    else:
+        error = None
+    if error is not None:
+        body = fastjson.dumps({'error': error})
+        return (body, 400, {'Content-length': len(body),
+                            'Content-type': 'application/json',
+                           }
+               )
+    # drop duplicates, keep the client's order for the missing-key report
+    keys = list(dict.fromkeys(keys))
+
+    def generate():
+        found = set()
+        if keys:
+            for kv in db.session.query(Kv.key, *blobs.READ_COLUMNS) \
+                                .join(Blob, Blob.digest == Kv.digest) \
+                                .filter(Kv.key.in_(keys)).yield_per(100):
+                found.add(kv.key)
+                yield fastjson.kv_body(kv.key, blobs.fragment_of(kv)) + b'\n'
+        for key in keys:
+            if key not in found:
+                yield fastjson.dumps({'key': key, 'error': 'Key not found.'}) + b'\n'
+
+    return Response(stream_with_context(generate()), 200,
+                    {'Content-type': 'application/x-ndjson'})
+
 @app.route('/nonce')
 def nonce():
-    '''Return 32-byte nonce for generating non-reusable signatures..'''
+    '''Return 32-byte nonce for generating non-reusable signatures..
+
+    count=N pre-issues up to NONCE_WINDOW nonces at once for bulk writers.'''
+    address = request.args.get('address')
+    clear = request.args.get('clear')
+    count = request.args.get('count', 1, type=int)
+
+    out = run(db.session, issue_nonce(nonces, address, count, clear))
     # check if user exists
-    o = db.session.query(Owner).get(request.args.get('address'))
-    if o is None:
+    if out is None:
         return abort(500)
+    db.session.commit()
 
-    # clear the nonce by sending it to the server
-    if request.args.get('clear') and request.args.get('clear') == o.nonce:
-        o.nonce = ''
-        db.session.commit()
-        body = json.dumps({'nonce': o.nonce})
-    # if nonce is set for user return it, else make a new one
-    elif o.nonce and len(o.nonce) == 32:
-        body = json.dumps({'nonce': o.nonce})
-    # if not, create one and store it
-    else:
-        print("storing")
-        n = ''.join(random.SystemRandom().choice(string.hexdigits) for _ in range(32))
-        o.nonce = n.lower()
-        db.session.commit()
-        body = json.dumps({'nonce': o.nonce})
-
+    body = fastjson.dumps(out)
     return (body, 200, {'Content-length': len(body),
                         'Content-type': 'application/json',
                        }
@@ -567,10 +592,10 @@ def get_deposit_address():
     signature = request.args.get('signature')
 
     print(len(signature))
-    if len(signature) == 88 and verify(address, message, signature):
-        body = json.dumps({'address': 'hereyago'})
+    if len(signature) == 88 and verifier.verify(address, message, signature):
+        body = fastjson.dumps({'address': 'hereyago'})
     else:
-        body = json.dumps({'error': 'Invalid signature'})
+        body = fastjson.dumps({'error': 'Invalid signature'})
 
     return (body, 200, {'Content-length': len(body),
                         'Content-type': 'application/json',
@@ -586,6 +611,9 @@ def has_no_empty_params(rule):
 @app.route('/info')
 def info():
     '''Returns list of defined routes.'''
+    return INFO_RESPONSE
+
+def route_links():
     links = []
     for rule in app.url_map.iter_rules():
         # Filter out rules we can't navigate to in a browser
@@ -593,62 +621,49 @@ def info():
         if "GET" in rule.methods and has_no_empty_params(rule):
             url = url_for(rule.endpoint, **(rule.defaults or {}))
             links.append(url)
-
-    return json.dumps(links, indent=2)
+    return links
 
 @app.route('/bitcoin', methods=['GET', 'POST'])
 def query_bitcoin():
     if not core_enabled:
-        body = json.dumps({"result": "error",
+        body = fastjson.dumps({"result": "error",
                            "message": "Bitcoin Core not enabled for this server"})
         return (body, 200, {'Content-length': len(body),
                             'Content-type': 'application/json',
                            }
                )
 
-    rpc = RPC(RPCUSER, RPCPASS, SERVER, RPCPORT)
     # to begin, get hash, block height, and time for latest, then n-blocks-ago, or for a block hash
     owner = request.args.get('owner')
     string = request.args.get('query')
     
     sales = db.session.query(Sale).filter(Sale.owner == owner).count()
-    res = []
-    out = {}
+    out = None
     if sales == 0:
-        body = json.dumps({"result": "error",
+        body = fastjson.dumps({"result": "error",
                            "message": "Account required to make queries"})
         return (body, 200, {'Content-length': len(body),
                             'Content-type': 'application/json',
                            }
                )
     elif string == 'getbydepth':
-        depth = request.args.get('depth')
-        res = rpc.get('getblockcount')
-        if 'output' in res and 'result' in res['output']:
-            height = res['output']['result'] - int(depth)
+        out = block_cache.by_depth(request.args.get('depth'))
     elif string == 'getbyheight':
-        height = request.args.get('height')
+        out = block_cache.by_height(request.args.get('height'))
     elif string == 'getbyhash':
-        res = rpc.get('getblockheader', [request.args.get('hash')])
-        height = res['output']['result']['height']
+        out = block_cache.by_hash(request.args.get('hash'))
     elif string == 'sendrawtransaction':
+        rpc = RPC.shared(RPCUSER, RPCPASS, SERVER, RPCPORT, timeout=RPCTIMEOUT)
         tx = request.args.get('tx')
         res = rpc.get('sendrawtransaction', [str(tx)])
         if 'output' in res and 'result' in res['output']:
-            out['txid'] = res['output']['result']
-            body = json.dumps(out)
+            body = fastjson.dumps({'txid': res['output']['result']})
             return (body, 200, {'Content-length': len(body), 'Content-type': 'application/json', })
         
-    res = rpc.get('getblockhash', [int(height)])
-    out['height'] = height
-    if 'output' in res and 'result' in res['output']:
-        out['hash'] = res['output']['result']
-        res = rpc.get('getblockheader', [str(out['hash'])])
-        out['time'] = res['output']['result']['time']
-        out['height'] = height
-        body = json.dumps(out)
+    if out:
+        body = fastjson.dumps(out)
     else:
-        body = json.dumps({"result": "error",
+        body = fastjson.dumps({"result": "error",
                            "message": "Invalid depth or RPC error"})
     return (body, 200, {'Content-length': len(body),
                         'Content-type': 'application/json',
@@ -656,33 +671,38 @@ def query_bitcoin():
            )
 
 def get_by_depth(depth):
-    rpc = RPC(RPCUSER, RPCPASS, SERVER, RPCPORT)
-    res = rpc.get('getblockcount')
-    if 'output' in res and 'result' in res['output']:
-        height = res['output']['result'] - int(depth)
-    else:
-        return None
-    res = rpc.get('getblockhash', [height])
-    out = {}
-    if 'output' in res and 'result' in res['output']:
-        out['hash'] = res['output']['result']
-        res = rpc.get('getblockheader', [out['hash']])
-        out['time'] = res['output']['result']['time']
-        out['height'] = height
-    return out
+    return block_cache.by_depth(depth)
 
-if __name__ == '__main__':
-    if DEBUG:
-        app.debug = True
-
-    rpc = RPC(RPCUSER, RPCPASS, SERVER, RPCPORT)
+def check_core():
+    '''Enable the Bitcoin Core routes if bitcoind answers.'''
+    global core_enabled
+    rpc = RPC.shared(RPCUSER, RPCPASS, SERVER, RPCPORT, timeout=RPCTIMEOUT)
     try:
         rpc.get('getblockcount')
         core_enabled = CORE_ENABLED
     except:
         core_enabled = False
-
     print("Core enabled: " + str(core_enabled))
 
+def after_fork():
+    '''Per-worker setup when causeway.py forks this app: drop connections and
+    threads inherited from the master.'''
+    db.engine.dispose()
+    RPC.shared(RPCUSER, RPCPASS, SERVER, RPCPORT, timeout=RPCTIMEOUT).close()
+    if core_enabled:
+        block_cache.start()
+
+# every route is registered by now
+with app.test_request_context():
+    INFO_RESPONSE = static_response(route_links(), indent=2)
+
+if __name__ == '__main__':
+    if DEBUG:
+        app.debug = True
+
+    check_core()
+    if core_enabled:
+        block_cache.start()
+
     app.run(host='0.0.0.0', port=(os.environ.get('SERVER_PORT', SERVER_PORT)))
     #app.run(host='127.0.0.1', port=SERVER_PORT)
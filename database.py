@@ -0,0 +1,114 @@
+'''
+The one Flask app, SQLAlchemy handle and engine each Causeway process uses.
+
+cserver, models, monitor and indexer all import app and db from here, so a
+process has a single connection pool configured for its backend:
+
+SQLite      pooled connections (instead of one per request), each opened with
+            WAL journaling, synchronous=NORMAL, a memory map and a busy
+            timeout so readers don't block the writer
+PostgreSQL  a sized pool with overflow, pre-ping to drop dead connections and
+            periodic recycling
+
+The pool times how long requests wait for a connection; /status reports it.
+'''
+import sqlite3
+import threading
+import time
+
+from flask import Flask
+from flask.ext.sqlalchemy import SQLAlchemy as _SQLAlchemy, BaseQuery
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from settings import DATABASE_URI, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT
+from settings import SQLITE_MMAP_SIZE, SQLITE_BUSY_TIMEOUT
+
+# run on every new SQLite connection, here and in aserver's aiosqlite pool
+SQLITE_PRAGMAS = ('PRAGMA journal_mode=WAL',
+                  'PRAGMA synchronous=NORMAL',
+                  'PRAGMA mmap_size=%d' % SQLITE_MMAP_SIZE,
+                  'PRAGMA busy_timeout=%d' % SQLITE_BUSY_TIMEOUT,
+                 )
+
+
+class TimedPool(QueuePool):
+    '''QueuePool that records how long each checkout waited for a connection.'''
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            waited = time.time() - start
+            with self.stats_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+    def stats(self):
+        with self.stats_lock:
+            return {'size': self.size(),
+                    'checked_out': self.checkedout(),
+                    'overflow': self.overflow(),
+                    'checkouts': self.checkouts,
+                    'wait_avg_ms': round(1000 * self.wait_total / self.checkouts, 3) if self.checkouts else 0,
+                    'wait_max_ms': round(1000 * self.wait_max, 3),
+                   }
+
+
+@event.listens_for(TimedPool, 'connect')
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def engine_options(uri):
+    '''create_engine() keyword arguments for uri's backend.'''
+    url = make_url(uri)
+    options = {'poolclass': TimedPool,
+               'pool_size': DB_POOL_SIZE,
+               'max_overflow': DB_MAX_OVERFLOW,
+               'pool_timeout': DB_POOL_TIMEOUT,
+              }
+    if url.drivername.startswith('sqlite'):
+        if url.database in (None, '', ':memory:'):
+            return {}       # one shared in-memory connection, leave it alone
+        # a connection is only ever used by one thread at a time through the pool
+        options['connect_args'] = {'check_same_thread': False}
+    elif url.drivername.startswith('postgres'):
+        options['pool_pre_ping'] = True
+        options['pool_recycle'] = 3600
+    return options
+
+
+class SQLAlchemy(_SQLAlchemy):
+    '''Flask-SQLAlchemy building its engine with engine_options().'''
+
+    def apply_driver_hacks(self, app, info, options):
+        _SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        options.update(engine_options(info))
+
+
+def pool_stats():
+    '''Connection pool counters for /status, or None if the pool isn't timed.'''
+    pool = db.engine.pool
+    return pool.stats() if isinstance(pool, TimedPool) else None
+
+
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# db.session.query() returns BaseQuery too, so indexer lookups can paginate()
+db = SQLAlchemy(app, session_options={'query_cls': BaseQuery})
@@ -4,10 +4,95 @@ SERVER_PORT = 2016
  
 DATABASE_URI = 'sqlite:////home/cw/causeway/causeway.db'
 
+# Connection pool per process: kept-open connections, extra ones allowed under
+# load, and seconds to wait for a free connection before failing the request
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_POOL_TIMEOUT = 30
+
+# Prepared statements kept per PostgreSQL connection by the asyncio server
+DB_STATEMENT_CACHE_SIZE = 256
+
+# SQLite only: bytes of the database file to memory map, and milliseconds to
+# wait for a lock before giving up
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_BUSY_TIMEOUT = 5000
+
 DEBUG = False
 
+# causeway.py serve: worker processes (0 = one per CPU core), requests before a
+# worker is replaced (0 = never), and a file to write the master pid to once ready
+WORKERS = 0
+MAX_REQUESTS = 10000
+READY_FILE = ''
+
 DATA_DIR = ''
 
+# Maximum number of keys accepted by one /mget request
+MGET_MAX_KEYS = 1000
+
+# /get read cache: bytes of values kept per process, seconds a cached value is
+# trusted (writes from other worker processes show up after at most this long),
+# and an optional shared tier, e.g. 'redis://localhost:6379/0', with its own expiry
+KV_CACHE_BYTES = 64 * 1024 * 1024
+KV_CACHE_TTL = 5
+KV_CACHE_SHARED = ''
+KV_CACHE_SHARED_TTL = 300
+
+# /query results per page by default, and the most a client may ask for
+QUERY_PAGE_SIZE = 100
+QUERY_MAX_PAGE_SIZE = 500
+
+# Seconds clients and proxies may reuse a /get or /query response before
+# revalidating it with its ETag
+GET_MAX_AGE = 0
+QUERY_MAX_AGE = 0
+
+# Number of signature verification results kept in memory
+VERIFY_CACHE_SIZE = 4096
+
+# Compress new values of at least COMPRESSION_MIN_SIZE bytes: 'gzip', 'zstd'
+# (needs zstandard; COMPRESSION_DICT may name a dictionary from
+# causeway.py train-dict), or None to store them plain. zstd values can only
+# be read with the dictionary they were compressed with, so keep it once set.
+COMPRESSION = None
+COMPRESSION_MIN_SIZE = 512
+COMPRESSION_DICT = None
+
+# Values of at least SEGMENT_MIN_SIZE bytes are kept in append-only segment
+# files under DATA_DIR/segments instead of the database, None to keep them
+# all in the database. A segment is closed at SEGMENT_SIZE bytes. monitor.py
+# compacts segments whose live bytes fall below SEGMENT_COMPACT_RATIO every
+# SEGMENT_COMPACT_INTERVAL seconds, 0 to leave it to causeway.py compact
+SEGMENT_MIN_SIZE = None
+SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENT_COMPACT_RATIO = 0.5
+SEGMENT_COMPACT_INTERVAL = 3600
+
+# Segments written to in the last SEGMENT_COMPACT_GRACE seconds are left for
+# the next compaction, as their appends may not be committed yet, and retired
+# segments are deleted no sooner, so requests still using them can finish
+SEGMENT_COMPACT_GRACE = 600
+
+# Response JSON encoder: 'orjson', 'json' (standard library), or 'auto' for
+# orjson when it is installed
+JSON_ENCODER = 'auto'
+
+# Key recovery backend: 'bitcoinlib' (python-bitcoinlib), 'native' (bitcoinsig.py, on
+# libsecp256k1 if coincurve is installed, else pure Python and slower than bitcoinlib),
+# or 'auto' for 'native' when coincurve is installed and 'bitcoinlib' otherwise
+VERIFY_ENGINE = 'auto'
+
+# Worker processes for signature verification, 0 to verify in the request thread
+VERIFY_WORKERS = 2
+
+# Seconds an issued nonce stays valid, and most nonces outstanding per owner
+NONCE_TTL = 3600
+NONCE_WINDOW = 64
+
+# Database connections per process for the asyncio server (aserver.py)
+ASYNC_POOL_SIZE = 10
+
 # Price in BTC for 1MB storage and 50MB transfer
 PRICE = 0.001
 
@@ -17,8 +102,16 @@ SERVER = '127.0.0.1'
 RPCPORT = 8332
 RPCUSER = 'bitcoinrpc'
 RPCPASS = 'fill in with password from bitcoin.conf'
+RPCTIMEOUT = 30     # seconds
 TESTNET = False
 
+# Seconds between chain tip checks, and number of block headers kept in memory
+BLOCK_POLL_INTERVAL = 30
+BLOCK_CACHE_SIZE = 2048
+
+# Seconds between bucket usage reconciliations in monitor.py, 0 to disable
+RECONCILE_INTERVAL = 3600
+
 # Minimum number of confirmations to consider a payment good 
 MINCONF = 1
 
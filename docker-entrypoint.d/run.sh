@@ -1,3 +1,3 @@
 #!/bin/sh
 
-python3 cserver.py
+exec python3 causeway.py serve
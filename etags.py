@@ -0,0 +1,46 @@
+'''
+HTTP validators for /get and /query.
+
+A /get ETag is the sha256 of the stored value, computed when it is written
+(Kv.digest). A /query ETag hashes the request with the version stamp of the
+document types the query can return (indexer.collection_version) and the
+block_info it reports, so an unchanged result is answered 304 before the
+query runs.
+'''
+import hashlib
+import json
+
+
+def quote(digest):
+    '''Strong ETag header value for a digest.'''
+    return '"%s"' % digest
+
+
+def query_etag(query_string, version, block_info):
+    '''ETag for a /query response.'''
+    h = hashlib.sha256(query_string)
+    h.update(('\n%d\n' % version).encode('ascii'))
+    h.update(json.dumps(block_info, sort_keys=True).encode('utf-8'))
+    return quote(h.hexdigest()[:32])
+
+
+def matches(if_none_match, etag):
+    '''True if an If-None-Match header value names etag.'''
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        # If-None-Match uses the weak comparison
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def cache_control(max_age):
+    '''Cache-Control for a validated response: caches may reuse it for
+    max_age seconds, then must revalidate with the ETag.'''
+    return 'public, max-age=%d, must-revalidate' % max_age
@@ -0,0 +1,54 @@
+'''
+JSON encoding for response bodies.
+
+dumps() returns UTF-8 bytes, ready to send and to measure for Content-length.
+It uses orjson when that is installed and JSON_ENCODER allows it, otherwise
+the standard library json module. Both produce valid JSON, but they differ
+in whitespace, in escaping non-ASCII characters, and in the dict keys they
+take: json writes None, numbers and booleans as string keys ("null", "1",
+"true") where orjson raises TypeError, so keys must be strings.
+
+/get bodies are spliced together from a fragment stored with each value
+(Blob.value_json), so the value itself is encoded once, on write.
+'''
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENCODERS = ('auto', 'orjson', 'json')
+encoder = 'orjson' if orjson is not None else 'json'
+
+
+def set_encoder(name):
+    '''Select 'orjson', 'json' or 'auto' (orjson if installed).'''
+    global encoder
+    if name not in ENCODERS:
+        raise ValueError("Unknown JSON encoder %r" % name)
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson' and orjson is None:
+        raise ValueError("JSON_ENCODER is 'orjson' but orjson is not installed")
+    encoder = name
+
+
+def dumps(obj, indent=None):
+    '''Encode obj; any indent means orjson's two spaces.'''
+    if encoder == 'orjson':
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=indent).encode('utf-8')
+
+
+def fragment(value):
+    '''A stored value encoded as a JSON string literal, for Blob.value_json.'''
+    return dumps(value).decode('utf-8')
+
+
+def kv_body(key, value_json):
+    '''{"key": key, "value": value} from a stored value_json fragment, as a
+    string or already encoded bytes (or a memoryview of them).'''
+    if isinstance(value_json, str):
+        value_json = value_json.encode('utf-8')
+    return b''.join((b'{"key": ', dumps(key), b', "value": ', value_json, b'}'))
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+'''
+Write-time field index for Rein documents.
+
+Each stored value is scanned once on /put for its document type lines
+("Rein Job", "Rein Bid", ...) and the header fields /query filters on. The
+results go into the docindex table so queries become indexed lookups instead
+of LIKE scans over every kv row. Values are stored and looked up lowercase
+(fold), so lookups ignore case as the old ILIKE scans, and LIKE on SQLite,
+did. They match whole field values, where the scans matched any line
+starting with the value.
+
+Enrollment User and Contact fields are additionally broken into lowercase
+trigrams so get_user can answer partial, case-insensitive matches from the
+index as well.
+
+Every write also bumps a per (testnet, document type) counter in docversion.
+A /query's version is the sum of the counters for the types it can match, so
+it changes whenever any document the query could return is written or deleted.
+
+Usage (backfill existing rows):
+    python3 indexer.py
+'''
+from sqlalchemy import func, or_, and_
+from sqlalchemy.dialects import postgresql
+
+import armor
+import blobs
+from models import db, Kv, Blob, DocIndex, Trigram, DocVersion
+
+# header fields that /query resolves through the index
+INDEXED_FIELDS = ('Job ID',
+                  'Job creator public key',
+                  'Worker public key',
+                  'Mediator public key',
+                  'Secure Identity Number',
+                  'User msin',
+                  'Rater msin',
+                  'Master signing address',
+                  'Delegate signing address',
+                  'Willing to mediate',
+                  'User',
+                  'Contact',
+                 )
+
+# fields get_user searches, in ranking order; the last two accept partial matches
+USER_FIELDS = ('Secure Identity Number',
+               'Master signing address',
+               'Delegate signing address',
+               'User',
+               'Contact',
+              )
+PARTIAL_FIELDS = ('User', 'Contact')
+ENROLLMENT = 'Rein User Enrollment'
+GRAM = 3
+
+DOC_TYPE = 'Document type'
+SIG_ADDRESS = 'Signature address'
+MAX_VALUE = 255
+
+# document types each /query can return; missing queries filter on fields
+# only and may match any type
+QUERY_TYPES = {'jobs': ('Rein Job',),
+               'bids': ('Rein Bid',),
+               'deliveries': ('Rein Delivery',),
+               'dispute': ('Rein Delivery', 'Rein Offer'),
+               'get_user_ratings': ('Rein Rating',),
+               'get_user_name': (ENROLLMENT,),
+               'get_user': (ENROLLMENT,),
+              }
+
+
+def parse_fields(value):
+    '''Return (doc_type, [(field, value), ...]) for a stored document.
+
+    doc_type is the first "Rein ..." line. Every type line, nested or not, is
+    also returned as a "Document type" field so lookups behave like the old
+    LIKE '%\\nRein Job%' matches.'''
+    doc = armor.parse(value)
+    doc_type = None
+    fields = []
+    for line in (doc.body if doc.root is not None else doc.lines):
+        line = line.strip()
+        if line.startswith('Rein '):
+            if doc_type is None:
+                doc_type = line
+            fields.append((DOC_TYPE, line))
+        elif ': ' in line:
+            field, val = line.split(': ', 1)
+            if field in INDEXED_FIELDS:
+                fields.append((field, val.strip()))
+    if doc.root is not None and doc.root.signed:
+        fields.append((SIG_ADDRESS, doc.root.signature_address))
+    return doc_type, fields
+
+
+def fold(value):
+    '''The lowercase form field values are indexed and looked up in.'''
+    return value.lower() if value is not None else None
+
+
+def trigrams(text):
+    '''Set of lowercase character trigrams in text.'''
+    text = text.lower()
+    return set(text[i:i + GRAM] for i in range(len(text) - GRAM + 1))
+
+
+def index_rows(key, testnet, value):
+    '''Column dicts for the docindex and trigram rows of one document.'''
+    doc_type, fields = parse_fields(value or '')
+    seen = set()
+    grams = set()
+    docs = []
+    for field, val in fields:
+        val = fold(val)[:MAX_VALUE]
+        if (field, val) in seen:
+            continue
+        seen.add((field, val))
+        docs.append({'key': key, 'testnet': testnet, 'doc_type': doc_type,
+                     'field': field, 'value': val})
+        if doc_type == ENROLLMENT and field in PARTIAL_FIELDS:
+            grams.update((field, g) for g in trigrams(val))
+    return docs, [{'key': key, 'testnet': testnet, 'field': field, 'gram': gram}
+                  for field, gram in grams]
+
+
+def row_types(docs):
+    '''Document types named by index_rows() docindex rows.'''
+    return set(row['value'] for row in docs if row['field'] == DOC_TYPE)
+
+
+def indexed_types(session, key):
+    '''Query of the type lines indexed under key.'''
+    return session.query(DocIndex.value).filter(DocIndex.key == key, DocIndex.field == DOC_TYPE)
+
+
+def version_bumps(dialect, testnet, doc_types):
+    '''Statements adding one to the docversion rows of doc_types.
+
+    Untyped documents count under ''. Rows are created on first use and
+    updated in a fixed order so concurrent writers don't deadlock.'''
+    table = DocVersion.__table__
+    stmts = []
+    for doc_type in sorted(doc_types or ('',)):
+        row = {'testnet': bool(testnet), 'doc_type': doc_type, 'version': 0}
+        if dialect == 'postgresql':
+            stmts.append(postgresql.insert(table).values(**row).on_conflict_do_nothing())
+        else:
+            stmts.append(table.insert().prefix_with('OR IGNORE').values(**row))
+        stmts.append(table.update()
+                          .where(and_(table.c.testnet == bool(testnet),
+                                      table.c.doc_type == doc_type))
+                          .values(version=table.c.version + 1))
+    return stmts
+
+
+def collection_version(session, testnet, query):
+    '''Query of the version stamp for a /query name: the sum of the docversion
+    counters it depends on. Pass testnet=None for both networks.'''
+    q = session.query(func.coalesce(func.sum(DocVersion.version), 0))
+    if testnet is not None:
+        q = q.filter(DocVersion.testnet == testnet)
+    if query in QUERY_TYPES:
+        q = q.filter(DocVersion.doc_type.in_([fold(t) for t in QUERY_TYPES[query]]))
+    return q
+
+
+def matching(session, testnet, field, value):
+    '''Subquery of kv keys having field == value (value may be a list),
+    ignoring case.'''
+    q = session.query(DocIndex.key).filter(DocIndex.field == field)
+    if testnet is not None:
+        q = q.filter(DocIndex.testnet == testnet)
+    if isinstance(value, (list, tuple)):
+        return q.filter(DocIndex.value.in_([fold(v) for v in value]))
+    return q.filter(DocIndex.value == fold(value))
+
+
+def lookup(session, testnet, *terms):
+    '''Kv query for documents matching all (field, value) terms.
+
+    Pass testnet=None to search both networks.'''
+    q = session.query(Kv)
+    if testnet is not None:
+        q = q.filter(Kv.testnet == testnet)
+    for field, value in terms:
+        q = q.filter(Kv.key.in_(matching(session, testnet, field, value)))
+    return q
+
+
+def dispute_lookup(session, job_ids):
+    '''Kv query for the dispute view of job_ids, both networks: the documents
+    with a Rein Delivery line for each job id, or its Rein Offer documents
+    if it has no delivery.'''
+    delivered = matching(session, None, DOC_TYPE, 'Rein Delivery')
+    offered = matching(session, None, DOC_TYPE, 'Rein Offer')
+    delivered_jobs = matching(session, None, 'Job ID', job_ids) \
+                         .filter(DocIndex.key.in_(delivered)) \
+                         .with_entities(DocIndex.value)
+    undelivered = matching(session, None, 'Job ID', job_ids) \
+                      .filter(~DocIndex.value.in_(delivered_jobs))
+    return lookup(session, None, ('Job ID', job_ids)) \
+               .filter(or_(Kv.key.in_(delivered),
+                           and_(Kv.key.in_(offered), Kv.key.in_(undelivered))))
+
+
+def page(q, cursor=None, limit=100):
+    '''Keyset page of a lookup() query.
+
+    Selects key, seq and the blob columns (read with blobs.value_of) of the
+    rows inserted after cursor, oldest first, plus one row to tell whether
+    another page follows.'''
+    q = q.with_entities(Kv.key, Kv.seq, *blobs.READ_COLUMNS).join(Blob, Blob.digest == Kv.digest)
+    if cursor:
+        q = q.filter(Kv.seq > cursor)
+    return q.order_by(Kv.seq).limit(limit + 1)
+
+
+def page_rows(rows, limit):
+    '''Split page() results into (rows, cursor of the next page or None).'''
+    if len(rows) > limit:
+        return rows[:limit], str(rows[limit - 1].seq)
+    return rows, None
+
+
+def user_matches(session, testnet, text):
+    '''Query of (key, field, value) index rows that may match text.'''
+    exact = and_(DocIndex.field.in_(USER_FIELDS[:3]), DocIndex.value == fold(text))
+    grams = trigrams(text)
+    if grams:
+        candidates = session.query(Trigram.key).filter(Trigram.testnet == testnet,
+                                                       Trigram.gram.in_(grams)) \
+                                               .group_by(Trigram.key, Trigram.field) \
+                                               .having(func.count(Trigram.gram.distinct()) == len(grams))
+        partial = and_(DocIndex.field.in_(PARTIAL_FIELDS), DocIndex.key.in_(candidates))
+    else:
+        # too short for a trigram, scan the indexed field values only
+        partial = and_(DocIndex.field.in_(PARTIAL_FIELDS), DocIndex.value.ilike('%' + text + '%'))
+    return session.query(DocIndex.key, DocIndex.field, DocIndex.value) \
+                  .filter(DocIndex.testnet == testnet,
+                          DocIndex.doc_type == ENROLLMENT,
+                          or_(exact, partial))
+
+
+def rank_users(rows, text, limit=20):
+    '''Order user_matches() rows best first and return their keys.'''
+    needle = text.lower()
+    ranked = {}
+    for key, field, value in rows:
+        value = value.lower()
+        if field in PARTIAL_FIELDS and needle not in value:
+            continue
+        rank = (USER_FIELDS.index(field), value != needle, not value.startswith(needle), len(value))
+        if key not in ranked or rank < ranked[key]:
+            ranked[key] = rank
+    return sorted(ranked, key=ranked.get)[:limit]
+
+
+def answer(session, string, testnet, args, cursor=0, limit=100):
+    '''Steps (see writes.py) for the results of a /query, returning
+    (results, cursor of the next page or None).
+
+    args are the request's query arguments, read like Flask's request.args.'''
+    res = []
+    found = None
+    keyed = False       # return {key, value} objects rather than bare values
+    next_cursor = None
+
+    if string == 'mediators':
+        found = lookup(session, testnet, ('Willing to mediate', 'True'))
+    elif string == 'jobs':
+        found = lookup(session, testnet, (DOC_TYPE, 'Rein Job'))
+    elif string == 'bids':
+        found = lookup(session, testnet, (DOC_TYPE, 'Rein Bid'))
+    elif string == 'deliveries':
+        found = lookup(session, testnet, (DOC_TYPE, 'Rein Delivery'),
+                       ('Job creator public key', args.get('job_creator')))
+    elif string == 'in-process':
+        found = lookup(session, testnet, ('Worker public key', args.get('worker')))
+    elif string == 'review':
+        found = lookup(session, testnet, ('Mediator public key', args.get('mediator')))
+    elif string == 'by_job_id':
+        found = lookup(session, testnet, ('Job ID', args.get('job_ids', '').split(',')))
+    elif string == 'dispute':
+        # deliveries for each job id, or its offers if it has no delivery
+        found = dispute_lookup(session, args.get('job_ids', '').split(','))
+    elif string == 'get_user_ratings':
+        dest = args.get('dest')
+        source = args.get('source')
+        if not dest and not source:
+            res.append('error')
+        else:
+            terms = [(DOC_TYPE, 'Rein Rating')]
+            if dest:
+                terms.append(('User msin', dest))
+            if source:
+                terms.append(('Rater msin', source))
+            found = lookup(session, testnet, *terms)
+            keyed = True
+    elif string == 'get_user_name':
+        msin = args.get('msin')
+        if not msin:
+            res.append('error')
+        else:
+            found = lookup(session, testnet, (DOC_TYPE, ENROLLMENT), ('Secure Identity Number', msin))
+            keyed = True
+    elif string == 'get_user':
+        search_input = args.get('search_input')
+        if not search_input:
+            res.append('error')
+        else:
+            # SIN, master address, delegate address, then partial User/Contact matches;
+            # ranked rather than inserted, so the cursor counts ranked results
+            keys = rank_users((yield user_matches(session, testnet, search_input)),
+                              search_input, cursor + limit + 1)
+            if len(keys) > cursor + limit:
+                next_cursor = str(cursor + limit)
+            keys = keys[cursor:cursor + limit]
+            values = {}
+            if keys:
+                values = dict((row.key, blobs.value_of(row))
+                              for row in (yield session.query(Kv.key, *blobs.READ_COLUMNS)
+                                                       .join(Blob, Blob.digest == Kv.digest)
+                                                       .filter(Kv.key.in_(keys))))
+            res = [values[key] for key in keys if key in values]
+
+    if found is not None:
+        rows, next_cursor = page_rows((yield page(found, cursor, limit)), limit)
+        res = [{'key': row.key, 'value': blobs.value_of(row)} if keyed else blobs.value_of(row)
+               for row in rows]
+    return res, next_cursor
+
+
+def backfill(session, batch=500):
+    '''Rebuild the index for every stored kv row.'''
+    # writes builds on this module
+    from writes import run, index
+    dialect = session.get_bind().dialect.name
+    keys = [row[0] for row in session.query(Kv.key)]
+    for i in range(0, len(keys), batch):
+        for kv in session.query(Kv.key, Kv.testnet, *blobs.READ_COLUMNS) \
+                         .join(Blob, Blob.digest == Kv.digest) \
+                         .filter(Kv.key.in_(keys[i:i + batch])):
+            run(session, index(dialect, kv.key, kv.testnet, blobs.value_of(kv)))
+        session.commit()
+    return len(keys)
+
+
+if __name__ == '__main__':
+    DocIndex.__table__.create(db.engine, checkfirst=True)
+    Trigram.__table__.create(db.engine, checkfirst=True)
+    DocVersion.__table__.create(db.engine, checkfirst=True)
+    print("Indexed %d documents" % backfill(db.session))
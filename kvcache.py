@@ -0,0 +1,133 @@
+'''
+Read cache for /get.
+
+Entries are (value, digest, gzip data, segment pointer) records, so a hit can
+also answer a conditional GET or one that accepts gzip, and a value kept in
+a segment file is cached as its location only. They are kept in a
+per-process LRU bounded by the bytes they hold, not by entry count, so a few
+large documents can't crowd out the hot set. Writes through /put, /mput and
+/delete invalidate the key in the writing process. Other worker processes
+can't see that, so local entries also expire after KV_CACHE_TTL seconds.
+
+With KV_CACHE_SHARED set to a redis:// URL, a local miss is looked up in
+redis before the database, and writes delete the key there too, so workers
+share one warm copy of each document.
+'''
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# rough per-entry bookkeeping cost on top of key and value
+OVERHEAD = 100
+
+
+class KvCache(object):
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=5, shared=None, shared_ttl=300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl                  # seconds a local entry is trusted, 0 forever
+        self.shared_ttl = shared_ttl
+        self.shared = None
+        if shared:
+            import redis
+            self.shared = redis.StrictRedis.from_url(shared)
+        self.entries = OrderedDict()    # key -> (record, size, expiry)
+        self.bytes = 0
+        self.writes = 0                 # bumped by every invalidation
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _shared_key(key):
+        # v3: records carry the gzip data and segment pointer as well
+        return 'cw:kv3:' + key
+
+    def get(self, key):
+        '''Cached record for key, or None.'''
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if not entry[2] or entry[2] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self._drop(key)
+            token = self.writes
+        if self.shared is not None:
+            try:
+                record = self.shared.get(self._shared_key(key))
+                if record is not None:
+                    record = tuple(json.loads(record.decode('utf-8')))
+            except Exception:
+                record = None
+            if record is not None:
+                with self.lock:
+                    self.shared_hits += 1
+                self._store(key, record, token)
+                return record
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def token(self):
+        '''Take before reading the database; pass to fill() afterwards.'''
+        return self.writes
+
+    def fill(self, key, record, token):
+        '''Cache a record (a tuple of strings) just read from the database.
+
+        Skipped if any write happened since token was taken, so a read that
+        raced an update can't cache the old value.'''
+        if self._store(key, record, token) and self.shared is not None:
+            try:
+                self.shared.set(self._shared_key(key), json.dumps(record).encode('utf-8'),
+                                ex=self.shared_ttl or None)
+            except Exception:
+                pass
+
+    def _store(self, key, record, token):
+        size = len(key) + sum(len(part) for part in record) + OVERHEAD
+        if size > self.max_bytes:
+            return False
+        expiry = time.time() + self.ttl if self.ttl else 0
+        with self.lock:
+            if token != self.writes:
+                return False
+            self._drop(key)
+            self.entries[key] = (record, size, expiry)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+        return True
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def invalidate(self, *keys):
+        '''Forget keys after they were written or deleted.'''
+        with self.lock:
+            self.writes += 1
+            for key in keys:
+                self._drop(key)
+        if self.shared is not None and keys:
+            try:
+                self.shared.delete(*[self._shared_key(key) for key in keys])
+            except Exception:
+                pass
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {'entries': len(self.entries),
+                    'bytes': self.bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'shared_hits': self.shared_hits,
+                    'misses': self.misses,
+                    'hit_rate': round(float(self.hits + self.shared_hits) / lookups, 4) if lookups else 0,
+                   }
@@ -0,0 +1,232 @@
+'''
+Schema upgrades for an existing Causeway database.
+
+Each step checks whether it is needed first, so running all of them after
+every upgrade is safe:
+
+    python3 causeway.py migrate
+
+New databases created from schema.sql are already current.
+'''
+from sqlalchemy import func, inspect, table, column
+
+from models import db, Blob, Nonce, Sale, DocIndex, Trigram, DocVersion, content_digest, kv_size
+from writes import run, acquire
+import fastjson
+import indexer
+
+# kv as it was while values were stored inline, before blob_store
+legacy_kv = table('kv', column('key'), column('value'), column('value_json'),
+                  column('digest'), column('size'))
+
+
+def columns(table):
+    return set(c['name'] for c in inspect(db.engine).get_columns(table))
+
+
+def has_table(table):
+    return db.engine.dialect.has_table(db.engine, table)
+
+
+def add_column(table, ddl):
+    db.engine.execute('ALTER TABLE %s ADD COLUMN %s' % (table, ddl))
+
+
+def docversion():
+    '''docversion: per document type write counters for /query ETags.'''
+    if has_table('docversion'):
+        return False
+    DocVersion.__table__.create(db.engine)
+    return True
+
+
+def inline_values():
+    '''True until blob_store has started moving values out of kv.'''
+    return 'value' in columns('kv') and not has_table('blob')
+
+
+def fill_column(name, compute, batch=500):
+    '''Set a kv column to compute(key, value) on every row where it is null,
+    while values are still inline.'''
+    if not inline_values():
+        return False
+    kv = legacy_kv
+    filled = False
+    while True:
+        rows = db.session.execute(kv.select().with_only_columns([kv.c.key, kv.c.value])
+                                    .where(kv.c[name] == None).limit(batch)).fetchall()
+        if not rows:
+            return filled
+        for key, value in rows:
+            db.session.execute(kv.update().where(kv.c.key == key)
+                                 .values({name: compute(key, value or '')}))
+        db.session.commit()
+        filled = True
+
+
+def kv_digest():
+    '''kv.digest: sha256 of each value, the /get ETag.'''
+    added = 'digest' not in columns('kv')
+    if added:
+        add_column('kv', 'digest varchar(64)')
+    return fill_column('digest', lambda key, value: content_digest(value)) or added
+
+
+def kv_value_json():
+    '''kv.value_json: each value pre-encoded for /get.'''
+    if not inline_values():
+        return False
+    added = 'value_json' not in columns('kv')
+    if added:
+        add_column('kv', 'value_json text')
+    return fill_column('value_json', lambda key, value: fastjson.fragment(value)) or added
+
+
+def kv_seq():
+    '''kv.seq: insertion order for /query cursors, numbered on insert.'''
+    if 'seq' in columns('kv'):
+        return False
+    if db.engine.dialect.name == 'postgresql':
+        # existing rows are numbered as the column is added
+        add_column('kv', 'seq bigserial')
+    else:
+        add_column('kv', 'seq integer')
+        db.engine.execute('UPDATE kv SET seq = rowid')
+        db.engine.execute('CREATE TRIGGER kv_seq AFTER INSERT ON kv WHEN new.seq IS NULL '
+                          'BEGIN UPDATE kv SET seq = new.rowid WHERE rowid = new.rowid; END')
+    db.engine.execute('CREATE UNIQUE INDEX ix_kv_seq ON kv (seq)')
+    return True
+
+
+def kv_size_column():
+    '''kv.size: bytes each row is charged, then sale.bytes_used recomputed from it.'''
+    if 'size' in columns('kv'):
+        return False
+    add_column('kv', 'size integer')
+    fill_column('size', kv_size)
+    # usage charged before sizes were tracked has drifted
+    Sale.reconcile(db.session)
+    return True
+
+
+def nonce_window():
+    '''nonce: windows pre-issued by /nonce?count=N, shared by every process.'''
+    if has_table('nonce'):
+        return False
+    Nonce.__table__.create(db.engine)
+    return True
+
+
+def owner_nonce_expires():
+    '''owner.nonce_expires: owner.nonce honoured for NONCE_TTL seconds.
+
+    Nonces stored before this have no expiry and are no longer accepted;
+    the next /nonce replaces them.'''
+    if 'nonce_expires' in columns('owner'):
+        return False
+    add_column('owner', 'nonce_expires integer')
+    return True
+
+
+def sale_owner_price_index():
+    '''ix_sale_owner_price: covers the free bucket count in /request.'''
+    if 'ix_sale_owner_price' in set(i['name'] for i in inspect(db.engine).get_indexes('sale')):
+        return False
+    db.engine.execute('CREATE INDEX ix_sale_owner_price ON sale (owner, price)')
+    return True
+
+
+def blob_codec():
+    '''blob.codec and blob.data: values stored compressed.'''
+    if not has_table('blob') or 'codec' in columns('blob'):
+        return False
+    add_column('blob', 'codec varchar(16)')
+    add_column('blob', 'data %s' % ('bytea' if db.engine.dialect.name == 'postgresql' else 'blob'))
+    return True
+
+
+def blob_segments():
+    '''blob.segment, seg_offset and seg_length: values kept in segment files.'''
+    if not has_table('blob') or 'segment' in columns('blob'):
+        return False
+    add_column('blob', 'segment integer')
+    add_column('blob', 'seg_offset %s' % ('bigint' if db.engine.dialect.name == 'postgresql' else 'integer'))
+    add_column('blob', 'seg_length integer')
+    return True
+
+
+def blob_store(batch=500):
+    '''blob: each distinct value stored once, kv rows pointing at it by digest.
+
+    Moves a batch of inline values at a time and clears them from kv, so an
+    interrupted run picks up where it stopped. Then drops the inline columns.'''
+    kv = legacy_kv
+    if has_table('blob'):
+        if 'value' not in columns('kv'):
+            return False
+        # done, but on an sqlite that kept the emptied columns
+        if not db.session.execute(kv.select().with_only_columns([kv.c.key])
+                                    .where(kv.c.value_json != None).limit(1)).fetchall():
+            return False
+    Blob.__table__.create(db.engine, checkfirst=True)
+    dialect = db.engine.dialect.name
+    while True:
+        rows = db.session.execute(kv.select().with_only_columns([kv.c.key, kv.c.value, kv.c.digest])
+                                    .where(kv.c.value_json != None).limit(batch)).fetchall()
+        if not rows:
+            break
+        for key, value, digest in rows:
+            run(db.session, acquire(dialect, value or '', digest))
+            db.session.execute(kv.update().where(kv.c.key == key)
+                                 .values(value=None, value_json=None))
+        db.session.commit()
+    try:
+        db.engine.execute('ALTER TABLE kv DROP COLUMN value_json')
+        db.engine.execute('ALTER TABLE kv DROP COLUMN value')
+    except Exception:
+        # sqlite before 3.35 can't drop columns; they stay, empty
+        pass
+    return True
+
+
+def document_index():
+    '''docindex and trigram, filled from the stored documents.'''
+    if has_table('docindex') and has_table('trigram'):
+        return False
+    DocIndex.__table__.create(db.engine, checkfirst=True)
+    Trigram.__table__.create(db.engine, checkfirst=True)
+    indexer.backfill(db.session)
+    return True
+
+
+def docindex_casefold():
+    '''docindex values lowercase (indexer.fold), reindexing every document.'''
+    if not has_table('docindex'):
+        return False
+    if not db.session.query(DocIndex.id).filter(DocIndex.value != func.lower(DocIndex.value)).first():
+        return False
+    indexer.backfill(db.session)
+    return True
+
+
+# in order; later steps may rely on earlier ones
+MIGRATIONS = (docversion,
+              kv_digest,
+              kv_value_json,
+              kv_seq,
+              kv_size_column,
+              nonce_window,
+              sale_owner_price_index,
+              blob_codec,
+              blob_segments,
+              blob_store,
+              document_index,
+              owner_nonce_expires,
+              docindex_casefold,
+             )
+
+
+def migrate(out=print):
+    for step in MIGRATIONS:
+        applied = step()
+        out("%-24s %s" % (step.__name__, 'applied' if applied else 'up to date'))
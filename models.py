@@ -1,14 +1,9 @@
 
 from settings import *
 
-from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
+import hashlib
 from datetime import datetime, timedelta
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+from database import db
 
 class Owner(db.Model):
     __tablename__ = 'owner'
@@ -18,6 +13,7 @@ class Owner(db.Model):
     nonce = db.Column(db.String(32), unique=True)
     balance = db.Column(db.Integer)
     bad_attempts = db.Column(db.Integer)
+    nonce_expires = db.Column(db.Integer)   # unix time; see nonces.py
 
     def __init__(self, address, delegate, nonce=None, balance=0, bad_attempts=0):
         self.address = address
@@ -29,27 +25,148 @@ class Owner(db.Model):
     def __repr__(self):
         return '<Owner %r>' % self.address
 
+    @classmethod
+    def with_sales(cls, session, address):
+        '''The owner and all of their sales, from one outer-joined query.
+
+        Returns (owner, [sale, ...]) in sale id order, or (None, []) for an
+        unknown address.'''
+        rows = session.query(cls, Sale).outerjoin(Sale, Sale.owner == cls.address) \
+                      .filter(cls.address == address).order_by(Sale.id).all()
+        if not rows:
+            return None, []
+        return rows[0][0], [s for o, s in rows if s is not None]
+
+class Nonce(db.Model):
+    '''A nonce pre-issued by /nonce?count=N, spent by deleting it; see nonces.py.'''
+    __tablename__ = 'nonce'
+    __table_args__ = (db.Index('ix_nonce_owner_expires', 'owner', 'expires'),)
+
+    nonce = db.Column(db.String(32), primary_key=True)
+    owner = db.Column(db.String(64))
+    expires = db.Column(db.Integer)     # unix time
+
+    def __repr__(self):
+        return '<Nonce %r>' % self.nonce
+
 class Kv(db.Model):
     __tablename__ = 'kv'
+    __table_args__ = (db.Index('ix_kv_seq', 'seq', unique=True),)
 
     key = db.Column(db.String(64), primary_key=True)
-    value = db.Column(db.String(8192))
     owner = db.Column(db.String(64))
     sale = db.Column(db.Integer)        #aka bucket
     testnet = db.Column(db.Boolean)
+    digest = db.Column(db.String(64))   # sha256 of value: the Blob holding it, and the /get ETag
+    # insertion order for /query cursors, set by the database on insert
+    seq = db.Column(db.BigInteger, server_default=db.FetchedValue())
+    size = db.Column(db.Integer)        # bytes charged to the sale, see kv_size()
 
     def __init__(self, key, value, owner, sale, testnet=False):
+        '''The value itself goes in its Blob, see writes.acquire().'''
         self.key = key
-        self.value = value
         self.owner = owner
         self.sale = sale
         self.testnet = testnet
+        self.digest = content_digest(value)
+        self.size = kv_size(key, value)
 
     def __repr__(self):
         return "<Kv %r>" % self.key
 
+class Blob(db.Model):
+    '''A stored value, kept once however many kv rows hold it.'''
+    __tablename__ = 'blob'
+
+    digest = db.Column(db.String(64), primary_key=True)  # content_digest(value)
+    value = db.Column(db.Text)
+    value_json = db.Column(db.Text)     # value encoded as a JSON string, spliced into /get
+    size = db.Column(db.Integer)        # bytes of value
+    refs = db.Column(db.Integer)        # kv rows pointing here
+    # set when the value is stored compressed in data instead, see compress.py
+    codec = db.Column(db.String(16))
+    data = db.Column(db.LargeBinary)
+    # set when the stored bytes are in a segment file instead, see segments.py
+    segment = db.Column(db.Integer)
+    seg_offset = db.Column(db.BigInteger)
+    seg_length = db.Column(db.Integer)
+
+    def __repr__(self):
+        return "<Blob %r refs=%r>" % (self.digest, self.refs)
+
+def kv_size(key, value):
+    '''Bytes a key/value pair counts against its bucket.'''
+    return len(key.encode('utf-8')) + len(value.encode('utf-8'))
+
+def content_digest(value):
+    '''Hex sha256 of a stored value.'''
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+class DocIndex(db.Model):
+    __tablename__ = 'docindex'
+    __table_args__ = (db.Index('ix_docindex_lookup', 'testnet', 'field', 'value', 'doc_type'),
+                      db.Index('ix_docindex_key', 'key'))
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64))      # kv key this row points at
+    testnet = db.Column(db.Boolean)
+    doc_type = db.Column(db.String(64)) # first "Rein ..." line of the document
+    field = db.Column(db.String(64))
+    value = db.Column(db.String(255))  # lowercase, see indexer.fold
+
+    def __init__(self, key, testnet, doc_type, field, value):
+        self.key = key
+        self.testnet = testnet
+        self.doc_type = doc_type
+        self.field = field
+        self.value = value
+
+    def __repr__(self):
+        return "<DocIndex %r %r=%r>" % (self.key, self.field, self.value)
+
+class Trigram(db.Model):
+    __tablename__ = 'trigram'
+    __table_args__ = (db.Index('ix_trigram_gram', 'testnet', 'gram', 'key', 'field'),
+                      db.Index('ix_trigram_key', 'key'))
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64))
+    testnet = db.Column(db.Boolean)
+    field = db.Column(db.String(64))    # User or Contact
+    gram = db.Column(db.String(16))     # lowercase 3-character substring
+
+    def __init__(self, key, testnet, field, gram):
+        self.key = key
+        self.testnet = testnet
+        self.field = field
+        self.gram = gram
+
+    def __repr__(self):
+        return "<Trigram %r %r>" % (self.key, self.gram)
+
+class DocVersion(db.Model):
+    '''Write counter per document type, the version stamp behind /query ETags.'''
+    __tablename__ = 'docversion'
+
+    testnet = db.Column(db.Boolean, primary_key=True)
+    doc_type = db.Column(db.String(64), primary_key=True)  # '' for untyped documents
+    version = db.Column(db.Integer)
+
+    def __init__(self, testnet, doc_type, version=0):
+        self.testnet = testnet
+        self.doc_type = doc_type
+        self.version = version
+
+    def __repr__(self):
+        return "<DocVersion %r %r>" % (self.doc_type, self.version)
+
+BUCKET_SIZE = 1024 * 1024
+
 class Sale(db.Model):
     __tablename__ = 'sale'
+    __table_args__ = (db.Index('ix_sale_owner_created', 'owner', 'created'),
+                      db.Index('ix_sale_owner_price', 'owner', 'price'),
+                     )
 
     id = db.Column(db.Integer, primary_key=True)
     owner = db.Column(db.String(64))    # owner address
@@ -77,12 +194,59 @@ class Sale(db.Model):
         self.id = id
 
     def get_buckets(self):
-        sales = Sale.query.filter_by(owner=self.owner).all()
+        return Sale.buckets(Sale.query.filter_by(owner=self.owner).all())
+
+    @staticmethod
+    def buckets(sales):
+        '''Bucket listing for /buy and /request from already loaded sales.'''
         result = []
         for s in sales:
-            result.append({"id": s.id, "created":str(s.created), "bytes_free": str(1024*1024 - s.bytes_used)})
+            result.append({"id": s.id, "created":str(s.created), "bytes_free": str(BUCKET_SIZE - s.bytes_used)})
         return result
 
+    @classmethod
+    def free_count(cls, session, owner):
+        '''Number of free buckets owner holds; answered from ix_sale_owner_price.'''
+        return session.query(db.func.count()).select_from(cls) \
+                      .filter(cls.owner == owner, cls.price == 0).scalar()
+
+    @classmethod
+    def usage(cls, session):
+        '''(sale id, recorded bytes_used, bytes its kv rows add up to) for
+        every sale, in one grouped query.'''
+        return session.query(cls.id, cls.bytes_used, db.func.coalesce(db.func.sum(Kv.size), 0)) \
+                      .outerjoin(Kv, Kv.sale == cls.id) \
+                      .group_by(cls.id, cls.bytes_used)
+
+    @classmethod
+    def reconcile(cls, session, fix=True):
+        '''Compare each sale's bytes_used with its stored rows and report drift.
+
+        With fix, drifted sales are set to the actual total. The update only
+        applies if bytes_used hasn't changed since it was read, so this can run
+        alongside live writes; a sale skipped that way is caught next time.
+        Returns {'sales', 'drifted', 'drift_bytes', 'fixed', 'worst'}.'''
+        drifted = []
+        sales = 0
+        for sale_id, recorded, actual in cls.usage(session):
+            sales += 1
+            if (recorded or 0) != actual:
+                drifted.append((sale_id, recorded, actual))
+        fixed = 0
+        if fix:
+            for sale_id, recorded, actual in drifted:
+                fixed += session.query(cls).filter(cls.id == sale_id, cls.bytes_used == recorded) \
+                                .update({cls.bytes_used: actual}, synchronize_session=False)
+            session.commit()
+        worst = sorted(drifted, key=lambda d: -abs((d[1] or 0) - d[2]))[:10]
+        return {'sales': sales,
+                'drifted': len(drifted),
+                'drift_bytes': sum((recorded or 0) - actual for sale_id, recorded, actual in drifted),
+                'fixed': fixed,
+                'worst': [{'id': sale_id, 'recorded': recorded, 'actual': actual}
+                          for sale_id, recorded, actual in worst],
+               }
+
     @classmethod
     def get(cls, owner):
         return Sale.query.filter(cls.owner==owner, cls.payment_address != None).all()
@@ -92,6 +256,13 @@ class Sale(db.Model):
         return Sale.query.filter(Sale.owner==owner, Sale.payment_address != None,
                                  Sale.created > datetime.now()-timedelta(days=1), Sale.paid==0).all()
 
+    @staticmethod
+    def recent(sales):
+        '''get_recent() applied to an owner's already loaded sales.'''
+        since = datetime.now()-timedelta(days=1)
+        return [s for s in sales if s.payment_address is not None and not s.paid
+                and s.created is not None and s.created > since]
+
     @classmethod
     def get_unpaid(cls, session):
         return session.query(cls).filter(cls.paid != 1,
@@ -27,16 +27,17 @@ import signal
 from requests.exceptions import ConnectionError
 from time import sleep
 from decimal import *
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from models import Sale
+from database import db
+import blobs
 
 # our configuration file - copy defaultsettings.py to settings.py and edit
 from settings import * 
 from rpc import RPC
 
-# connect to db
-engine = create_engine(DATABASE_URI)
+# connect to db, through the same tuned engine as the server
+engine = db.engine
 DBSession = sessionmaker(bind=engine)
 session = DBSession()
 
@@ -53,7 +54,7 @@ logger.setLevel(logging.INFO)
 class Daemon():
     def __init__(self):
         self.bitcoind_command  = ['bitcoind']
-        self.rpc = RPC(RPCUSER, RPCPASS, SERVER, RPCPORT)
+        self.rpc = RPC.shared(RPCUSER, RPCPASS, SERVER, RPCPORT, timeout=RPCTIMEOUT)
 
     def check(self):
         try:
@@ -76,6 +77,15 @@ class Daemon():
         res = self.rpc.get('getreceivedbyaddress', [address, int(minconf)])
         return res['output']['result']
 
+    def get_received_snapshot(self,minconf):
+        '''Map of address -> total received for every wallet address with funds.'''
+        res = self.rpc.get('listreceivedbyaddress', [int(minconf), False, True])
+        return dict((r['address'], Decimal(str(r['amount']))) for r in res['output']['result'])
+
+    def get_bestblockhash(self):
+        res = self.rpc.get('getbestblockhash')
+        return res['output']['result']
+
     def get_balance(self,minconf):
         res = self.rpc.get('getbalance', ['*', int(minconf)])
         return Decimal(str(res))
@@ -88,29 +98,61 @@ class Daemon():
 
 class Sales :
     def __init__(self):
-        pass
+        self.last_block = None  # best block hash the snapshot was taken at
+        self.received = {}      # address -> amount received at last_block
 
     def enter_deposits(self):
+        '''Mark unpaid orders paid from one wallet snapshot per new block.
+
+        Returns {'orders': checked, 'paid': newly paid, 'seconds': elapsed}.'''
+        start = time.time()
         d = Daemon()
         unpaid = Sale.get_unpaid(session)
         logger.debug(json.dumps({"action":"enter deposits"}))
 
+        # confirmed totals only change with a new block, so reuse the last
+        # snapshot until the tip moves (unconfirmed payments can arrive any time)
+        block = d.get_bestblockhash()
+        if block != self.last_block or MINCONF == 0:
+            self.received = d.get_received_snapshot(MINCONF)
+            self.last_block = block
+
         # get list of pending orders with amounts and addresses
+        paid = 0
         for order in unpaid:
             if order.payment_address is None:
                 continue
             # get total out
             total = Decimal(str(order.price))
             address = order.payment_address
-            received = d.get_receivedbyaddress(address,MINCONF)
-            logger.info(json.dumps({"action":"check received", "expected": str(total), "received": received, "address": address}))
+            received = self.received.get(address, Decimal(0))
+            logger.info(json.dumps({"action":"check received", "expected": str(total), "received": str(received), "address": address}))
             if( received >= total ):
                 logger.info(json.dumps({"action":"payment complete", "order_id": str(order.id)}))
                 # do things when payment received - mark a bucket paid, send an email, etc.
                 order.paid = True
+                order.received = str(received)
                 session.add(order)
+                paid += 1
         session.commit()
 
+        stats = {'orders': len(unpaid), 'paid': paid, 'seconds': round(time.time() - start, 3)}
+        logger.info(json.dumps(dict(action="cycle", block=block, **stats)))
+        return stats
+
+    def reconcile_usage(self):
+        '''Recompute every sale's bytes_used from its stored rows and log any drift.'''
+        report = Sale.reconcile(session)
+        level = logging.WARNING if report['drifted'] else logging.INFO
+        logger.log(level, json.dumps(dict(action="reconcile usage", **report)))
+        return report
+
+    def compact_segments(self):
+        '''Reclaim segment file space left by deleted values and log it.'''
+        report = blobs.compact(session)
+        logger.info(json.dumps(dict(action="compact segments", **report)))
+        return report
+
 
 if __name__ == "__main__":
     def signal_handler(signal, frame):
@@ -123,9 +165,17 @@ if __name__ == "__main__":
     d = Daemon()
     s = Sales()
     refreshcount = 0
+    last_reconcile = 0
+    last_compact = 0
     while(1):
         d.check()
         s.enter_deposits()
+        if RECONCILE_INTERVAL and time.time() - last_reconcile >= RECONCILE_INTERVAL:
+            s.reconcile_usage()
+            last_reconcile = time.time()
+        if SEGMENT_COMPACT_INTERVAL and time.time() - last_compact >= SEGMENT_COMPACT_INTERVAL:
+            s.compact_segments()
+            last_compact = time.time()
         refreshcount = refreshcount + 1
         REFRESH_PERIOD = 60
         sleep(REFRESH_PERIOD)
@@ -0,0 +1,146 @@
+'''
+Single-use nonces for signed writes.
+
+/nonce hands out one nonce at a time through owner.nonce, and
+/nonce?count=N pre-issues a window of nonces for bulk writers as rows of the
+nonce table. Both are stored with an expiry, owner.nonce_expires and
+nonce.expires, NONCE_TTL seconds after issue, and every server process sees
+them.
+
+A nonce is only ever spent in the database, with one statement per write:
+writes.consume_nonce() clears owner.nonce where it still holds the nonce
+unexpired, or, for a nonce that wasn't owner.nonce, deletes its unexpired
+row, and goes by the row count, so two processes can't both accept it. A
+store in memory alone could not tell them apart under the pre-forking
+server. Nonces this process issued are also remembered in a NonceStore so
+writes.check_nonce() can pass them before signature verification without a
+query; that map is only a cache, and a nonce found there may already have
+been spent by another process.
+
+The statement builders here are run by writes.py.
+'''
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import and_
+
+from models import Owner, Nonce
+
+
+def new_nonce():
+    '''32 hex characters from the OS CSPRNG.'''
+    return secrets.token_hex(16)
+
+
+def set_owner(address, nonce, current, expires):
+    '''Store nonce as owner.nonce until expires, if it still holds current.'''
+    table = Owner.__table__
+    return table.update().where(and_(table.c.address == address, table.c.nonce == current)) \
+                .values(nonce=nonce, nonce_expires=expires)
+
+
+def clear_owner(address, nonce, now):
+    '''Clear owner.nonce if it holds nonce and that hasn't expired.'''
+    table = Owner.__table__
+    return table.update().where(and_(table.c.address == address, table.c.nonce == nonce,
+                                     table.c.nonce_expires > now)) \
+                .values(nonce=None, nonce_expires=None)
+
+
+def owner_live(owner, now):
+    '''True if owner (a row with nonce and nonce_expires) holds a nonce that
+    hasn't expired.'''
+    return bool(owner.nonce) and owner.nonce_expires is not None and owner.nonce_expires > now
+
+
+def add_window(address, fresh, expires):
+    '''Store pre-issued nonces for address.'''
+    return Nonce.__table__.insert().values([{'nonce': nonce, 'owner': address, 'expires': expires}
+                                            for nonce in fresh])
+
+
+def trim_window(address, now, window):
+    '''Delete address's expired nonces and all but the newest window.'''
+    table = Nonce.__table__
+    keep = table.select().with_only_columns([table.c.nonce]) \
+                .where(and_(table.c.owner == address, table.c.expires > now)) \
+                .order_by(table.c.expires.desc()).limit(window)
+    return table.delete().where(and_(table.c.owner == address, ~table.c.nonce.in_(keep)))
+
+
+def take(address, nonce, now):
+    '''Delete a pre-issued nonce that hasn't expired.'''
+    table = Nonce.__table__
+    return table.delete().where(and_(table.c.nonce == nonce, table.c.owner == address,
+                                     table.c.expires > now))
+
+
+def spend(address, nonce, now):
+    '''The statements that use nonce up as owner.nonce and as a pre-issued
+    nonce; the one that changes a row spent it.'''
+    return clear_owner(address, nonce, now), take(address, nonce, now)
+
+
+def outstanding(session, address, nonce, now):
+    '''Query of a pre-issued nonce that hasn't expired.'''
+    return session.query(Nonce.nonce).filter(Nonce.nonce == nonce, Nonce.owner == address,
+                                             Nonce.expires > now)
+
+
+class NonceStore(object):
+    def __init__(self, ttl=3600, window=64):
+        self.ttl = ttl              # seconds a nonce stays valid
+        self.window = window        # most nonces outstanding per owner
+        self.issued = {}            # owner -> OrderedDict(nonce -> expiry)
+        self.lock = threading.Lock()
+
+    def _live(self, owner, now):
+        nonces = self.issued.get(owner)
+        if nonces is None:
+            return None
+        for nonce in [n for n, expiry in nonces.items() if expiry <= now]:
+            del nonces[nonce]
+        if not nonces:
+            del self.issued[owner]
+            return None
+        return nonces
+
+    def issue(self, owner, count=1):
+        '''Issue count fresh nonces for owner, dropping the oldest past the window.
+
+        The caller stores them: one in owner.nonce, several with add_window().'''
+        count = self.count(count)
+        expiry = time.time() + self.ttl
+        fresh = [new_nonce() for _ in range(count)]
+        with self.lock:
+            nonces = self.issued.setdefault(owner, OrderedDict())
+            for nonce in fresh:
+                nonces[nonce] = expiry
+            while len(nonces) > self.window:
+                nonces.popitem(last=False)
+        return fresh
+
+    def count(self, count):
+        '''count clamped to what one /nonce request may issue.'''
+        return max(1, min(int(count), self.window))
+
+    def expires(self, now=None):
+        '''Expiry to store with nonces issued now.'''
+        return int((now or time.time()) + self.ttl)
+
+    def cached(self, owner, nonce):
+        '''True if this process issued nonce for owner and it hasn't expired.'''
+        with self.lock:
+            nonces = self._live(owner, time.time())
+            return bool(nonces) and nonce in nonces
+
+    def discard(self, owner, nonce):
+        '''Forget nonce without requiring it to be outstanding.'''
+        with self.lock:
+            nonces = self.issued.get(owner)
+            if nonces is not None:
+                nonces.pop(nonce, None)
+                if not nonces:
+                    del self.issued[owner]
@@ -1,28 +1,90 @@
 import requests
 import json
+from requests.adapters import HTTPAdapter
+
+
+def _shape(out):
+    '''Wrap one JSON-RPC response the way callers of RPC.get expect.'''
+    return {"output": out, "result": "success"}
+
+
+def _payload(command, params):
+    if params is None:
+        params = []
+    return {
+        "method": command,
+        "params": params,
+        "jsonrpc": "2.0",
+        "id": 0}
 
 
 class RPC(object):
-    def __init__(self, username, password, server, port):
-        self.url = "http://%s:%s@%s:%s/" % (username, password, server, port)
+    '''JSON-RPC client for bitcoind over a pooled keep-alive HTTP session.
+
+    Use RPC.shared() to reuse one client (and its connections) per server.'''
+    _shared = {}
+
+    def __init__(self, username, password, server, port, timeout=30, pool_size=8):
+        self.url = "http://%s:%s/" % (server, port)
         self.headers = {'content-type': 'application/json'}
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+
+    @classmethod
+    def shared(cls, username, password, server, port, **kwargs):
+        '''Return the process-wide client for this server, creating it once.'''
+        key = (username, password, server, port)
+        if key not in cls._shared:
+            cls._shared[key] = cls(username, password, server, port, **kwargs)
+        return cls._shared[key]
 
     def get(self, command, params=None):
-        if params is None:
-            params = []
-        payload = {
-            "method": command,
-	        "params": params,
-            "jsonrpc": "2.0",
-            "id": 0}
-        out = requests.post(self.url, data=json.dumps(payload), headers=self.headers).json()
-
-        try:
-            res = json.loads(out)
-        except:
-            res = {"output": out}
-        res['result'] = 'success'
-        return res
+        out = self.session.post(self.url, data=json.dumps(_payload(command, params)),
+                                timeout=self.timeout).json()
+        return _shape(out)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncRPC(object):
+    '''asyncio variant of RPC, backed by an aiohttp connection pool.'''
+
+    def __init__(self, username, password, server, port, timeout=30, pool_size=8):
+        self.url = "http://%s:%s/" % (server, port)
+        self.headers = {'content-type': 'application/json'}
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.session = None
+
+    def _session(self):
+        if self.session is None:
+            import aiohttp
+            self.session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self.username, self.password),
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def _post(self, payload):
+        async with self._session().post(self.url, data=json.dumps(payload)) as resp:
+            return await resp.json(content_type=None)
+
+    async def get(self, command, params=None):
+        return _shape(await self._post(_payload(command, params)))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
 
 if __name__ == '__main__':
     from settings import *
@@ -5,15 +5,67 @@ CREATE TABLE owner (
     nonce varchar(32),
     balance integer,
     bad_attempts integer,
-    delegate varchar(64));
+    delegate varchar(64),
+    nonce_expires integer);    /* unix time owner.nonce stops being accepted */
+CREATE TABLE nonce (
+    nonce varchar(32) primary key,    /* pre-issued by /nonce?count=N */
+    owner varchar(64),
+    expires integer,       /* unix time */
+    foreign key(owner) references owner(address)
+);
+CREATE INDEX ix_nonce_owner_expires ON nonce (owner, expires);
 CREATE TABLE kv (
     key varchar(64) primary key,
-    value blob,
     owner varchar(64),
     testnet boolean,
     sale integer,    /* which sale/bucket is this stored under */
+    digest varchar(64),    /* sha256 of value: its row in blob, and the /get ETag */
+    seq integer,           /* insertion order for /query cursors, see kv_seq */
+    size integer,          /* bytes charged to the sale */
     foreign key(owner) references owner(address)
 );
+CREATE UNIQUE INDEX ix_kv_seq ON kv (seq);
+CREATE TRIGGER kv_seq AFTER INSERT ON kv WHEN new.seq IS NULL
+BEGIN
+    UPDATE kv SET seq = new.rowid WHERE rowid = new.rowid;
+END;
+CREATE TABLE blob (
+    digest varchar(64) primary key,    /* sha256 of value */
+    value text,
+    value_json text,       /* value encoded as a JSON string, spliced into /get */
+    size integer,          /* bytes of value */
+    refs integer,          /* kv rows pointing here */
+    codec varchar(16),     /* set when value is stored compressed in data, see compress.py */
+    data blob,
+    segment integer,       /* set when the bytes are in a segment file instead, see segments.py */
+    seg_offset integer,
+    seg_length integer
+);
+CREATE TABLE docindex (
+    id integer primary key,
+    key varchar(64),    /* kv key this row points at */
+    testnet boolean,
+    doc_type varchar(64),
+    field varchar(64),
+    value varchar(255)
+);
+CREATE INDEX ix_docindex_lookup ON docindex (testnet, field, value, doc_type);
+CREATE INDEX ix_docindex_key ON docindex (key);
+CREATE TABLE trigram (
+    id integer primary key,
+    key varchar(64),
+    testnet boolean,
+    field varchar(64),  /* User or Contact */
+    gram varchar(16)    /* lowercase 3-character substring */
+);
+CREATE INDEX ix_trigram_gram ON trigram (testnet, gram, key, field);
+CREATE INDEX ix_trigram_key ON trigram (key);
+CREATE TABLE docversion (
+    testnet boolean,
+    doc_type varchar(64),  /* '' for untyped documents */
+    version integer,       /* bumped by every write touching this type */
+    primary key (testnet, doc_type)
+);
 CREATE TABLE wallet (
     address varchar(64) primary key,
     contact varchar(256),
@@ -33,6 +85,8 @@ CREATE TABLE sale (
     received varchar(32),
     foreign key(owner) references owner(address)
 );
+CREATE INDEX ix_sale_owner_created ON sale (owner, created);
+CREATE INDEX ix_sale_owner_price ON sale (owner, price);
 CREATE TABLE log (
     created text,
     ip varchar(45),  /* max length of ipv6 address */
@@ -0,0 +1,152 @@
+'''
+Append-only segment files for large values.
+
+Blobs of at least SEGMENT_MIN_SIZE bytes are written to numbered segment
+files under DATA_DIR/segments and the blob row keeps only (segment, offset,
+length). Reads slice a read-only mmap of the segment, so a value goes from
+the page cache into the response without a database round trip for its
+bytes.
+
+Appends from every worker process go to the newest segment under an flock,
+and a new segment is started once it would pass SEGMENT_SIZE. Deleted blobs
+leave their bytes behind; blobs.compact() copies the live blobs out of
+mostly dead segments and retires them. A retired segment is renamed to .dead
+and only deleted by a later compaction, so a request that read its old
+pointer just before the move can still finish.
+'''
+import fcntl
+import mmap
+import os
+import threading
+import time
+
+# seconds between checks for mapped segments that were deleted; until a map
+# is dropped the disk space of its file can't be reclaimed
+PRUNE_INTERVAL = 60
+
+
+class SegmentStore(object):
+    def __init__(self, path, segment_size=64 * 1024 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        self.maps = {}                  # segment -> mmap
+        self.pruned = time.time()
+        self.unsynced = set()           # segments appended to with sync=False
+        self.lock = threading.Lock()
+
+    def filename(self, segment, dead=False):
+        return os.path.join(self.path, '%08d.seg%s' % (segment, '.dead' if dead else ''))
+
+    def segments(self):
+        '''Numbers of the live segment files, oldest first.'''
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.seg'))
+
+    def active(self):
+        '''The segment appends go to, None before the first.'''
+        segments = self.segments()
+        return segments[-1] if segments else None
+
+    def size(self, segment):
+        return os.path.getsize(self.filename(segment))
+
+    def idle(self, segment, grace):
+        '''True if segment wasn't appended to in the last grace seconds.'''
+        return time.time() - os.path.getmtime(self.filename(segment)) >= grace
+
+    def retired(self, segment):
+        '''True if segment was compacted, so pointers into it are out of date.'''
+        return not os.path.exists(self.filename(segment))
+
+    def append(self, data, sync=True):
+        '''Write data to the active segment and return (segment, offset).
+
+        Synced to disk before returning, so the database row that points at
+        it never outlives the bytes. A batch can pass sync=False and call
+        sync() once before committing.'''
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            segment = self.active() or 1
+            offset = os.path.getsize(self.filename(segment)) \
+                         if os.path.exists(self.filename(segment)) else 0
+            if offset and offset + len(data) > self.segment_size:
+                segment, offset = segment + 1, 0
+            with open(self.filename(segment), 'ab') as f:
+                f.write(data)
+                f.flush()
+                if sync:
+                    os.fsync(f.fileno())
+                else:
+                    self.unsynced.add(segment)
+        return segment, offset
+
+    def sync(self):
+        '''fsync the segments appended to with sync=False.'''
+        for segment in self.unsynced:
+            with open(self.filename(segment), 'ab') as f:
+                os.fsync(f.fileno())
+        self.unsynced = set()
+
+    def read(self, segment, offset, length):
+        '''memoryview of length bytes at offset in segment.'''
+        with self.lock:
+            if time.time() - self.pruned > PRUNE_INTERVAL:
+                self._prune()
+            m = self.maps.get(segment)
+            if m is None or offset + length > len(m):
+                # new segment, or it grew since it was mapped
+                m = self.maps[segment] = self._map(segment)
+        return memoryview(m)[offset:offset + length]
+
+    def _map(self, segment):
+        try:
+            f = open(self.filename(segment), 'rb')
+        except FileNotFoundError:
+            f = open(self.filename(segment, dead=True), 'rb')
+        with f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def retire(self, segment):
+        '''Take a compacted segment out of use; purge() deletes it later.'''
+        os.rename(self.filename(segment), self.filename(segment, dead=True))
+
+    def revive(self, segment):
+        '''Put a retired segment back in use.'''
+        os.rename(self.filename(segment, dead=True), self.filename(segment))
+
+    def dead(self, grace=0):
+        '''Numbers of the segments retired at least grace seconds ago.'''
+        if not os.path.isdir(self.path):
+            return []
+        now = time.time()
+        return sorted(int(name[:-9]) for name in os.listdir(self.path)
+                      if name.endswith('.seg.dead')
+                      # the rename that retired it set ctime
+                      and now - os.path.getctime(os.path.join(self.path, name)) >= grace)
+
+    def purge(self, segments):
+        '''Delete retired segments; returns bytes freed.'''
+        freed = 0
+        for segment in segments:
+            path = self.filename(segment, dead=True)
+            freed += os.path.getsize(path)
+            os.remove(path)
+        with self.lock:
+            self._prune()
+        return freed
+
+    def _prune(self):
+        '''Drop maps of segment files that are gone. Call with lock held.'''
+        self.maps = dict((segment, m) for segment, m in self.maps.items()
+                         if os.path.exists(self.filename(segment))
+                         or os.path.exists(self.filename(segment, dead=True)))
+        self.pruned = time.time()
+
+    def stats(self):
+        segments = self.segments()
+        return {'segments': len(segments),
+                'bytes': sum(self.size(segment) for segment in segments),
+               }
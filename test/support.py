@@ -0,0 +1,58 @@
+'''
+Settings and a scratch database for tests of modules that read settings.
+
+Import this before any of them. It installs a settings module copied from
+default_settings, with the database and DATA_DIR in a temporary directory.
+'''
+import atexit
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import types
+
+import default_settings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIR = tempfile.mkdtemp(prefix='causeway-test-')
+DB_PATH = os.path.join(DIR, 'causeway.db')
+atexit.register(shutil.rmtree, DIR, True)
+
+settings = types.ModuleType('settings')
+settings.__dict__.update((name, value) for name, value in vars(default_settings).items()
+                         if name.isupper())
+settings.DATABASE_URI = 'sqlite:///' + DB_PATH
+settings.DATA_DIR = os.path.join(DIR, 'data')
+# small enough that test documents go to segment files, and fill several
+settings.SEGMENT_MIN_SIZE = 300
+settings.SEGMENT_SIZE = 2048
+sys.modules['settings'] = settings
+
+
+def reset_db():
+    '''Recreate the database from schema.sql and empty DATA_DIR.'''
+    from database import db
+    import blobs
+    db.session.remove()
+    db.engine.dispose()
+    for path in (DB_PATH, DB_PATH + '-wal', DB_PATH + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(settings.DATA_DIR, True)
+    # segments are numbered from 1 again; don't read the old files' maps
+    blobs.store.maps = {}
+    os.makedirs(settings.DATA_DIR)
+    with open(os.path.join(ROOT, 'schema.sql')) as f:
+        conn = sqlite3.connect(DB_PATH)
+        conn.executescript(f.read())
+        conn.close()
+
+
+def signed(*lines):
+    '''An armored document around lines, with a well-formed (not valid) signature.'''
+    return '\n'.join(('-----BEGIN BITCOIN SIGNED MESSAGE-----',) + lines +
+                     ('-----BEGIN SIGNATURE-----',
+                      '1HZwkjkeaoZfTSaJxDw6aKkxp45agDiEzN',
+                      'H' + 'A' * 87,
+                      '-----END BITCOIN SIGNED MESSAGE-----'))
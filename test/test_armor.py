@@ -0,0 +1,136 @@
+'''
+Tests for armor.py: the parser against the regexes validate.py used before it.
+
+    python -m unittest discover -s test
+'''
+import random
+import re
+import unittest
+
+import armor
+import validate
+
+B, S, E = armor.BEGIN, armor.SIGNATURE, armor.END
+
+
+def old_strip_armor(sig, dash_space=False):
+    sig = sig.replace('- ----', '-' * 5) if dash_space else sig
+    sig = re.sub("-{5}BEGIN BITCOIN SIGNED MESSAGE-{5}", "", sig)
+    sig = re.sub(
+        "\n+-{5}BEGIN SIGNATURE-{5}[\n\\dA-z+=/]+-{5}END BITCOIN SIGNED MESSAGE-{5}\n*",
+        "",
+        sig
+    )
+    sig = re.sub("^\n", "", sig)
+    sig = re.sub("\n\n", "", sig)
+    return sig
+
+
+def old_parse_sig(sig):
+    matches = re.finditer("(.+):\\s(.+)\n", sig)
+    ret = {}
+    for match in matches:
+        ret[match.group(1)] = match.group(2)
+    m = re.search(
+        "-{5}BEGIN SIGNATURE-{5}\n([A-z\\d=+/]+)\n([A-z\\d=+/]+)"
+        "\n-{5}END BITCOIN SIGNED MESSAGE-{5}",
+        sig
+    )
+    if m:
+        ret['signature_address'] = m.group(1)
+        ret['signature'] = m.group(2)
+    else:
+        return False
+    return ret
+
+
+def old_audit_text(txt):
+    '''validate_audit()'s text, before it kept running marker counts.'''
+    ret = ""
+    b = "- ----BEGIN BITCOIN SIGNED MESSAGE-----"
+    c = "- ----BEGIN SIGNATURE-----"
+    d = "- ----END BITCOIN SIGNED MESSAGE-----"
+    for line in txt.splitlines():
+        if line == b and ret.count(b[2:]) == 0:
+            line = line.replace('- ----', '-----')
+        elif line == c and ret.count(c[2:]) == 1:
+            line = line.replace('- ----', '-----')
+        elif line == d and ret.count(d[2:]) == 1:
+            line = line.replace('- ----', '-----')
+        ret += line + '\n'
+    return ret
+
+
+# lines of generated documents: markers plain, escaped, or run into text,
+# fields, signature-like lines and blanks
+LINES = [B, S, E, 'x' + B, '-' + B, '-' + S, B + 'y', '- ' + B[1:] + '\r', '- ' + B[1:],
+         '- ' + S[1:], '- ' + E[1:], '', '', 'Rein Job', 'Job ID: 1', 'Name:', 'x: y: z',
+         '1Addr', 'SIGxyz=', 'text here', 'a\r', ' ']
+
+# pieces of generated text, to put markers anywhere within lines
+PIECES = [B, S, E, '- ' + B[1:], '- ' + S[1:], '- ' + E[1:], '\n', '\n', '\n\n', '-', '- ',
+          'A', 'z1', '=+/', ' ', '٣', '[', ']^_`', '\r', 'x: y', '-----', '-----END',
+          '1Addr\nSig=\n']
+
+
+def line_document(rnd):
+    if rnd.random() < 0.7:
+        body = [rnd.choice(LINES[6:]) for _ in range(rnd.randint(0, 5))]
+        pre = [rnd.choice(LINES[6:]) for _ in range(rnd.randint(0, 2))] if rnd.random() < .3 else []
+        post = [rnd.choice(LINES) for _ in range(rnd.randint(0, 3))] if rnd.random() < .6 else []
+        lines = pre + [B] + body + [S, '1Addr', 'SIGxyz=', E] + post
+    else:
+        lines = [rnd.choice(LINES) for _ in range(rnd.randint(1, 12))]
+    text = '\n'.join(lines)
+    if rnd.random() < .1:
+        text = text.replace('\n', '\r\n')
+    if rnd.random() < .3:
+        text += '\n' * rnd.randint(1, 3)
+    return text
+
+
+def piece_document(rnd):
+    return ''.join(rnd.choice(PIECES) for _ in range(rnd.randint(0, 30)))
+
+
+def nest(text, depth):
+    '''text signed again depth times, with escaped markers inside.'''
+    for n in range(depth):
+        text = '\n'.join([B, text.replace('-----', '- ----'),
+                          S, '1Outer%d' % n, 'H' + 'b' * 87, E])
+    return text
+
+
+class StripTest(unittest.TestCase):
+    def check(self, text):
+        doc = armor.parse(text)
+        self.assertEqual(doc.message, old_strip_armor(text), repr(text))
+        self.assertEqual(validate.strip_armor(text, True), old_strip_armor(text, True), repr(text))
+        self.assertEqual(doc.info(), old_parse_sig(text), repr(text))
+
+    def test_samples(self):
+        inner = '\n'.join([B, 'Rein Job', 'Job ID: 1', S, '1Addr', 'H' + 'a' * 87, E])
+        for depth in range(4):
+            self.check(nest(inner, depth))
+            self.check('lead\n' + nest(inner, depth) + '\n\ntrail')
+
+    def test_generated_lines(self):
+        rnd = random.Random(12)
+        for _ in range(5000):
+            self.check(line_document(rnd))
+
+    def test_generated_pieces(self):
+        rnd = random.Random(34)
+        for _ in range(5000):
+            self.check(piece_document(rnd))
+
+    def test_audit_text(self):
+        rnd = random.Random(56)
+        for _ in range(2000):
+            text = nest(line_document(rnd), rnd.randint(0, 3))
+            message = armor.parse(text).message
+            self.assertEqual(validate._audit_text(message), old_audit_text(message), repr(text))
+
+
+if __name__ == '__main__':
+    unittest.main()
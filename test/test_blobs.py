@@ -0,0 +1,77 @@
+'''
+Tests for blobs.compact() next to a writer whose segment append isn't
+committed yet.
+
+    python -m unittest discover -s test
+'''
+import os
+import unittest
+
+from sqlalchemy.orm import Session
+
+import support
+import blobs
+from database import db
+from models import Blob, content_digest
+from writes import run, store_kv, delete_kv, owned
+
+OWNER = '1HZwkjkeaoZfTSaJxDw6aKkxp45agDiEzN'
+
+# with support's segment sizes: OLD and NEW go to segment 1, LAST starts 2
+OLD = 'Rein Job\nJob ID: 1\n' + 'a' * 1000
+NEW = 'Rein Job\nJob ID: 2\n' + 'b' * 400
+LAST = 'Rein Job\nJob ID: 3\n' + 'c' * 1500
+
+
+def value(digest):
+    db.session.expire_all()
+    row = db.session.query(*blobs.READ_COLUMNS).filter(Blob.digest == digest).one()
+    return row.segment, blobs.value_of(row)
+
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_db()
+        # segment 1 holds only deleted bytes
+        run(db.session, store_kv('sqlite', 'old', OLD, OWNER, None, False))
+        db.session.commit()
+        run(db.session, delete_kv('sqlite', run(db.session, owned('old', OWNER))))
+        db.session.commit()
+        # another writer appends to it and to segment 2, and hasn't committed
+        self.writer = Session(bind=db.engine)
+        run(self.writer, store_kv('sqlite', 'new', NEW, OWNER, None, False))
+        run(self.writer, store_kv('sqlite', 'last', LAST, OWNER, None, False))
+        self.assertEqual(blobs.store.segments(), [1, 2])
+
+    def tearDown(self):
+        self.writer.close()
+        db.session.rollback()
+
+    def commit_writer(self):
+        db.session.rollback()
+        self.writer.commit()
+
+    def test_grace_skips_the_segment(self):
+        self.assertEqual(blobs.compact(db.session)['compacted'], 0)
+        self.commit_writer()
+        self.assertEqual(value(content_digest(NEW)), (1, NEW))
+        self.assertEqual(blobs.store.segments(), [1, 2])
+
+    def test_no_grace_revives_the_segment(self):
+        # what the grace period guards against: the row the writer is about
+        # to commit points into a segment compaction retires
+        self.assertEqual(blobs.compact(db.session, grace=0)['compacted'], 1)
+        self.assertTrue(blobs.store.retired(1))
+        self.commit_writer()
+        # still readable from the retired file
+        self.assertEqual(value(content_digest(NEW)), (1, NEW))
+        # the next run puts it back, and moves the blob out of it
+        self.assertEqual(blobs.compact(db.session, grace=0)['moved'], 1)
+        self.assertEqual(value(content_digest(NEW)), (2, NEW))
+        self.assertEqual(value(content_digest(LAST)), (2, LAST))
+        self.assertTrue(blobs.store.retired(1))
+        self.assertTrue(os.path.exists(blobs.store.filename(1, dead=True)))
+
+
+if __name__ == '__main__':
+    unittest.main()
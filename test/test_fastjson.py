@@ -0,0 +1,43 @@
+'''
+Tests for fastjson.py.
+
+    python -m unittest discover -s test
+'''
+import json
+import unittest
+
+import fastjson
+
+
+class EncoderTest(unittest.TestCase):
+    def tearDown(self):
+        fastjson.set_encoder('auto')
+
+    def test_json_writes_none_key_as_null(self):
+        fastjson.set_encoder('json')
+        self.assertEqual(json.loads(fastjson.dumps({None: 1})), {'null': 1})
+
+    @unittest.skipIf(fastjson.orjson is None, 'orjson is not installed')
+    def test_orjson_refuses_none_key(self):
+        fastjson.set_encoder('orjson')
+        with self.assertRaises(TypeError):
+            fastjson.dumps({None: 1})
+
+    def test_string_keys_agree(self):
+        obj = {'result': 'success', 'jobs': [{'key': 'k', 'value': 'vé'}], 'next_cursor': None}
+        bodies = [json.loads(fastjson.dumps(obj).decode('utf-8'))]
+        if fastjson.orjson is not None:
+            fastjson.set_encoder('orjson')
+            bodies.append(json.loads(fastjson.dumps(obj).decode('utf-8')))
+        for body in bodies:
+            self.assertEqual(body, obj)
+
+    def test_kv_body(self):
+        for name in ('json', 'orjson') if fastjson.orjson is not None else ('json',):
+            fastjson.set_encoder(name)
+            body = fastjson.kv_body('k', fastjson.fragment('a "v"'))
+            self.assertEqual(json.loads(body.decode('utf-8')), {'key': 'k', 'value': 'a "v"'})
+
+
+if __name__ == '__main__':
+    unittest.main()
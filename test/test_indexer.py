@@ -0,0 +1,146 @@
+'''
+Tests for indexer.py: /query lookups through docindex against the LIKE
+scans they replaced.
+
+    python -m unittest discover -s test
+'''
+import re
+import unittest
+
+import support
+from support import signed
+from database import db
+from indexer import answer, index_rows
+from writes import run, store_kv
+
+OWNER = '1HZwkjkeaoZfTSaJxDw6aKkxp45agDiEzN'
+
+DOCS = [('job1', signed('Rein Job',
+                        'Job name: Logo',
+                        'Job ID: 7A1C',
+                        'Job creator public key: 02AbCdEf',
+                        'Mediator public key: 03MeDiAtOr')),
+        ('job2', signed('Rein Job',
+                        'Job name: Site',
+                        'Job ID: b9f2',
+                        'Job creator public key: 02abcdef',
+                        'Mediator public key: 03other')),
+        ('bid1', signed('Rein Bid',
+                        'Job ID: 7a1c',
+                        'Worker public key: 02WoRkEr')),
+        ('offer1', signed('Rein Offer',
+                          'Job ID: 7a1c',
+                          'Worker public key: 02worker',
+                          'Mediator public key: 03mediator')),
+        ('delivery1', signed('Rein Delivery',
+                             'Job ID: b9f2',
+                             'Job creator public key: 02ABCDEF')),
+        ('enroll1', signed('Rein User Enrollment',
+                           'User: Alice',
+                           'Contact: alice@example.com',
+                           'Master signing address: 1MasterAddr',
+                           'Delegate signing address: 1DelegateAddr',
+                           'Willing to mediate: True',
+                           'Secure Identity Number: AbC123')),
+        ('enroll2', signed('Rein User Enrollment',
+                           'User: Bob',
+                           'Willing to mediate: true',
+                           'Secure Identity Number: dEf456')),
+        ('enroll3', signed('Rein User Enrollment',
+                           'User: Carol',
+                           'Willing to mediate: False',
+                           'Secure Identity Number: ghi789')),
+        ('rating1', signed('Rein Rating',
+                           'User msin: AbC123',
+                           'Rater msin: DEF456')),
+        ('rating2', signed('Rein Rating',
+                           'User msin: ghi789',
+                           'Rater msin: abc123')),
+       ]
+
+
+def like(pattern, value):
+    '''SQL ILIKE, which the case-insensitive scans used and which LIKE is
+    on SQLite.'''
+    regex = ''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern)
+    return re.match(regex + r'\Z', value, re.I | re.S) is not None
+
+
+def old_answer(string, args):
+    '''The documents the LIKE scans in cserver.query() returned.'''
+    def where(*patterns):
+        return [v for k, v in DOCS if all(like(p, v) for p in patterns)]
+    if string == 'mediators':
+        return where('%\nWilling to mediate: True%')
+    if string == 'jobs':
+        return where('%\nRein Job%')
+    if string == 'bids':
+        return where('%\nRein Bid%')
+    if string == 'deliveries':
+        return where('%Rein Delivery%Job creator public key: ' + args['job_creator'] + '%')
+    if string == 'in-process':
+        return where('%Worker public key: ' + args['worker'] + '%')
+    if string == 'review':
+        return where('%Mediator public key: ' + args['mediator'] + '%')
+    if string == 'by_job_id':
+        return [v for job_id in args['job_ids'].split(',')
+                for v in where('%Job ID: ' + job_id + '\n%')]
+    if string == 'get_user_ratings':
+        patterns = ['%\nRein Rating%']
+        if args.get('dest'):
+            patterns.append('%\nUser msin: {}%'.format(args['dest']))
+        if args.get('source'):
+            patterns.append('%\nRater msin: {}%'.format(args['source']))
+        return where(*patterns)
+    if string == 'get_user_name':
+        return where('%\nRein User Enrollment%',
+                     '%\nSecure Identity Number: {}%'.format(args['msin']))
+
+
+class LookupTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        support.reset_db()
+        for key, value in DOCS:
+            run(db.session, store_kv('sqlite', key, value, OWNER, None, False))
+        db.session.commit()
+
+    def new_answer(self, string, args):
+        res, cursor = run(db.session, answer(db.session, string, False, args, 0, 100))
+        self.assertIsNone(cursor)
+        return [r['value'] if isinstance(r, dict) else r for r in res]
+
+    def check(self, string, **args):
+        old = old_answer(string, args)
+        self.assertTrue(old, 'no sample document matches %s %r' % (string, args))
+        self.assertEqual(self.new_answer(string, args), old)
+
+    def test_types(self):
+        for string in ('mediators', 'jobs', 'bids'):
+            self.check(string)
+
+    def test_fields_ignore_case(self):
+        self.check('deliveries', job_creator='02abcdef')
+        self.check('in-process', worker='02WORKER')
+        self.check('review', mediator='03mediator')
+        self.check('review', mediator='03OTHER')
+        self.check('by_job_id', job_ids='7a1c')
+        self.check('by_job_id', job_ids='B9F2')
+        self.check('get_user_ratings', dest='abc123')
+        self.check('get_user_ratings', source='def456')
+        self.check('get_user_ratings', dest='GHI789', source='ABC123')
+        self.check('get_user_name', msin='ABC123')
+        self.check('get_user_name', msin='def456')
+
+    def test_no_match(self):
+        self.assertEqual(self.new_answer('in-process', {'worker': '02nobody'}), [])
+        self.assertEqual(old_answer('in-process', {'worker': '02nobody'}), [])
+
+    def test_index_rows_fold(self):
+        docs, grams = index_rows('k', False, DOCS[0][1])
+        self.assertIn(('Job ID', '7a1c'), [(row['field'], row['value']) for row in docs])
+        self.assertTrue(all(row['value'] == row['value'].lower() for row in docs))
+
+
+if __name__ == '__main__':
+    unittest.main()
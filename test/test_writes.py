@@ -0,0 +1,116 @@
+'''
+Tests for writes.py: bucket charges and blob references, run on a scratch
+database.
+
+    python -m unittest discover -s test
+'''
+import unittest
+from datetime import datetime
+
+import support
+from database import db
+from models import Owner, Sale, Kv, Blob, BUCKET_SIZE, content_digest
+from writes import run, charge_many, store_kv, delete_kv, owned
+
+OWNER = '1HZwkjkeaoZfTSaJxDw6aKkxp45agDiEzN'
+
+
+def bucket(used):
+    '''A new active bucket for OWNER with used bytes charged, by id.'''
+    s = Sale(OWNER, 'contact', 1, 30, 0, 'addr')
+    s.created = datetime.utcnow()
+    s.bytes_used = used
+    db.session.add(s)
+    db.session.commit()
+    return s.id
+
+
+def usage():
+    db.session.expire_all()
+    return dict(db.session.query(Sale.id, Sale.bytes_used))
+
+
+class ChargeManyTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_db()
+        db.session.add(Owner(OWNER, OWNER))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_new_keys_share_a_bucket(self):
+        a, b = bucket(0), bucket(BUCKET_SIZE - 100)
+        sizes = [('k%d' % i, 10) for i in range(20)] + [('k0', 30)]
+        placed = run(db.session, charge_many(OWNER, sizes, {}))
+        self.assertEqual(set(sale for sale, size in placed.values()), {a})
+        self.assertEqual(placed['k0'], (a, 30))
+        self.assertEqual(usage(), {a: 220, b: BUCKET_SIZE - 100})
+
+    def test_overwrites_stay_in_their_buckets(self):
+        a, b = bucket(5), bucket(10)
+        placed = run(db.session, charge_many(OWNER, [('x', 50), ('y', 60), ('z', 7)],
+                                             {'x': (b, 10), 'y': (a, 5)}))
+        self.assertEqual(placed, {'x': (b, 50), 'y': (a, 60), 'z': (b, 7)})
+        self.assertEqual(usage(), {a: 60, b: 57})
+
+    def test_falls_back_when_a_bucket_is_full(self):
+        a, b = bucket(0), bucket(BUCKET_SIZE - 100)
+        placed = run(db.session, charge_many(OWNER, [('x', 200), ('y', 10)],
+                                             {'x': (b, 50), 'y': (b, 5)}))
+        self.assertEqual(placed, {'x': (a, 200), 'y': (b, 10)})
+        self.assertEqual(usage(), {a: 200, b: BUCKET_SIZE - 100 - 50 + 5})
+
+    def test_no_room(self):
+        a = bucket(BUCKET_SIZE - 10)
+        self.assertIsNone(run(db.session, charge_many(OWNER, [('x', 20)], {})))
+
+
+def refs():
+    '''Map of blob digest -> refs.'''
+    db.session.expire_all()
+    return dict(db.session.query(Blob.digest, Blob.refs))
+
+
+class RefsTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_db()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def store(self, key, value):
+        run(db.session, store_kv('sqlite', key, value, OWNER, None, False))
+        db.session.commit()
+
+    def delete(self, key):
+        run(db.session, delete_kv('sqlite', run(db.session, owned(key, OWNER))))
+        db.session.commit()
+
+    def test_shared_value(self):
+        # the second is big enough for a segment file
+        for value in ('Rein Job\nJob ID: 1\n', 'Rein Job\nJob ID: 2\n' + 'x' * 400):
+            digest = content_digest(value)
+            self.store('a', value)
+            self.store('b', value)
+            self.assertEqual(refs(), {digest: 2})
+            self.delete('a')
+            self.assertEqual(refs(), {digest: 1})
+            self.delete('b')
+            self.assertEqual(refs(), {})
+
+    def test_overwrite(self):
+        self.store('a', 'one')
+        self.store('b', 'one')
+        self.store('a', 'two')
+        self.assertEqual(refs(), {content_digest('one'): 1, content_digest('two'): 1})
+        self.store('b', 'two')
+        self.assertEqual(refs(), {content_digest('two'): 2})
+        # the same value again keeps one reference per key
+        self.store('b', 'two')
+        self.assertEqual(refs(), {content_digest('two'): 2})
+        self.assertEqual(db.session.query(Kv).count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
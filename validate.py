@@ -1,21 +1,12 @@
 #!/usr/bin/env python
-import re
+import armor
 import bitcoinecdsa
 import unittest
 
 
 def strip_armor(sig, dash_space=False):
     '''Removes ASCII-armor from a signed message by default exlcudes 'dash-space' headers'''
-    sig = sig.replace('- ----', '-' * 5) if dash_space else sig
-    sig = re.sub("-{5}BEGIN BITCOIN SIGNED MESSAGE-{5}", "", sig)
-    sig = re.sub(
-        "\n+-{5}BEGIN SIGNATURE-{5}[\n\dA-z+=/]+-{5}END BITCOIN SIGNED MESSAGE-{5}\n*",
-        "",
-        sig
-    )
-    sig = re.sub("^\n", "", sig)
-    sig = re.sub("\n\n", "", sig)
-    return sig
+    return armor.strip(sig, dash_space)
 
 
 def parse_sig(sig):
@@ -25,31 +16,17 @@ def parse_sig(sig):
     assigned within the message, for example:
        parse_sig(sig)['Name/handle'] === "David Sterry"
     '''
-    matches = re.finditer("(.+):\s(.+)\n", sig)
-    ret = {}
-    for match in matches:
-        ret[match.group(1)] = match.group(2)
-    m = re.search(
-        "-{5}BEGIN SIGNATURE-{5}\n([A-z\d=+/]+)\n([A-z\d=+/]+)"
-        "\n-{5}END BITCOIN SIGNED MESSAGE-{5}",
-        sig
-    )
-    if m:
-        ret['signature_address'] = m.group(1)
-        ret['signature'] = m.group(2)
-    else:
-        return False
-    return ret
+    return armor.parse(sig).info()
 
 
 def verify_sig(sig):
     '''The base function for verifying an ASCII-armored signature.'''
-    sig_info = parse_sig(sig)
+    doc = sig if isinstance(sig, armor.Document) else armor.parse(sig)
+    sig_info = doc.info()
     if sig_info:
-        message = strip_armor(sig)
         valid = bitcoinecdsa.verify(
             sig_info['signature_address'],
-            message,
+            doc.message,
             sig_info['signature']
         )
     else:
@@ -66,34 +43,44 @@ def validate_enrollment(enrollment_signature_text):
 
 
 def validate_review(reviewer_text):
-    a = verify_sig(reviewer_text)
+    doc = armor.parse(reviewer_text)
+    a = verify_sig(doc)
     return [
         a['valid'],
         a['info']['signature_address'],
-        strip_armor(reviewer_text).replace('- ----', '-----')
+        doc.message.replace('- ----', '-----')
     ]
 
 
 def validate_audit(auditor_text):
-    a = verify_sig(auditor_text)
-    txt = strip_armor(auditor_text)
-    ret = ""
+    doc = armor.parse(auditor_text)
+    a = verify_sig(doc)
+    return [
+        a['valid'],
+        a['info'],
+        _audit_text(doc.message)
+    ]
+
+
+def _audit_text(txt):
+    '''The audited text with the markers of the review it wraps unescaped.'''
+    ret = []
     b = "- ----BEGIN BITCOIN SIGNED MESSAGE-----"
     c = "- ----BEGIN SIGNATURE-----"
     d = "- ----END BITCOIN SIGNED MESSAGE-----"
+    # running counts of each marker (escaped or not) emitted so far
+    seen = {b: 0, c: 0, d: 0}
     for line in txt.splitlines():
-        if line == b and ret.count(b[2:]) == 0:
+        if line == b and seen[b] == 0:
             line = line.replace('- ----', '-----')
-        elif line == c and ret.count(c[2:]) == 1:
+        elif line == c and seen[c] == 1:
             line = line.replace('- ----', '-----')
-        elif line == d and ret.count(d[2:]) == 1:
+        elif line == d and seen[d] == 1:
             line = line.replace('- ----', '-----')
-        ret += line + '\n'
-    return [
-        a['valid'],
-        a['info'],
-        ret
-    ]
+        for m in seen:
+            seen[m] += line.count(m[2:])
+        ret.append(line + '\n')
+    return ''.join(ret)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+'''
+Signature verification service backed by a process pool.
+
+Public-key recovery is CPU-bound, so request handlers hand it to worker
+processes instead of running it in the request thread. Results go through the
+shared bitcoinecdsa.verify_cache in the calling process, so the pool only
+sees cache misses.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import threading
+
+import bitcoin
+import bitcoinecdsa
+from bitcoinecdsa import VerifyCache, verify_cache
+
+
+_configured = None
+
+
+def _check(task):
+    '''Verify one (testnet, engine, address, message, signature) task.'''
+    global _configured
+    testnet, engine = task[:2]
+    if _configured != (testnet, engine):
+        # first task in this worker (or settings changed): match the server
+        bitcoin.SelectParams('testnet' if testnet else 'mainnet')
+        bitcoinecdsa.set_engine(engine)
+        _configured = (testnet, engine)
+    try:
+        return bitcoinecdsa.verify_uncached(*task[2:])
+    except Exception:
+        return False
+
+
+class Verifier(object):
+    def __init__(self, workers=2, testnet=False):
+        self.workers = workers      # 0 verifies inline in the calling thread
+        self.testnet = testnet
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def _pool(self):
+        # created on first use so each forked server process gets its own
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self.pool
+
+    def verify(self, address, message, signature):
+        return self.verify_many([(address, message, signature)])[0]
+
+    def verify_many(self, items):
+        '''Verify [(address, message, signature), ...], returning a list of bools.
+
+        Malformed signatures count as invalid.'''
+        keys, results, missing = self._cached(items)
+        if not missing:
+            return results
+        if self.workers:
+            checked = list(self._pool().map(_check, self._tasks(items, missing)))
+        else:
+            checked = [self._inline(items[i]) for i in missing]
+        return self._record(keys, results, missing, checked)
+
+    async def verify_many_async(self, items):
+        '''verify_many for asyncio callers: waits on the pool without blocking the loop.'''
+        keys, results, missing = self._cached(items)
+        if not missing:
+            return results
+        if self.workers:
+            pool = self._pool()
+            checked = await asyncio.gather(*[asyncio.wrap_future(pool.submit(_check, task))
+                                             for task in self._tasks(items, missing)])
+        else:
+            checked = [self._inline(items[i]) for i in missing]
+        return self._record(keys, results, missing, checked)
+
+    async def verify_async(self, address, message, signature):
+        return (await self.verify_many_async([(address, message, signature)]))[0]
+
+    @staticmethod
+    def _cached(items):
+        keys = [VerifyCache.key(*item) for item in items]
+        results = [verify_cache.get(key) for key in keys]
+        missing = [i for i, valid in enumerate(results) if valid is None]
+        return keys, results, missing
+
+    def _tasks(self, items, missing):
+        return [(self.testnet, bitcoinecdsa.engine) + tuple(items[i]) for i in missing]
+
+    @staticmethod
+    def _record(keys, results, missing, checked):
+        for i, valid in zip(missing, checked):
+            verify_cache.put(keys[i], valid)
+            results[i] = valid
+        return results
+
+    @staticmethod
+    def _inline(item):
+        try:
+            return bitcoinecdsa.verify_uncached(*item)
+        except Exception:
+            return False
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
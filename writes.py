@@ -0,0 +1,324 @@
+'''
+The write path shared by cserver.py and aserver.py.
+
+Each operation is a generator of steps. It yields a statement and is sent
+back the rows of a query, or the row count of anything else, or it yields a
+Blocking call and is sent back its result. run() drives an operation on a
+Session and arun() on an adb connection, where blocking calls (segment
+appends, which fsync) go to an executor. The SQL, and the decisions made
+between statements, are then written once for both servers.
+
+    sale_id = run(db.session, charge(owner, size))
+    sale_id = await arun(conn, charge(owner, size))
+
+Statements are built from the blobs, indexer and nonces builders. Callers
+commit.
+'''
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_
+from sqlalchemy.orm import Query, scoped_session
+from sqlalchemy.sql.expression import Select
+
+from adb import Statements
+from models import Owner, Kv, Sale, DocIndex, Trigram, BUCKET_SIZE, content_digest, kv_size
+from indexer import index_rows, row_types, indexed_types, version_bumps
+from nonces import set_owner, owner_live, add_window, trim_window, spend, outstanding
+import blobs
+
+q = Statements()
+
+
+class Blocking(object):
+    '''A step that calls fn(*args), off the event loop under arun().'''
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+
+def run(session, steps):
+    '''Run steps on session and return the operation's result.'''
+    if isinstance(session, scoped_session):
+        # Query.with_session() wants the thread's Session itself
+        session = session()
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        if isinstance(step, Blocking):
+            result = step.fn(*step.args)
+        elif isinstance(step, Query):
+            result = step.with_session(session).all()
+        elif isinstance(step, Select):
+            result = session.execute(step).fetchall()
+        else:
+            result = session.execute(step).rowcount
+
+
+async def arun(conn, steps):
+    '''Run steps on an adb connection and return the operation's result.'''
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        if isinstance(step, Blocking):
+            result = await asyncio.get_event_loop().run_in_executor(None, step.fn, *step.args)
+        elif isinstance(step, (Query, Select)):
+            result = await conn.fetch_all(step)
+        else:
+            result = await conn.execute(step)
+
+
+def first(rows):
+    '''The first of a query step's rows, or None.'''
+    return rows[0] if rows else None
+
+
+def active(created, term, now):
+    '''True if a bucket created for term days hasn't expired by now.'''
+    return created is not None and created + timedelta(days=term) > now
+
+
+def allocate(owner, size):
+    '''Charge size bytes to one of owner's active buckets and return its id.
+
+    Buckets are tried most free space first. The charge is a conditional
+    UPDATE, so concurrent puts can't push a bucket past BUCKET_SIZE.
+    Returns None if no bucket has room.'''
+    now = datetime.utcnow()
+    sale = Sale.__table__
+    buckets = yield q.query(Sale.id, Sale.created, Sale.term, Sale.bytes_used) \
+                     .filter(Sale.owner == owner) \
+                     .order_by(Sale.bytes_used)
+    for sale_id, created, term, bytes_used in buckets:
+        if not active(created, term, now) or bytes_used + size > BUCKET_SIZE:
+            continue
+        updated = yield sale.update().where(and_(sale.c.id == sale_id,
+                                                 sale.c.bytes_used + size <= BUCKET_SIZE)) \
+                                     .values(bytes_used=sale.c.bytes_used + size)
+        if updated:
+            return sale_id
+    return None
+
+
+def charge(owner, size, current=None):
+    '''Charge a write of size bytes and return the bucket it is stored under.
+
+    current is the (sale, size) of the value being overwritten, if any.
+    An overwrite stays in its bucket when the size difference fits there;
+    otherwise it moves to the bucket allocate() picks and its old size is
+    released. Returns None if nothing has room.'''
+    if current is not None and current[0] is not None:
+        if (yield from adjust(current[0], size - (current[1] or 0))):
+            return current[0]
+    sale_id = yield from allocate(owner, size)
+    if sale_id is not None and current is not None and current[0] is not None:
+        yield from adjust(current[0], -(current[1] or 0))
+    return sale_id
+
+
+def charge_many(owner, sizes, current):
+    '''Charge a batch of writes and return a map of key -> (sale, size).
+
+    sizes is the (key, size) of each write in order, a repeated key
+    overwriting its earlier write, and current is stored_sizes() for them.
+    Each bucket is charged once for the sum landing in it: overwrites stay
+    in their buckets and new keys go together to the one allocate() picks.
+    If the batch won't fit that way, keys are charged one at a time with
+    charge(). Returns None if one of them has no room.'''
+    final = dict(sizes)
+    deltas = {}
+    new = 0
+    for key, size in final.items():
+        sale_id, old = current.get(key, (None, None))
+        if sale_id is None:
+            new += size
+        else:
+            deltas[sale_id] = deltas.get(sale_id, 0) + size - (old or 0)
+    charged = []
+    for sale_id, delta in sorted(deltas.items()):
+        if not (yield from adjust(sale_id, delta)):
+            break
+        charged.append((sale_id, delta))
+    else:
+        bucket = (yield from allocate(owner, new)) if new else None
+        if bucket is not None or not new:
+            return dict((key, (current.get(key, (None, None))[0] or bucket, size))
+                        for key, size in final.items())
+    # give back what was charged and go key by key
+    for sale_id, delta in charged:
+        yield from adjust(sale_id, -delta)
+    placed = {}
+    for key, size in final.items():
+        sale_id = yield from charge(owner, size, current.get(key))
+        if sale_id is None:
+            return None
+        placed[key] = (sale_id, size)
+    return placed
+
+
+def adjust(sale_id, delta):
+    '''Add delta bytes to one bucket's usage and return True.
+
+    Growth is refused (False) if the bucket has expired or would pass
+    BUCKET_SIZE.'''
+    sale = Sale.__table__
+    where = sale.c.id == sale_id
+    if delta > 0:
+        row = first((yield q.query(Sale.created, Sale.term).filter(Sale.id == sale_id)))
+        if row is None or not active(row.created, row.term, datetime.utcnow()):
+            return False
+        where = and_(where, sale.c.bytes_used + delta <= BUCKET_SIZE)
+    return (yield sale.update().where(where).values(bytes_used=sale.c.bytes_used + delta)) == 1
+
+
+def stored_sizes(owner, keys):
+    '''Map of key -> (sale, size) for the keys owner already stores.'''
+    rows = yield q.query(Kv.key, Kv.sale, Kv.size).filter(Kv.owner == owner, Kv.key.in_(keys))
+    return dict((key, (sale, size)) for key, sale, size in rows)
+
+
+def check_nonce(nonces, owner, nonce):
+    '''True if nonce may be outstanding for owner, a row with address, nonce
+    and nonce_expires, without using it up. Only consume_nonce() decides.'''
+    if not nonce:
+        return False
+    now = int(time.time())
+    if nonces.cached(owner.address, nonce) or (owner.nonce == nonce and owner_live(owner, now)):
+        return True
+    # pre-issued by another process
+    return bool((yield outstanding(q, owner.address, nonce, now)))
+
+
+def consume_nonce(nonces, owner, nonce):
+    '''Use nonce up for owner, a row with address and nonce; False if it was
+    not outstanding.
+
+    One conditional statement spends it, so of concurrent writers in any
+    process only one gets True. owner.nonce as read for check_nonce() says
+    which store holds it: a nonce handed out after that read was not yet
+    known to the client.'''
+    if not nonce:
+        return False
+    nonces.discard(owner.address, nonce)
+    clear, take = spend(owner.address, nonce, int(time.time()))
+    return (yield clear if owner.nonce == nonce else take) == 1
+
+
+def issue_nonce(nonces, address, count=1, clear=None):
+    '''The /nonce reply for address, or None if it isn't an owner.
+
+    clear spends that nonce instead, replying with an empty nonce; a clear
+    that matches nothing outstanding falls through to the usual reply.
+    count > 1 pre-issues a window in the nonce table. Otherwise owner.nonce
+    is handed out until it expires, and a fresh one is stored only if
+    owner.nonce hasn't changed meanwhile.'''
+    owner = first((yield q.query(Owner.address, Owner.nonce, Owner.nonce_expires)
+                              .filter(Owner.address == address)))
+    if owner is None:
+        return None
+    if clear and (yield from consume_nonce(nonces, owner, clear)):
+        return {'nonce': ''}
+    if count > 1:
+        fresh = nonces.issue(address, count)
+        yield add_window(address, fresh, nonces.expires())
+        yield trim_window(address, int(time.time()), nonces.window)
+        return {'nonce': fresh[0], 'nonces': fresh}
+    if owner_live(owner, time.time()) and len(owner.nonce) == 32:
+        return {'nonce': owner.nonce}
+    fresh = nonces.issue(address)[0]
+    # a concurrent /nonce may have stored one first; hand out that one
+    if (yield set_owner(address, fresh, owner.nonce, nonces.expires())) != 1:
+        nonces.discard(address, fresh)
+        fresh = first((yield q.query(Owner.nonce).filter(Owner.address == address))).nonce
+    return {'nonce': fresh}
+
+
+def acquire(dialect, value, digest=None):
+    '''Reference value's blob, storing it first if new, and return the digest.
+
+    Tries the reference before the insert so a blob swept between the two
+    by a concurrent release is stored again.'''
+    digest = digest or content_digest(value)
+    while True:
+        if (yield blobs.add_ref(digest)):
+            return digest
+        if blobs.segmented(value):
+            # appending to a segment file syncs it to disk
+            stmt = yield Blocking(blobs.insert, dialect, digest, value)
+        else:
+            stmt = blobs.insert(dialect, digest, value)
+        if (yield stmt):
+            return digest
+
+
+def release(digest):
+    '''Drop one reference, deleting the blob with its last.'''
+    if digest is not None:
+        yield blobs.drop_ref(digest)
+        yield blobs.sweep(digest)
+
+
+def bump_versions(dialect, testnet, doc_types):
+    '''Add one to the docversion counters of doc_types.'''
+    for stmt in version_bumps(dialect, testnet, doc_types):
+        yield stmt
+
+
+def index(dialect, key, testnet, value):
+    '''Replace the index rows for key, now holding value, and bump its type
+    versions.'''
+    old = yield from unindex(key)
+    docs, grams = index_rows(key, testnet, value)
+    if docs:
+        yield DocIndex.__table__.insert().values(docs)
+    if grams:
+        yield Trigram.__table__.insert().values(grams)
+    yield from bump_versions(dialect, testnet, old | row_types(docs))
+
+
+def unindex(key):
+    '''Drop the index rows for key and return the document types it had.'''
+    types = set(row[0] for row in (yield indexed_types(q, key)))
+    yield DocIndex.__table__.delete().where(DocIndex.__table__.c.key == key)
+    yield Trigram.__table__.delete().where(Trigram.__table__.c.key == key)
+    return types
+
+
+def owned(key, owner):
+    '''The kv row for key if owner stores it, with what delete_kv() needs.'''
+    return first((yield q.query(Kv.key, Kv.digest, Kv.sale, Kv.size, Kv.testnet)
+                         .filter(Kv.key == key, Kv.owner == owner)))
+
+
+def store_kv(dialect, k, v, o, sale_id, testnet):
+    '''Insert or update a key owned by o and refresh its index rows.
+
+    sale_id is the bucket charge() put it in.'''
+    table = Kv.__table__
+    kv = first((yield q.query(Kv.testnet, Kv.digest).filter(Kv.key == k, Kv.owner == o)))
+    digest = yield from acquire(dialect, v)
+    if kv is None:
+        yield table.insert().values(key=k, owner=o, sale=sale_id, testnet=testnet,
+                                    digest=digest, size=kv_size(k, v))
+    else:
+        testnet = kv.testnet
+        yield table.update().where(table.c.key == k) \
+                   .values(digest=digest, size=kv_size(k, v), sale=sale_id)
+        yield from release(kv.digest)
+    yield from index(dialect, k, testnet, v)
+
+
+def delete_kv(dialect, kv):
+    '''Remove an owned() row and return its bytes to its bucket.'''
+    yield from adjust(kv.sale, -(kv.size or 0))
+    yield from bump_versions(dialect, kv.testnet, (yield from unindex(kv.key)))
+    yield Kv.__table__.delete().where(Kv.__table__.c.key == kv.key)
+    yield from release(kv.digest)